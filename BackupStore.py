@@ -0,0 +1,156 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import zlib
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows: stores are only locked against other threads
+    fcntl = None
+
+_store_lock = threading.Lock()
+
+
+class BackupStore:
+    """Content-addressed store of filesystem images
+
+    Images are split into blocks which are stored once, compressed, under their SHA-256. Each backup is a small JSON
+    manifest listing the block hashes of the image in order. Adding a backup and pruning hold the store's lock file,
+    so a prune never deletes blocks a backup being added relies on.
+    """
+
+    compress_level = 6
+
+    def __init__(self, root='backups'):
+        self.root = root
+        self.blocks_dir = os.path.join(root, 'blocks')
+        self.manifests_dir = os.path.join(root, 'manifests')
+
+    def _block_path(self, digest):
+        return os.path.join(self.blocks_dir, digest[:2], digest)
+
+    def _manifest_path(self, name):
+        return os.path.join(self.manifests_dir, name + '.json')
+
+    @contextmanager
+    def _locked(self):
+        os.makedirs(self.root, exist_ok=True)
+        with _store_lock, open(os.path.join(self.root, '.lock'), 'a') as fh:
+            if fcntl:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+            yield
+
+    @staticmethod
+    def _write_atomic(path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(data)
+        os.replace(tmp_path, path)
+
+    def unique_name(self, name):
+        candidate = name
+        suffix = 1
+        while os.path.exists(self._manifest_path(candidate)):
+            candidate = f"{name}.{suffix}"
+            suffix += 1
+        return candidate
+
+    def add(self, name, image, block_size=4096, device_id=''):
+        with self._locked():
+            return self._add(name, image, block_size, device_id)
+
+    def _add(self, name, image, block_size, device_id):
+        image = memoryview(image)
+        blocks = []
+        new_blocks = 0
+        for offset in range(0, len(image), block_size):
+            block = image[offset:offset + block_size]
+            digest = hashlib.sha256(block).hexdigest()
+            if not os.path.exists(self._block_path(digest)):
+                self._write_atomic(self._block_path(digest), zlib.compress(block, self.compress_level))
+                new_blocks += 1
+            blocks.append(digest)
+
+        manifest = {
+            'name': name,
+            'device_id': device_id,
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'block_size': block_size,
+            'size': len(image),
+            'blocks': blocks,
+        }
+        self._write_atomic(self._manifest_path(name), json.dumps(manifest, indent=1).encode('utf-8'))
+        return manifest, new_blocks
+
+    def names(self):
+        if not os.path.isdir(self.manifests_dir):
+            return []
+        return sorted(fn[:-len('.json')] for fn in os.listdir(self.manifests_dir) if fn.endswith('.json'))
+
+    def manifest(self, name):
+        with open(self._manifest_path(name), 'r') as fh:
+            return json.load(fh)
+
+    def iter_image(self, name):
+        """Yield the blocks of a backup image in order, verifying each one against its hash"""
+        for digest in self.manifest(name)['blocks']:
+            with open(self._block_path(digest), 'rb') as fh:
+                block = zlib.decompress(fh.read())
+            if hashlib.sha256(block).hexdigest() != digest:
+                raise ValueError(f"Backup block {digest} is corrupt")
+            yield block
+
+    def verify(self, name):
+        """Check every block of a backup is present and intact, raising like iter_image if one isn't"""
+        for _ in self.iter_image(name):
+            pass
+
+    def remove(self, name):
+        os.remove(self._manifest_path(name))
+
+    def import_legacy(self, block_size=4096):
+        """Move raw <device_id>-<timestamp>.littlefs images left in the store root into the store"""
+        imported = []
+        if not os.path.isdir(self.root):
+            return imported
+        for fn in sorted(os.listdir(self.root)):
+            path = os.path.join(self.root, fn)
+            if not fn.endswith('.littlefs') or not os.path.isfile(path):
+                continue
+            name = fn[:-len('.littlefs')]
+            with open(path, 'rb') as fh:
+                self.add(name, fh.read(), block_size, device_id=name.split('-')[0])
+            os.remove(path)
+            imported.append(name)
+        return imported
+
+    def prune(self):
+        """Delete every stored block that no manifest references. Returns (blocks removed, bytes freed)"""
+        with self._locked():
+            return self._prune()
+
+    def _prune(self):
+        referenced = set()
+        for name in self.names():
+            referenced.update(self.manifest(name)['blocks'])
+
+        removed = 0
+        freed = 0
+        if not os.path.isdir(self.blocks_dir):
+            return removed, freed
+        for prefix in os.listdir(self.blocks_dir):
+            prefix_dir = os.path.join(self.blocks_dir, prefix)
+            for digest in os.listdir(prefix_dir):
+                if digest not in referenced:
+                    path = os.path.join(prefix_dir, digest)
+                    freed += os.path.getsize(path)
+                    os.remove(path)
+                    removed += 1
+            if not os.listdir(prefix_dir):
+                os.rmdir(prefix_dir)
+        return removed, freed
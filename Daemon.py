@@ -0,0 +1,270 @@
+import base64
+import json
+import os
+import socket
+import socketserver
+import stat
+from DirIndex import normpath
+from ParticleLittleFS import (DeviceBusy, DeviceError, FileExists, FSError, NotMounted, ParticleLittleFSError,
+                              UnsavedChanges)
+from Trace import span
+from LazyImport import lazy_import
+
+errors = lazy_import('littlefs.errors')
+
+DEFAULT_SOCKET = 'particle-littlefs.sock'
+
+# JSON-RPC 2.0 error codes: the spec's, then ours
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+FS_ERROR = -32000       # littlefs refused the operation; data.error is its error name, e.g. ERR_NOENT
+IO_ERROR = -32001       # A host file, image or device operation failed
+BUSY = -32002           # The device is in use by another request
+
+
+def socket_path():
+    return os.environ.get('PARTICLE_DAEMON_SOCKET', DEFAULT_SOCKET)
+
+
+class RPCError(Exception):
+    def __init__(self, code, message, data=None):
+        super().__init__(message)
+        self.code = code
+        self.data = data
+
+
+def _entry(entry):
+    return {'path': entry.path, 'name': entry.name, 'type': entry.type, 'size': entry.size}
+
+
+class Daemon:
+    """The operations served over the socket. Each public method is an RPC method taking keyword parameters
+
+    Every method is a thin layer over a ParticleLittleFS session, so images are mounted, budgeted and evicted just
+    as in the CLI. The session runs one call at a time, as littlefs isn't reentrant; device transfers run on their
+    own threads, one per device and image file, while other requests carry on.
+    """
+
+    METHODS = ('mount', 'unmount', 'mounts', 'ls', 'stat', 'read', 'write', 'insert', 'extract', 'sync', 'devices',
+               'fsread', 'fswrite')
+
+    def __init__(self, session, local_filename):
+        self.session = session
+        self.local_filename = local_filename
+
+    @staticmethod
+    def _path(name, path):
+        # A path in the image mounted as `name`
+        return f"{name}:{normpath(path)}"
+
+    def mount(self, image, name=None):
+        name = name or os.path.splitext(os.path.basename(image))[0]
+        try:
+            mount = self.session.mount(image, name, replace=False)
+        except FileExists:
+            with self.session.lock:
+                mount = self.session.mounts.mounts.get(name)
+                if mount is None or os.path.abspath(mount.filename) != os.path.abspath(image):
+                    raise RPCError(INVALID_PARAMS, f"\"{name}\" is already mounted from "
+                                                   f"\"{mount.filename if mount else image}\"")
+        return {'name': name, 'image': mount.filename, 'size': mount.size}
+
+    def unmount(self, name, destination=None, discard=False):
+        return {'bytes_written': self.session.unmount(name, destination, save=not discard)}
+
+    def mounts(self):
+        with self.session.lock:
+            return [{'name': mount.name, 'image': mount.filename, 'unsaved': mount.is_dirty()}
+                    for mount in self.session.mounts]
+
+    def ls(self, name, path='/'):
+        return [_entry(entry) for entry in self.session.listdir(self._path(name, path))]
+
+    def stat(self, name, path):
+        return _entry(self.session.stat(self._path(name, path)))
+
+    def read(self, name, path, offset=0, length=None):
+        with self.session.read(self._path(name, path)) as fh:
+            fh.seek(offset)
+            data = fh.read() if length is None else fh.read(length)
+        return {'data': base64.b64encode(data).decode('ascii'), 'size': len(data)}
+
+    def write(self, name, path, data):
+        try:
+            payload = base64.b64decode(data, validate=True)
+        except ValueError as e:
+            raise RPCError(INVALID_PARAMS, f"data is not base64: {e}")
+        self.session.write_bytes(self._path(name, path), payload)
+        return {'bytes': len(payload)}
+
+    def insert(self, name, local, path):
+        return {'bytes': self.session.insert(local, self._path(name, path), overwrite=True)}
+
+    def extract(self, name, path, local):
+        return {'bytes': self.session.extract(self._path(name, path), local, overwrite=True)}
+
+    def sync(self, name, destination=None):
+        return {'bytes_written': self.session.sync(name, destination)}
+
+    def devices(self):
+        return [{'id': device.device_id, 'platform': device.platform.name, 'name': device.name}
+                for device in self.session.devices()]
+
+    def _run_transfer(self, description, start):
+        try:
+            transfer = start()
+        except DeviceBusy as e:
+            raise RPCError(BUSY, str(e))
+        except DeviceError as e:
+            raise RPCError(IO_ERROR if e.device_id else INVALID_PARAMS, str(e))
+        try:
+            result = transfer.wait()
+        except DeviceError as e:
+            raise RPCError(IO_ERROR, f"{description} failed: {e}", {'log': transfer.log})
+        return {'device': transfer.device_id, 'result': result, 'log': transfer.log}
+
+    def fsread(self, device=None, full=False, mount=None):
+        """Read the device into the local copy, mounting it as `mount` if given (replacing any image of that name).
+        Images of the local copy with unsaved changes must be synced, and so must the one `mount` replaces"""
+        if mount:
+            with self.session.lock:
+                replaced = self.session.mounts.mounts.get(mount)
+                if replaced and replaced.is_dirty():
+                    raise UnsavedChanges(f"\"{mount}\" has unsaved changes to \"{replaced.filename}\", sync it first")
+        result = self._run_transfer('fsread', lambda: self.session.fsread(device, full, self.local_filename))
+        if mount:
+            mounted = self.session.mount(self.local_filename, mount)
+            result['mount'] = {'name': mount, 'image': mounted.filename, 'size': mounted.size}
+        return result
+
+    def fswrite(self, device=None, delta=False, dry_run=False):
+        """Back up the device, then write the local copy to it. Unsaved changes to the local copy must be synced"""
+        result = self._run_transfer('fswrite', lambda: self.session.fswrite(device, self.local_filename, delta, dry_run))
+        result['result'] = result['result']._asdict()
+        return result
+
+    def call(self, method, params):
+        if method not in self.METHODS:
+            raise RPCError(METHOD_NOT_FOUND, f"unknown method \"{method}\"")
+        if not isinstance(params, dict):
+            raise RPCError(INVALID_PARAMS, "params must be an object")
+        with span(f"rpc.{method}"):
+            try:
+                return getattr(self, method)(**params)
+            except TypeError as e:
+                raise RPCError(INVALID_PARAMS, str(e))
+            except errors.LittleFSError as e:
+                raise RPCError(FS_ERROR, str(e), {'error': e.name})
+            except FileExistsError as e:
+                raise RPCError(FS_ERROR, str(e), {'error': "ERR_EXIST"})
+            except FSError as e:
+                raise RPCError(FS_ERROR, str(e), {'error': e.error})
+            except (NotMounted, UnsavedChanges) as e:
+                raise RPCError(INVALID_PARAMS, str(e))
+            except ParticleLittleFSError as e:
+                raise RPCError(IO_ERROR, str(e))
+            except (OSError, ValueError) as e:
+                raise RPCError(IO_ERROR, str(e))
+
+    def handle(self, line):
+        """The JSON-RPC response to one request line, or None for a notification"""
+        request_id = None
+        try:
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                raise RPCError(PARSE_ERROR, f"parse error: {e}")
+            if not isinstance(request, dict) or not isinstance(request.get('method'), str):
+                raise RPCError(INVALID_REQUEST, "invalid request")
+            request_id = request.get('id')
+            result = self.call(request['method'], request.get('params', {}))
+            if 'id' not in request:
+                return None
+            return {'jsonrpc': '2.0', 'id': request_id, 'result': result}
+        except RPCError as e:
+            error = {'code': e.code, 'message': str(e)}
+            if e.data is not None:
+                error['data'] = e.data
+            return {'jsonrpc': '2.0', 'id': request_id, 'error': error}
+        except Exception as e:
+            # A bug must not end the connection with the client still waiting for its response
+            return {'jsonrpc': '2.0', 'id': request_id,
+                    'error': {'code': INTERNAL_ERROR, 'message': f"internal error: {type(e).__name__}: {e}"}}
+
+    def close(self):
+        """Close every image. Unsaved changes are lost, so they are listed first"""
+        with self.session.lock:
+            for mount in self.session.mounts:
+                if mount.is_dirty():
+                    print(f"Discarding unsaved changes to \"{mount.name}\" ({mount.filename})")
+            self.session.close()
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            response = self.server.daemon.handle(line)
+            if response is not None:
+                self.wfile.write(json.dumps(response).encode() + b'\n')
+                self.wfile.flush()
+
+
+class DaemonServer(socketserver.ThreadingUnixStreamServer):
+    """Serves newline-delimited JSON-RPC 2.0 requests on a Unix socket, each connection on its own thread"""
+
+    daemon_threads = True
+
+    def __init__(self, path, daemon):
+        if os.path.exists(path):
+            if not stat.S_ISSOCK(os.stat(path).st_mode):
+                raise OSError(f"\"{path}\" exists and is not a socket")
+            # Replace a socket left by a daemon that didn't shut down cleanly, but never one still in use
+            probe = socket.socket(socket.AF_UNIX)
+            try:
+                probe.connect(path)
+                raise OSError(f"a daemon is already listening on \"{path}\"")
+            except ConnectionRefusedError:
+                os.remove(path)
+            finally:
+                probe.close()
+        self.daemon = daemon
+        umask = os.umask(0o177)  # Only our user may connect
+        try:
+            super().__init__(path, _RequestHandler)
+        finally:
+            os.umask(umask)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+class DaemonClient:
+    """Calls a daemon's methods, e.g. DaemonClient().call('ls', name='temp', path='/')"""
+
+    def __init__(self, path=None):
+        self.socket = socket.socket(socket.AF_UNIX)
+        self.socket.connect(path or socket_path())
+        self.file = self.socket.makefile('rwb')
+        self.next_id = 1
+
+    def call(self, method, **params):
+        request_id = self.next_id
+        self.next_id += 1
+        self.file.write(json.dumps({'jsonrpc': '2.0', 'id': request_id, 'method': method, 'params': params}).encode() + b'\n')
+        self.file.flush()
+        response = json.loads(self.file.readline())
+        if 'error' in response:
+            error = response['error']
+            raise RPCError(error['code'], error['message'], error.get('data'))
+        return response['result']
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
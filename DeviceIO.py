@@ -0,0 +1,326 @@
+import mmap
+import os
+import sys
+import tempfile
+from datetime import datetime
+from BackupStore import BackupStore
+from ParticleDFU import DFUError, open_dfu
+from ParticleUSB import ParticleDevice
+from LazyImport import lazy_import
+from ShellCmd import ShellCmd, DFU_PROGRESS_RE, ProgressParser, format_progress
+from LittleFSLayout import LayoutError, read_used_blocks
+from StreamIO import COPY_BUFFER_SIZE
+from Trace import span, tracer
+
+LittleFSImage = lazy_import('LittleFSImage')
+
+LOCAL_FILENAME = "temp.littlefs"
+BACKUP_PATH = "backups"
+DFU_FS_ADDRESS = 0x80000000
+# 'dfu-util' runs dfu-util for each transfer; 'native' (needs pyusb) and 'simulated' use the in-process DfuSe engine
+DFU_BACKEND = os.environ.get('PARTICLE_DFU_BACKEND', 'dfu-util')
+# Unneeded blocks a smart read will read through rather than start another transfer. Each dfu-util run costs far more
+# than a few extra blocks, an in-process transfer very little
+SMART_READ_GAP = {'dfu-util': 8}
+
+def run_shell_cmd(cmd, filter_str='', indent_char='\t', stdin_chunks=None, progress_callback=None, total_bytes=None):
+    # Output is echoed to stdout with dfu-util progress bars shown as parsed progress, unless `progress_callback` is
+    # supplied, in which case it receives the ProgressEvents and nothing is echoed
+    shell_cmd = ShellCmd(cmd, stdin_chunks=stdin_chunks, total_bytes=total_bytes)
+    if progress_callback:
+        shell_cmd.on_progress(progress_callback)
+    else:
+        in_progress = False
+
+        def echo_line(line):
+            nonlocal in_progress
+            if (filter_str and not line.startswith(filter_str)) or DFU_PROGRESS_RE.match(line) or not line.strip():
+                return
+            if in_progress:
+                sys.stdout.write('\n')
+                in_progress = False
+            sys.stdout.write(indent_char)
+            sys.stdout.write(line)
+
+        def echo_progress(event):
+            nonlocal in_progress
+            in_progress = True
+            sys.stdout.write(f"\r{indent_char}{format_progress(event)}   ")
+            sys.stdout.flush()
+
+        shell_cmd.on_line(echo_line).on_progress(echo_progress)
+
+    with span(os.path.basename(cmd[0]), args=' '.join(cmd[1:])) as trace:
+        result = shell_cmd.run()
+        if shell_cmd.last_progress:
+            trace.add(shell_cmd.last_progress.bytes)
+    if not progress_callback:
+        print()
+    return result
+
+def run_native_dfu(device: ParticleDevice, serial, transfer, progress_callback=None, indent_char='\t'):
+    # Runs transfer(engine) with the in-process DfuSe engine, returning 0 on success like dfu-util. Progress is echoed
+    # like run_shell_cmd's unless `progress_callback` is supplied. Ctrl-C cancels the transfer. However the transfer
+    # stops early, the device is returned to dfuIDLE, so it isn't left part way through a request
+    shown = None
+
+    def echo_progress(event):
+        nonlocal shown
+        if (event.operation, event.percent) != shown:
+            shown = (event.operation, event.percent)
+            sys.stdout.write(f"\r{indent_char}{format_progress(event)}   ")
+            sys.stdout.flush()
+
+    dfu = None
+    try:
+        dfu = open_dfu(DFU_BACKEND, device.platform.vid, device.platform.pid_dfu, serial or device_serial(device),
+                       progress_callback or echo_progress)
+        try:
+            transfer(dfu)
+        except BaseException:
+            try:
+                dfu.ensure_idle()   # DFU_ABORT, or DFU_CLRSTATUS if the transfer left the device in dfuERROR
+            except (DFUError, OSError, ValueError):
+                pass
+            raise
+        result = 0
+    except KeyboardInterrupt:
+        print(f"\n{indent_char}Transfer cancelled")
+        result = 1
+    except (DFUError, OSError, ValueError) as e:
+        print(f"\n{indent_char}DFU transfer failed: {e}")
+        result = 1
+    finally:
+        if dfu:
+            dfu.close()
+    if not progress_callback:
+        print()
+    return result
+
+def dfu_util_args(device: ParticleDevice, serial=None):
+    args = ['dfu-util',
+            '-d', f',{device.platform.vid:04x}:{device.platform.pid_dfu:04x}',
+            '-a', '2']
+    if serial:
+        args += ['-S', serial]
+    return args
+
+def device_serial(device: ParticleDevice):
+    # Particle devices report their device ID, in upper case, as the DFU serial number
+    return device.device_id.upper()
+
+def readFilesystem(filename: str, device: ParticleDevice, serial=None, progress_callback=None):
+    if DFU_BACKEND != 'dfu-util':
+        created = False
+
+        def upload(dfu):
+            nonlocal created
+            with open(filename, 'xb') as fh:
+                created = True
+                dfu.upload(DFU_FS_ADDRESS, device.platform.fs_size_bytes(), fh.write)
+        result = 1
+        try:
+            result = run_native_dfu(device, serial, upload, progress_callback)
+        finally:
+            if result and created:
+                os.remove(filename)     # Don't leave a partial image behind
+        return result
+
+    return run_shell_cmd(dfu_util_args(device, serial) +
+                         ['-s', f'0x{DFU_FS_ADDRESS:08x}:{device.platform.fs_size_bytes()}',
+                          '-U', filename],
+                         filter_str='Upload',
+                         progress_callback=progress_callback,
+                         total_bytes=device.platform.fs_size_bytes())
+
+def readFilesystemSmart(filename: str, device: ParticleDevice, serial=None, progress_callback=None, blocks_read=None,
+                        log=None):
+    """Like readFilesystem, but uploads only the blocks littlefs uses, leaving the rest of the image erased (0xFF)
+
+    The image still mounts like a full copy. Falls back to a full read if the filesystem structure can't be walked.
+    If `blocks_read` is a set, the numbers of the blocks actually read from the device are added to it. Notices,
+    such as falling back to a full read, are passed to `log` if given, otherwise printed.
+    """
+    block_size = device.platform.fs_block_size
+    total = device.platform.fs_size_bytes()
+    parser = ProgressParser(total)
+    fetched = 0  # Bytes read by finished transfers, so each transfer's progress can be reported as overall progress
+
+    def notice(message):
+        if log:
+            log(message)
+        else:
+            print(f"\t{message}")
+
+    def on_transfer(event):
+        if progress_callback:
+            progress_callback(parser.update('Upload', fetched + event.bytes))
+
+    def on_round(stats):
+        event = parser.update('Upload', stats.blocks_read * block_size)
+        if progress_callback:
+            progress_callback(event)
+        else:
+            print(f"\tRound {stats.rounds}: {stats.blocks_read} blocks read in {stats.transfers} transfers, "
+                  f"{stats.blocks_used} blocks in use found so far")
+
+    def fetch_dfu_util(first, count):
+        nonlocal fetched
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            extent_fn = os.path.join(tmp_dir, 'extent.littlefs')
+            result = run_shell_cmd(dfu_util_args(device, serial) +
+                                   ['-s', f'0x{DFU_FS_ADDRESS + first * block_size:08x}:{count * block_size}',
+                                    '-U', extent_fn],
+                                   progress_callback=on_transfer,
+                                   total_bytes=count * block_size)
+            if result or not os.path.exists(extent_fn):
+                raise DFUError(f"dfu-util upload failed with exit status {result}")
+            fetched += count * block_size
+            with open(extent_fn, 'rb') as fh:
+                return fh.read()
+
+    dfu = None
+    try:
+        if DFU_BACKEND == 'dfu-util':
+            fetch = fetch_dfu_util
+        else:
+            dfu = open_dfu(DFU_BACKEND, device.platform.vid, device.platform.pid_dfu, serial or device_serial(device),
+                           on_transfer)
+
+            def fetch(first, count):
+                nonlocal fetched
+                data = bytearray()
+                dfu.upload(DFU_FS_ADDRESS + first * block_size, count * block_size, data.extend)
+                fetched += count * block_size
+                return data
+
+        with span('fsread.smart', backend=DFU_BACKEND) as trace:
+            image, stats, loaded = read_used_blocks(fetch, block_size, device.platform.user_block_count,
+                                            gap=SMART_READ_GAP.get(DFU_BACKEND, 1), on_round=on_round)
+            trace.add(stats.blocks_read * block_size, stats.blocks_read)
+            if tracer.enabled:
+                trace.args.update(rounds=stats.rounds, transfers=stats.transfers, blocks_used=stats.blocks_used)
+    except LayoutError as e:
+        notice(f"Can't read only the used blocks ({e}), reading the whole filesystem")
+        if blocks_read is not None:
+            blocks_read.update(range(device.platform.user_block_count))
+        return readFilesystem(filename, device, serial, progress_callback)
+    except (DFUError, OSError, ValueError) as e:
+        notice(f"DFU transfer failed: {e}")
+        return 1
+    finally:
+        if dfu:
+            dfu.close()
+
+    with open(filename, 'xb') as fh:
+        fh.write(image)
+    if blocks_read is not None:
+        blocks_read.update(loaded)
+    if progress_callback:
+        progress_callback(parser.update('Upload', total, 100))
+    else:
+        print(f"\tRead {stats.blocks_read} of {device.platform.user_block_count} blocks "
+              f"({stats.blocks_used} in use) in {stats.transfers} transfers")
+    return 0
+
+def writeFilesystem(filename: str, device: ParticleDevice, chunks=None, serial=None, progress_callback=None):
+    # With `chunks`, the image is streamed to dfu-util's stdin instead of being read from `filename`
+    if chunks is None:
+        LittleFSImage.replay_flush_journal(filename)
+    if DFU_BACKEND != 'dfu-util':
+        def download(dfu):
+            if chunks is not None:
+                dfu.download(DFU_FS_ADDRESS, chunks, device.platform.fs_size_bytes())
+            else:
+                with open(filename, 'rb') as fh:
+                    dfu.download(DFU_FS_ADDRESS, iter(lambda: fh.read(COPY_BUFFER_SIZE), b''), os.path.getsize(filename))
+        return run_native_dfu(device, serial, download, progress_callback)
+
+    return run_shell_cmd(dfu_util_args(device, serial) +
+                         ['-s', f'0x{DFU_FS_ADDRESS:08x}',
+                          '-D', '-' if chunks is not None else filename],
+                         filter_str='Download',
+                         stdin_chunks=chunks,
+                         progress_callback=progress_callback,
+                         total_bytes=device.platform.fs_size_bytes() if chunks is not None else os.path.getsize(filename))
+
+def writeFilesystemExtents(filename: str, device: ParticleDevice, extents, serial=None, progress_callback=None):
+    # Each extent is downloaded from its own slice of the image, so dfu-util only erases and programs those blocks
+    LittleFSImage.replay_flush_journal(filename)
+    if DFU_BACKEND != 'dfu-util':
+        def download(dfu):
+            with open(filename, 'rb') as fh:
+                for offset, length in extents:
+                    fh.seek(offset)
+                    dfu.download(DFU_FS_ADDRESS + offset, [fh.read(length)], length)
+        return run_native_dfu(device, serial, download, progress_callback)
+
+    with open(filename, 'rb') as fh:
+        for offset, length in extents:
+            fh.seek(offset)
+            with tempfile.NamedTemporaryFile(suffix='.littlefs', delete=False) as extent_file:
+                extent_file.write(fh.read(length))
+            try:
+                result = run_shell_cmd(dfu_util_args(device, serial) +
+                                       ['-s', f'0x{DFU_FS_ADDRESS + offset:08x}:{length}',
+                                        '-D', extent_file.name],
+                                       filter_str='Download',
+                                       progress_callback=progress_callback,
+                                       total_bytes=length)
+            finally:
+                os.remove(extent_file.name)
+            if result:
+                return result
+    return 0
+
+def backup_filesystem(device: ParticleDevice, serial=None, progress_callback=None, log=None):
+    # Read the device filesystem into the backup store, returning (backup name, image, new blocks stored, blocks read).
+    # Only the blocks littlefs uses are read, so the image is the device's contents only at the blocks read
+    store = BackupStore(BACKUP_PATH)
+    backup_name = store.unique_name(f"{device.device_id}-{datetime.now().strftime('%Y.%m.%d-%H.%M.%S')}")
+    os.makedirs(BACKUP_PATH, exist_ok=True)
+    incoming_fn = os.path.join(BACKUP_PATH, f".{backup_name}.incoming")
+    blocks_read = set()
+    try:
+        result = readFilesystemSmart(incoming_fn, device, serial, progress_callback, blocks_read, log)
+        if result or not os.path.exists(incoming_fn):
+            raise IOError(f"DFU upload failed with exit status {result}")
+        with open(incoming_fn, 'rb') as fh:
+            image = fh.read()
+    finally:
+        if os.path.exists(incoming_fn):
+            os.remove(incoming_fn)
+
+    _, new_blocks = store.add(backup_name, image, device.platform.fs_block_size, device_id=device.device_id)
+    return backup_name, image, new_blocks, blocks_read
+
+def diff_extents(old, new, block_size=4096, blocks_read=None):
+    """Compare two images block by block, returning (offset, length) extents of the changed blocks in `new`
+
+    If `old` was only partly read from the device, `blocks_read` is the set of blocks that were; every other block is
+    taken as changed, since what the device holds there is unknown.
+    """
+    old = memoryview(old)
+    new = memoryview(new)
+    extents = []
+    for offset in range(0, len(new), block_size):
+        end = min(offset + block_size, len(new))
+        known = blocks_read is None or offset // block_size in blocks_read
+        if known and old[offset:end] == new[offset:end]:
+            continue
+        if extents and sum(extents[-1]) == offset:
+            extents[-1] = (extents[-1][0], end - extents[-1][0])  # Neighbouring block, grow the extent
+        else:
+            extents.append((offset, end - offset))
+    return extents
+
+def load_image(name: str):
+    """Raw bytes of an image file (memory-mapped, read-only) or of a backup in the store, by name"""
+    if os.path.isfile(name):
+        LittleFSImage.replay_flush_journal(name)
+        with open(name, 'rb') as fh:
+            return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    store = BackupStore(BACKUP_PATH)
+    if name in store.names():
+        return b''.join(store.iter_image(name))
+    raise FileNotFoundError(f"{name}: No such image file or backup")
@@ -0,0 +1,100 @@
+import posixpath
+from LazyImport import lazy_import
+
+errors = lazy_import('littlefs.errors')
+
+LFS_TYPE_DIR = 34
+
+
+def normpath(path: str):
+    return posixpath.normpath('/' + path.lstrip('/'))
+
+
+class DirIndex:
+    """Lazily built, in-memory cache of directory listings for a mounted LittleFS
+
+    Offers the scandir() and stat() calls the CLI needs, answered from memory after the first scan of each directory,
+    and usage(), the recursive size of a directory, cached per directory.
+    Anything that changes the filesystem must call invalidate() with the path it changed.
+    """
+
+    def __init__(self, fs):
+        self.fs = fs
+        self.listings = {}
+        self.usages = {}
+        self.root_stat = None
+
+    def scandir(self, path='/'):
+        path = normpath(path)
+        listing = self.listings.get(path)
+        if listing is None:
+            listing = list(self.fs.scandir(path))
+            self.listings[path] = listing
+        return listing
+
+    def stat(self, path):
+        path = normpath(path)
+        if path == '/':
+            if self.root_stat is None:
+                self.root_stat = self.fs.stat('/')
+            return self.root_stat
+
+        parent, name = posixpath.split(path)
+        if not self.stat(parent).type == LFS_TYPE_DIR:
+            raise errors.LittleFSError(code=-20)    # ERR_NOTDIR
+        for dir_item in self.scandir(parent):
+            if dir_item.name == name:
+                return dir_item
+        raise errors.LittleFSError(code=-2)    # ERR_NOENT
+
+    def usage(self, path='/'):
+        """Total size in bytes of the files in directory `path` and its subdirectories"""
+        path = normpath(path)
+        total = self.usages.get(path)
+        if total is None:
+            total = 0
+            for dir_item in self.scandir(path):
+                if dir_item.type == LFS_TYPE_DIR:
+                    total += self.usage(posixpath.join(path, dir_item.name))
+                else:
+                    total += dir_item.size
+            self.usages[path] = total
+        return total
+
+    def invalidate(self, path):
+        """Forget what is cached about `path`: its parent's listing, its own listing and subdirectories, and the
+        usage of every directory containing it. Usage of unrelated directories is kept, so it is only recomputed
+        along the changed path"""
+        path = normpath(path)
+        self.listings.pop(posixpath.dirname(path), None)
+        prefix = path.rstrip('/') + '/'
+        for cache in (self.listings, self.usages):
+            for cached in [cached for cached in cache if cached == path or cached.startswith(prefix)]:
+                del cache[cached]
+        while path != '/':
+            path = posixpath.dirname(path)
+            self.usages.pop(path, None)
+
+    def invalidate_paths(self, paths):
+        """invalidate() every path in `paths`, in one pass over the cache however many there are"""
+        paths = {normpath(path) for path in paths}
+        changed = set(paths)
+        for path in paths:
+            while path != '/':
+                path = posixpath.dirname(path)
+                changed.add(path)
+        for path in paths:
+            self.listings.pop(posixpath.dirname(path), None)
+        for cache in (self.listings, self.usages):
+            for cached in list(cache):
+                # Drop anything at or below a changed path, and the usage of any directory above one
+                parent = cached
+                while parent not in paths and parent != '/':
+                    parent = posixpath.dirname(parent)
+                if parent in paths or (cache is self.usages and cached in changed):
+                    del cache[cached]
+
+    def clear(self):
+        self.listings.clear()
+        self.usages.clear()
+        self.root_stat = None
@@ -0,0 +1,191 @@
+import io
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobBusy(Exception):
+    """A job couldn't start because `job`, still running, holds `resource`"""
+
+    def __init__(self, resource, job):
+        super().__init__(f"{resource} is busy with job [{job.id}] {job.description}")
+        self.resource = resource
+        self.job = job
+
+
+class JobOutput:
+    """sys.stdout/sys.stderr replacement that sends what a job's thread prints to that job's log (in `logs`, by
+    thread), and everything else to the original stream, so background jobs never print over the prompt"""
+
+    def __init__(self, stream, logs):
+        self.stream = stream
+        self.logs = logs
+
+    def _target(self):
+        return self.logs.get(threading.get_ident(), self.stream)
+
+    def write(self, text):
+        return self._target().write(text)
+
+    def flush(self):
+        self._target().flush()
+
+    def isatty(self):
+        return threading.get_ident() not in self.logs and self.stream.isatty()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class Job:
+    """A unit of work running on its own thread. Its progress callbacks raise JobCancelled once cancel() has been
+    called, which is how transfers are stopped part way through
+
+    With an `events` queue, every phase change and progress event is also put on it, as (phase, ProgressEvent or
+    None), followed by None once the job has finished. `resources` are what the job has to itself while it runs:
+    its device ID, if it has one, and e.g. the image files it writes.
+    """
+
+    def __init__(self, job_id, description, device_id=None, on_success=None, events=None, resources=()):
+        self.id = job_id
+        self.description = description
+        self.device_id = device_id
+        self.resources = ({device_id} if device_id else set()) | set(resources)
+        self.on_success = on_success
+        self.state = 'running'
+        self.phase = 'starting'
+        self.progress = None
+        self.result = None
+        self.error = None
+        self.log = io.StringIO()
+        self.started = time.monotonic()
+        self.finished = None
+        self.cancelled = threading.Event()
+        self.thread = None
+        self.events = events
+
+    @property
+    def done(self):
+        return self.state != 'running'
+
+    def check_cancelled(self):
+        if self.cancelled.is_set():
+            raise JobCancelled("cancelled")
+
+    def set_phase(self, phase):
+        self.check_cancelled()
+        self.phase = phase
+        self.progress = None
+        if self.events is not None:
+            self.events.put((phase, None))
+
+    def progress_callback(self, phase):
+        def callback(event):
+            self.check_cancelled()
+            self.phase = phase
+            self.progress = event
+            if self.events is not None:
+                self.events.put((phase, event))
+        return callback
+
+    def note(self, message):
+        """Add a line to the job's log"""
+        self.log.write(message + '\n')
+
+    def status(self):
+        if self.state != 'running':
+            detail = self.result if self.state == 'done' else self.error
+            return f"{self.state}{': ' + str(detail) if detail else ''}"
+        if self.progress is None:
+            return self.phase
+        return f"{self.phase} {self.progress.percent}%"
+
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+
+class JobManager:
+    """Runs work in background jobs, keeping each job until reap() has returned it once finished"""
+
+    def __init__(self):
+        self.jobs = OrderedDict()
+        self.next_id = 1
+        self.logs = None
+        self.lock = threading.RLock()
+
+    def start(self, description, work, device_id=None, on_success=None, events=None, resources=()):
+        """Run `work(job)` on a new thread. Its return value becomes the job's result; an exception fails the job.
+        If it succeeds, `on_success()` is called from reap(), on the caller's thread. See Job for `events` and
+        `resources`; raises JobBusy if a running job holds one of them"""
+        with self.lock:
+            if self.logs is None:
+                self.logs = {}
+                sys.stdout = JobOutput(sys.stdout, self.logs)
+                sys.stderr = JobOutput(sys.stderr, self.logs)
+            job = Job(self.next_id, description, device_id, on_success, events, resources)
+            for resource in sorted(job.resources):
+                holder = self.busy(resource)
+                if holder:
+                    raise JobBusy(resource, holder)
+            self.next_id += 1
+            self.jobs[job.id] = job
+
+        def run():
+            self.logs[threading.get_ident()] = job.log
+            state = 'failed'
+            try:
+                job.result = work(job)
+                state = 'done'
+            except JobCancelled:
+                state = 'cancelled'
+            except Exception as e:
+                job.error = e
+            finally:
+                del self.logs[threading.get_ident()]
+                job.finished = time.monotonic()
+                job.state = state  # Last, so a job seen as done has everything else set
+                if job.events is not None:
+                    job.events.put(None)
+
+        job.thread = threading.Thread(target=run, name=f"job-{job.id}", daemon=True)
+        job.thread.start()
+        return job
+
+    def get(self, job_id):
+        try:
+            return self.jobs[int(job_id)]
+        except (KeyError, ValueError):
+            return None
+
+    def running(self):
+        with self.lock:
+            return [job for job in self.jobs.values() if not job.done]
+
+    def busy(self, resource):
+        """The running job holding `resource`, e.g. a device ID, if any"""
+        return next((job for job in self.running() if resource in job.resources), None)
+
+    def wait(self, job, timeout=None):
+        job.thread.join(timeout)
+        return job.done
+
+    def cancel(self, job):
+        job.cancelled.set()
+
+    def discard(self, job):
+        """Remove a finished job that its caller has waited for and reports itself, rather than reap() returning it"""
+        with self.lock:
+            self.jobs.pop(job.id, None)
+
+    def reap(self):
+        """Finished jobs, removed from the job list"""
+        with self.lock:
+            finished = [job for job in self.jobs.values() if job.done]
+            for job in finished:
+                del self.jobs[job.id]
+        return finished
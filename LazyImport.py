@@ -0,0 +1,25 @@
+import importlib
+
+
+class LazyModule:
+    """Stands in for a module, importing it the first time one of its attributes is used
+
+    littlefs (and the modules built on it) and parse take most of the CLI's startup time, and many commands never
+    need them.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        return f"<lazy module '{self._name}'{' (loaded)' if self._module else ''}>"
+
+
+def lazy_import(name):
+    return LazyModule(name)
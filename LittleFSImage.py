@@ -0,0 +1,345 @@
+import hashlib
+import mmap
+import os
+import posixpath
+import shutil
+import struct
+import tempfile
+from collections import Counter
+from littlefs import LittleFS
+from littlefs.context import UserContext
+from ParticleUSB import ParticleUSB, ParticlePlatform
+from StreamIO import COPY_BUFFER_SIZE, copy_stream
+from Trace import instrument_context, span, tracer
+
+
+class MappedContext(UserContext):
+    """LittleFS block device backed by a private (copy-on-write) memory map of an image file
+
+    Blocks littlefs programs or erases are recorded in `dirty`, so flush() only has to write those blocks back.
+    `identity` is the mapped file's (inode, size, mtime), so flush() can tell if the file was replaced since.
+
+    Snapshots are journals of the blocks changed since they were taken: the first time a block is changed after a
+    snapshot, its previous contents are saved in the journal, so a snapshot costs only the blocks changed since,
+    and rolling back writes just those blocks back. Every journal missing a block shares the one saved copy.
+    """
+
+    def __init__(self, filename: str, block_size=4096):
+        # UserContext.__init__ would allocate a full in-memory buffer, which is exactly what we avoid here
+        self.filename = filename
+        self.block_size = block_size
+        self.erased_block = b'\xff' * block_size
+        self.dirty = set()
+        self.journals = []  # (name, {block: saved contents}), oldest first
+        replay_flush_journal(filename)
+        self.identity = None
+        self.buffer = self._map(filename)
+        _mapped[os.path.realpath(filename)] += 1
+
+    def _map(self, filename):
+        with open(filename, 'rb') as fh:
+            self.identity = _identity(os.fstat(fh.fileno()))
+            return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    def read(self, cfg, block, off, size):
+        start = block * cfg.block_size + off
+        return self.buffer[start:start + size]
+
+    def prog(self, cfg, block, off, data):
+        # A block in the newest journal is in every journal, as each was taken before the newest
+        if self.journals and block not in self.journals[-1][1]:
+            self._save_block(block)
+        start = block * cfg.block_size + off
+        self.dirty.add(block)
+        self.buffer[start:start + len(data)] = data
+        return 0
+
+    def erase(self, cfg, block):
+        if self.journals and block not in self.journals[-1][1]:
+            self._save_block(block)
+        start = block * cfg.block_size
+        self.dirty.add(block)
+        self.buffer[start:start + cfg.block_size] = self.erased_block
+        return 0
+
+    def sync(self, cfg):
+        return 0
+
+    def _save_block(self, block):
+        start = block * self.block_size
+        saved = self.buffer[start:start + self.block_size]
+        for _, journal in reversed(self.journals):
+            if block in journal:
+                break
+            journal[block] = saved
+
+    def snapshot(self, name):
+        """Start a journal called `name`, which rollback(name) returns the image to"""
+        self.journals.append((name, {}))
+
+    def _journal_index(self, name):
+        for i in range(len(self.journals) - 1, -1, -1):
+            if self.journals[i][0] == name:
+                return i
+        raise KeyError(name)
+
+    def journal(self, name):
+        return self.journals[self._journal_index(name)][1]
+
+    def rollback(self, name):
+        """Return the image to snapshot `name`, dropping it and every later snapshot. Returns blocks restored.
+        Whatever is mounted on the image must be remounted"""
+        i = self._journal_index(name)
+        journal = self.journals[i][1]
+        for block, saved in journal.items():
+            start = block * self.block_size
+            self.buffer[start:start + self.block_size] = saved
+            self.dirty.add(block)
+        del self.journals[i:]
+        return len(journal)
+
+    def drop_snapshot(self, name):
+        del self.journals[self._journal_index(name)]
+
+    def journal_bytes(self):
+        """Memory used by snapshots, counting each saved block once however many journals share it"""
+        saved = {id(data): len(data) for _, journal in self.journals for data in journal.values()}
+        return sum(saved.values())
+
+    def is_dirty(self):
+        return bool(self.dirty)
+
+    def flush(self, filename=None):
+        """Write changes to `filename` (default: the mapped image). Returns bytes written
+
+        Flushing to the mapped image writes only the dirty blocks, in place: they are first saved in a flush journal
+        beside the image, which replay_flush_journal() applies if the writes were interrupted. If the image file was
+        replaced since it was mapped, patching it would mix two images, so it is replaced with the full image
+        instead, as is any other destination, and so is an image also mapped by another mount, whose unchanged
+        blocks would otherwise change under it.
+        """
+        if filename and os.path.abspath(filename) != os.path.abspath(self.filename):
+            with span('flush', file=filename) as trace:
+                _replace_file(filename, lambda fh: fh.write(self.buffer))
+                trace.add(len(self.buffer), len(self.buffer) // self.block_size)
+            return len(self.buffer)
+
+        if not self.dirty:
+            return 0
+
+        if file_identity(self.filename) != self.identity or _mapped[os.path.realpath(self.filename)] > 1:
+            with span('flush', file=self.filename) as trace:
+                _replace_file(self.filename, lambda fh: fh.write(self.buffer))
+                trace.add(len(self.buffer), len(self.buffer) // self.block_size)
+            written = len(self.buffer)
+        else:
+            dirty = sorted(self.dirty)
+            with span('flush', file=self.filename) as trace:
+                _write_blocks(self.filename, [(block, self.buffer[block * self.block_size:(block + 1) * self.block_size])
+                                              for block in dirty], self.block_size)
+                trace.add(len(dirty) * self.block_size, len(dirty))
+            written = len(dirty) * self.block_size
+
+        # Re-map the file so the private copies of the dirty pages are released
+        self.buffer.close()
+        self.buffer = self._map(self.filename)
+        self.dirty.clear()
+        return written
+
+    def close(self):
+        if not self.buffer.closed:
+            self.buffer.close()
+            _mapped[os.path.realpath(self.filename)] -= 1
+
+
+_mapped = Counter()  # MappedContexts open, by image file
+
+
+def _identity(st):
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def file_identity(filename: str):
+    """(inode, size, mtime) of a file, which change whenever it is rewritten or replaced, or None if it is missing"""
+    try:
+        return _identity(os.stat(filename))
+    except FileNotFoundError:
+        return None
+
+
+# Flush journal: header (magic, block size, block count), then each block's number and contents, then the SHA-256 of
+# everything before it, so a journal cut short by a crash is recognised and ignored
+JOURNAL_MAGIC = b'LFSJRNL1'
+JOURNAL_HEADER = struct.Struct('<8sII')
+JOURNAL_BLOCK = struct.Struct('<I')
+
+
+def _journal_path(filename):
+    return os.path.join(os.path.dirname(os.path.abspath(filename)), f".{os.path.basename(filename)}.journal")
+
+
+def _write_blocks(filename, blocks, block_size):
+    # Save the blocks in the journal, durably, before patching them into the image, then drop the journal
+    journal = hashlib.sha256()
+
+    def write_journal(fh):
+        for data in [JOURNAL_HEADER.pack(JOURNAL_MAGIC, block_size, len(blocks))] + \
+                    [part for block, contents in blocks for part in (JOURNAL_BLOCK.pack(block), contents)]:
+            journal.update(data)
+            fh.write(data)
+        fh.write(journal.digest())
+
+    journal_fn = _journal_path(filename)
+    _replace_file(journal_fn, write_journal)
+    _patch_blocks(filename, blocks, block_size)
+    _remove_journal(journal_fn)
+
+
+def _patch_blocks(filename, blocks, block_size):
+    with open(filename, 'r+b') as fh:
+        for block, contents in blocks:
+            fh.seek(block * block_size)
+            fh.write(contents)
+        fh.flush()
+        os.fsync(fh.fileno())
+
+
+def _remove_journal(journal_fn):
+    # A reader replaying the journal meanwhile only writes the same blocks again, and may remove it first
+    try:
+        os.remove(journal_fn)
+    except FileNotFoundError:
+        pass
+
+
+def replay_flush_journal(filename: str):
+    """Finish a flush of `filename` that was interrupted, from its journal. Returns blocks written
+
+    Everything that reads an image file's raw bytes calls this first, so none of them sees a half-flushed image.
+    """
+    journal_fn = _journal_path(filename)
+    try:
+        with open(journal_fn, 'rb') as fh:
+            data = fh.read()
+    except FileNotFoundError:
+        return 0
+
+    blocks = []
+    if len(data) >= JOURNAL_HEADER.size + 32 and hashlib.sha256(data[:-32]).digest() == data[-32:]:
+        magic, block_size, count = JOURNAL_HEADER.unpack_from(data)
+        offset = JOURNAL_HEADER.size
+        if magic == JOURNAL_MAGIC and len(data) - 32 - offset == count * (JOURNAL_BLOCK.size + block_size):
+            for _ in range(count):
+                block, = JOURNAL_BLOCK.unpack_from(data, offset)
+                offset += JOURNAL_BLOCK.size
+                blocks.append((block, data[offset:offset + block_size]))
+                offset += block_size
+    if blocks:
+        _patch_blocks(filename, blocks, block_size)
+    _remove_journal(journal_fn)  # Without blocks, it was cut short before the image was touched
+    return len(blocks)
+
+
+def _replace_file(filename, write):
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_filename = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(filename), suffix='.tmp')
+    try:
+        os.close(fd)
+        if os.path.exists(filename):
+            shutil.copymode(filename, tmp_filename)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_filename, 0o666 & ~umask)
+        with open(tmp_filename, 'r+b') as fh:
+            write(fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+
+    if hasattr(os, 'O_DIRECTORY'):
+        dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+def image_block_count(filename: str, block_size=4096):
+    fs_file_size = os.path.getsize(filename)
+    known_sizes = sorted({platform.fs_size_bytes() for platform in ParticleUSB.known_platforms.values() if platform.user_block_count})
+    if fs_file_size not in known_sizes:
+        raise ValueError(f"file \"{filename}\" wrong size (expected {', '.join(str(size) for size in known_sizes)})")
+    return fs_file_size // block_size
+
+
+def open_image(filename: str, block_size=4096):
+    """Mount an image file, raising FileNotFoundError, ValueError or LittleFSError if it can't be mounted"""
+    if not os.path.exists(filename):
+        raise FileNotFoundError(f"file \"{filename}\" does not exist")
+    block_count = image_block_count(filename, block_size)
+    with span('mount', file=filename) as trace:
+        context = MappedContext(filename, block_size)
+        if tracer.enabled:
+            instrument_context(context)
+        _fs = LittleFS(context=context, block_size=block_size, block_count=block_count, mount=False)
+        try:
+            _fs.mount()
+        except BaseException:
+            context.close()
+            raise
+        trace.add(len(context.buffer), block_count)
+    return _fs
+
+
+def remount(fs):
+    """Mount the image behind `fs` afresh, for when its blocks were changed under littlefs (e.g. by a rollback)"""
+    context = fs.context
+    _fs = LittleFS(context=context, block_size=context.block_size, block_count=len(context.buffer) // context.block_size,
+                   mount=False)
+    _fs.mount()
+    return _fs
+
+
+def size_description(size: int):
+    """What an image of `size` bytes is for, e.g. '2MB (Argon/Boron/BSoM)', or None if no platform uses that size"""
+    if size == ParticleUSB.known_platforms['Argon'].fs_size_bytes():
+        return '2MB (Argon/Boron/BSoM)'
+    if size == ParticleUSB.known_platforms['Asset Tracker'].fs_size_bytes():
+        return '4MB (Tracker)'
+    return None
+
+
+def build_image(src_dir: str, out_filename: str, platform: ParticlePlatform):
+    """Format a fresh LittleFS with the platform's geometry and pack a host directory tree into it
+
+    Directories and files are added in sorted order, so the same input always produces a byte-for-byte identical
+    image. Returns (directories, files, bytes) packed.
+    """
+    context = UserContext(platform.fs_size_bytes())
+    _fs = LittleFS(context=context, block_size=platform.fs_block_size, block_count=platform.user_block_count, mount=False)
+    _fs.format()
+    _fs.mount()
+
+    buffer = bytearray(COPY_BUFFER_SIZE)
+    directories = files = packed = 0
+    for root, dirs, filenames in os.walk(src_dir):
+        dirs.sort()
+        rel = os.path.relpath(root, src_dir)
+        fs_root = '/' if rel == '.' else '/' + '/'.join(rel.split(os.sep))
+        for name in dirs:
+            _fs.mkdir(posixpath.join(fs_root, name))
+            directories += 1
+        for name in sorted(filenames):
+            local_path = os.path.join(root, name)
+            if not os.path.isfile(local_path):
+                continue
+            with open(local_path, 'rb') as from_file, _fs.open(posixpath.join(fs_root, name), 'wb') as to_file:
+                packed += copy_stream(from_file, to_file, buffer)
+            files += 1
+
+    _replace_file(out_filename, lambda fh: fh.write(context.buffer))
+    return directories, files, packed
@@ -0,0 +1,380 @@
+import os
+import posixpath
+import struct
+import zlib
+from collections import namedtuple
+
+# littlefs v1 (DeviceOS uses 1.7.2) on-disk format, see SPEC.md in the littlefs repository
+LFS_TYPE_REG = 0x11
+LFS_TYPE_DIR = 0x22
+LFS_TYPE_SUPERBLOCK = 0x2e
+LFS_STRUCT_MOVED = 0x80
+LFS_BLOCK_NULL = 0xffffffff
+LFS_DIR_HEADER = struct.Struct('<IIII')    # revision, size (top bit: continued in tail), tail pair
+LFS_ENTRY_HEADER = struct.Struct('<BBBB')  # type, entry length, attribute length, name length
+LFS_DIR_CRC_SIZE = 4
+
+LayoutEntry = namedtuple('LayoutEntry', 'type name size head pair')
+
+
+class LayoutError(ValueError):
+    pass
+
+
+def _scmp(a, b):
+    # Sequence comparison of 32-bit revision counts, which may wrap
+    return ((a - b + 0x80000000) & 0xffffffff) - 0x80000000
+
+
+def _ctz(i):
+    return (i & -i).bit_length() - 1
+
+
+def ctz_index(off, block_size):
+    """Index of the CTZ skip-list block holding byte `off` of a file"""
+    b = block_size - 2 * 4
+    i = off // b
+    if i == 0:
+        return 0
+    return (off - 4 * (bin(i - 1).count('1') + 2)) // b
+
+
+class ImageLayout:
+    """Read-only parser for the littlefs v1 structures in a raw image (bytes, bytearray or mmap)
+
+    Works on the image bytes directly, without mounting, so metadata can be walked and a file's blocks listed
+    without going through the littlefs block device callbacks.
+
+    littlefs-python only creates and mounts littlefs v2 images, so the parser was validated against v1 images
+    written to SPEC.md (littlefs v1.7.2) by a separate writer. Those images had nested and continued directories,
+    a stale copy in each metadata pair, files of 0 bytes up to many skip-list blocks, and an entry left mid-move.
+    walk(), read_file() and allocation() matched the trees and blocks the images were built from, and
+    read_used_blocks() matched the full images. A v2 image is reported as such, not as corrupted.
+    """
+
+    def __init__(self, image, block_size=4096):
+        self.image = memoryview(image)
+        self.block_size = block_size
+        self.block_count = len(image) // block_size
+        self._dirs = {}
+
+    def block(self, block):
+        if not 0 <= block < self.block_count:
+            raise LayoutError(f"block {block} out of range")
+        start = block * self.block_size
+        return self.image[start:start + self.block_size]
+
+    def _fetch_block(self, block):
+        data = self.block(block)
+        rev, size, tail0, tail1 = LFS_DIR_HEADER.unpack_from(data)
+        length = size & 0x7fffffff
+        if not LFS_DIR_HEADER.size + LFS_DIR_CRC_SIZE <= length <= self.block_size:
+            return None
+        if zlib.crc32(data[:length]) != 0xffffffff:   # CRC over the block, including the stored CRC, is the residue
+            return None
+        return rev, bool(size & 0x80000000), (tail0, tail1), data[LFS_DIR_HEADER.size:length - LFS_DIR_CRC_SIZE]
+
+    def fetch_dir(self, pair):
+        """(continued, tail, entry bytes) from the newest valid block of a metadata pair"""
+        newest = None
+        for block in pair:
+            fetched = self._fetch_block(block)
+            if fetched and (newest is None or _scmp(fetched[0], newest[0]) > 0):
+                newest = fetched
+        if newest is None:
+            if tuple(pair) == (0, 1) and any(bytes(self.block(block)[8:16]) == b'littlefs' for block in pair):
+                # littlefs v2 keeps the magic right after the revision count and the first tag
+                raise LayoutError("littlefs v2 image, only the littlefs v1 format DeviceOS uses can be walked")
+            raise LayoutError(f"corrupted metadata pair {{{pair[0]}, {pair[1]}}}")
+        return newest[1:]
+
+    def superblock(self):
+        """(root pair, block_size, block_count, version) from the superblock in blocks {0, 1}"""
+        _, _, entries = self.fetch_dir((0, 1))
+        entry_type, elen, _, nlen = LFS_ENTRY_HEADER.unpack_from(entries)
+        if entry_type != LFS_TYPE_SUPERBLOCK or bytes(entries[4 + elen:4 + elen + nlen]) != b'littlefs':
+            raise LayoutError("no littlefs superblock")
+        root0, root1, block_size, block_count, version = struct.unpack_from('<IIIII', entries, 4)
+        return (root0, root1), block_size, block_count, version
+
+    def dir_entries(self, pair):
+        """Files and directories in the directory at `pair`, following continuations. Cached per pair"""
+        pair = tuple(pair)
+        cached = self._dirs.get(pair)
+        if cached is not None:
+            return cached
+
+        listing = []
+        current = pair
+        while True:
+            continued, tail, entries = self.fetch_dir(current)
+            listing.extend(self._parse_entries(entries, current))
+            if not continued:
+                break
+            current = tail
+
+        self._dirs[pair] = listing
+        return listing
+
+    @staticmethod
+    def _parse_entries(entries, pair):
+        off = 0
+        while off + LFS_ENTRY_HEADER.size <= len(entries):
+            entry_type, elen, alen, nlen = LFS_ENTRY_HEADER.unpack_from(entries, off)
+            data = off + LFS_ENTRY_HEADER.size
+            if data + elen + alen + nlen > len(entries) or (entry_type in (LFS_TYPE_REG, LFS_TYPE_DIR) and elen < 8):
+                raise LayoutError(f"corrupted entry in metadata pair {{{pair[0]}, {pair[1]}}}")
+            name = bytes(entries[data + elen + alen:data + elen + alen + nlen]).decode('utf-8', errors='replace')
+            # Entries flagged as mid-move also exist in their new directory, so only the destination is listed
+            if entry_type == LFS_TYPE_REG:
+                head, size = struct.unpack_from('<II', entries, data)
+                yield LayoutEntry(entry_type, name, size, head, None)
+            elif entry_type == LFS_TYPE_DIR:
+                yield LayoutEntry(entry_type, name, 0, None, struct.unpack_from('<II', entries, data))
+            off = data + elen + alen + nlen
+
+    def pair_entries(self, pair):
+        """Files and directories in a single metadata pair, without following continuations"""
+        return list(self._parse_entries(self.fetch_dir(pair)[2], pair))
+
+    def ctz_pointers(self, block, index):
+        """Skip-list pointers stored in the block at `index` of a file: pointer j is the block at index - 2**j"""
+        count = _ctz(index) + 1 if index else 0
+        pointers = struct.unpack_from(f'<{count}I', self.block(block))
+        for pointer in pointers:
+            if pointer >= self.block_count:
+                raise LayoutError(f"block {block} points outside the filesystem")
+        return pointers
+
+    def walk(self, path='/', pair=None):
+        """Yield (path, LayoutEntry) for everything under `path`, depth first in on-disk order"""
+        if pair is None:
+            pair = self.superblock()[0]
+        for entry in self.dir_entries(pair):
+            entry_path = posixpath.join(path, entry.name)
+            yield entry_path, entry
+            if entry.type == LFS_TYPE_DIR:
+                yield from self.walk(entry_path, entry.pair)
+
+    def ctz_blocks(self, head, size):
+        """Blocks of a file's CTZ skip-list in file order"""
+        if size == 0:
+            return []
+        index = ctz_index(size - 1, self.block_size)
+        blocks = [head]
+        while index > 0:
+            # Pointer 0 of block n is always block n - 1
+            head = struct.unpack_from('<I', self.block(head))[0]
+            blocks.append(head)
+            index -= 1
+        blocks.reverse()
+        return blocks
+
+    def read_file(self, head, size):
+        """Yield memoryviews of a file's data, one per block"""
+        remaining = size
+        for index, block in enumerate(self.ctz_blocks(head, size)):
+            skip = 0 if index == 0 else 4 * (_ctz(index) + 1)
+            length = min(remaining, self.block_size - skip)
+            yield self.block(block)[skip:skip + length]
+            remaining -= length
+
+    def metadata_blocks(self):
+        """Blocks of every metadata pair, found by following the tail list from the superblock"""
+        blocks = set()
+        pair = (0, 1)
+        while LFS_BLOCK_NULL not in pair:
+            if set(pair) <= blocks:
+                raise LayoutError("metadata tail list loops")
+            blocks.update(pair)
+            pair = self.fetch_dir(pair)[1]
+        return blocks
+
+    def allocation(self):
+        """(metadata blocks, file data blocks) in use, the same blocks littlefs's own traverse visits"""
+        metadata = self.metadata_blocks()
+        data = set()
+        for _, entry in self.walk():
+            if entry.type == LFS_TYPE_REG:
+                data.update(self.ctz_blocks(entry.head, entry.size))
+        return metadata, data
+
+
+SparseReadStats = namedtuple('SparseReadStats', 'rounds transfers blocks_read blocks_used')
+
+
+def _extents(blocks, gap):
+    # Coalesce sorted block numbers into (first, count) runs, bridging holes of up to `gap` blocks
+    extents = []
+    for block in blocks:
+        if extents and block - (extents[-1][0] + extents[-1][1]) <= gap:
+            extents[-1] = (extents[-1][0], block - extents[-1][0] + 1)
+        else:
+            extents.append((block, 1))
+    return extents
+
+
+def read_used_blocks(fetch, block_size, block_count, gap=0, read_ahead=True, on_round=None):
+    """Build an image holding only the blocks a littlefs v1 filesystem uses, every other block left erased (0xFF)
+
+    `fetch(first, count)` returns the contents of `count` blocks from `first`. Blocks are fetched in breadth-first
+    rounds: the superblock, then every metadata pair and file block discovered in the previous round, so the number
+    of rounds grows with directory depth and the log of file length. Files are usually allocated contiguously, so
+    with `read_ahead` the blocks of a file between its first and last are fetched as soon as its size is known.
+    Holes of up to `gap` unneeded blocks are read through to save transfers. Raises LayoutError if the filesystem
+    can't be walked. Returns (image, SparseReadStats, blocks read), the last a set of block numbers, so callers can
+    tell an erased block from one that wasn't read; on_round(stats) is called after every round.
+    """
+    image = bytearray(b'\xff' * (block_size * block_count))
+    layout = ImageLayout(image, block_size)
+    loaded = set()
+    wanted = {0, 1}
+    speculative = set()
+    pending_pairs = [(0, 1)]
+    seen_pairs = {(0, 1)}
+    files = {}          # (head, size) -> {skip-list index: block}
+    expanded = set()    # (head, size, index) whose pointers have been read
+    rounds = transfers = 0
+
+    def want_pair(pair):
+        pair = tuple(pair)
+        if LFS_BLOCK_NULL not in pair and pair not in seen_pairs:
+            if max(pair) >= block_count:
+                raise LayoutError(f"metadata pair {{{pair[0]}, {pair[1]}}} outside the filesystem")
+            seen_pairs.add(pair)
+            pending_pairs.append(pair)
+            wanted.update(pair)
+
+    while wanted - loaded:
+        rounds += 1
+        for first, count in _extents(sorted((wanted | speculative) - loaded), gap):
+            data = fetch(first, count)
+            if len(data) != count * block_size:
+                raise IOError(f"short read of blocks {first}-{first + count - 1}")
+            image[first * block_size:(first + count) * block_size] = data
+            loaded.update(range(first, first + count))
+            transfers += 1
+        speculative.clear()
+
+        for pair in [pair for pair in pending_pairs if set(pair) <= loaded]:
+            pending_pairs.remove(pair)
+            if pair == (0, 1):
+                want_pair(layout.superblock()[0])
+            want_pair(layout.fetch_dir(pair)[1])
+            for entry in layout.pair_entries(pair):
+                if entry.type == LFS_TYPE_DIR:
+                    want_pair(entry.pair)
+                elif entry.size:
+                    if entry.head >= block_count:
+                        raise LayoutError(f"file \"{entry.name}\" starts outside the filesystem")
+                    files.setdefault((entry.head, entry.size), {ctz_index(entry.size - 1, block_size): entry.head})
+
+        for (head, size), known in files.items():
+            last = ctz_index(size - 1, block_size)
+            progress = True
+            while progress:
+                progress = False
+                for index, block in list(known.items()):
+                    if block in loaded and (head, size, index) not in expanded:
+                        expanded.add((head, size, index))
+                        for j, pointer in enumerate(layout.ctz_pointers(block, index)):
+                            known.setdefault(index - (1 << j), pointer)
+                        progress = True
+            wanted.update(known.values())
+            if read_ahead and len(known) <= last:
+                speculative.update(guess for guess in range(max(0, head - last), head) if guess not in loaded)
+
+        if on_round:
+            on_round(SparseReadStats(rounds, transfers, len(loaded), len(wanted)))
+
+    return image, SparseReadStats(rounds, transfers, len(loaded), len(wanted)), loaded
+
+
+def ctz_block_count(size, block_size=4096):
+    """Number of blocks a file of `size` bytes takes up"""
+    return ctz_index(size - 1, block_size) + 1 if size else 0
+
+
+def estimate_blocks(local_path, block_size=4096):
+    """(files, directories, blocks) needed to add a host file or directory tree as new files
+
+    Each directory is counted as one metadata pair; very large directories may need more.
+    """
+    if os.path.isfile(local_path):
+        return 1, 0, ctz_block_count(os.path.getsize(local_path), block_size)
+    files = directories = blocks = 0
+    for root, dirs, filenames in os.walk(local_path):
+        directories += len(dirs)
+        blocks += 2 * len(dirs)
+        for name in filenames:
+            local_file = os.path.join(root, name)
+            if os.path.isfile(local_file):
+                files += 1
+                blocks += ctz_block_count(os.path.getsize(local_file), block_size)
+    return files, directories, blocks
+
+
+def changed_blocks(image_a, image_b, block_size=4096):
+    """Indices of the blocks that differ between two raw images of the same size"""
+    a, b = memoryview(image_a), memoryview(image_b)
+    if len(a) != len(b):
+        raise LayoutError("images differ in size")
+    if a == b:
+        return set()
+    return {block for block, start in enumerate(range(0, len(a), block_size))
+            if a[start:start + block_size] != b[start:start + block_size]}
+
+
+def _same_contents(layout_a, entry_a, layout_b, entry_b):
+    chunks_b = layout_b.read_file(entry_b.head, entry_b.size)
+    pending = memoryview(b'')
+    for chunk in layout_a.read_file(entry_a.head, entry_a.size):
+        while len(chunk):
+            if not len(pending):
+                pending = next(chunks_b)
+            length = min(len(chunk), len(pending))
+            if chunk[:length] != pending[:length]:
+                return False
+            chunk, pending = chunk[length:], pending[length:]
+    return True
+
+
+def diff_images(image_a, image_b, block_size=4096):
+    """Compare the files in two raw images. Returns ([(status, path, size_a, size_b)], changed block count)
+
+    Status is 'A'dded, 'D'eleted or 'M'odified; directories are reported with a trailing '/'. Blocks that are
+    byte-identical in both images are dismissed up front: a file whose blocks are the same, none of which changed,
+    is unchanged without reading it. Only the remaining files of equal size have their data compared.
+    """
+    changed = changed_blocks(image_a, image_b, block_size)
+    if not changed:
+        return [], 0
+
+    layout_a, layout_b = ImageLayout(image_a, block_size), ImageLayout(image_b, block_size)
+    entries_a, entries_b = dict(layout_a.walk()), dict(layout_b.walk())
+
+    differences = []
+    for path in sorted(set(entries_a) | set(entries_b)):
+        entry_a, entry_b = entries_a.get(path), entries_b.get(path)
+        if entry_a and entry_b and entry_a.type != entry_b.type:
+            differences.append(_difference('D', path, entry_a))
+            differences.append(_difference('A', path, entry_b))
+        elif not entry_b:
+            differences.append(_difference('D', path, entry_a))
+        elif not entry_a:
+            differences.append(_difference('A', path, entry_b))
+        elif entry_a.type == LFS_TYPE_REG:
+            if entry_a.size == entry_b.size:
+                blocks = layout_a.ctz_blocks(entry_a.head, entry_a.size)
+                if entry_a.head == entry_b.head and changed.isdisjoint(blocks):
+                    continue
+                if _same_contents(layout_a, entry_a, layout_b, entry_b):
+                    continue
+            differences.append(('M', path, entry_a.size, entry_b.size))
+    return differences, len(changed)
+
+
+def _difference(status, path, entry):
+    if entry.type == LFS_TYPE_DIR:
+        return status, path + '/', None, None
+    return (status, path) + ((entry.size, None) if status == 'D' else (None, entry.size))
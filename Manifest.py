@@ -0,0 +1,123 @@
+import hashlib
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+from DirIndex import DirIndex, LFS_TYPE_DIR, normpath
+from StreamIO import COPY_BUFFER_SIZE, iter_chunks
+from TreeWalk import walk
+from LazyImport import lazy_import
+
+errors = lazy_import('littlefs.errors')
+LittleFSImage = lazy_import('LittleFSImage')
+
+MANIFEST_VERSION = 1
+
+
+def _sha256(fs, path, buffer):
+    digest = hashlib.sha256()
+    with fs.open(path, 'rb') as fh:
+        for chunk in iter_chunks(fh, buffer):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def build_manifest(fs):
+    """Size and SHA-256 of every file in a mounted filesystem, reading each file once
+
+    {
+        "version": 1,
+        "files": {"/cfg/config.json": {"size": 112, "sha256": "<sha256 hex digest>"}}
+    }
+    """
+    buffer = bytearray(COPY_BUFFER_SIZE)
+    files = {}
+    for path, dir_item in walk(DirIndex(fs)):
+        if dir_item.type != LFS_TYPE_DIR:
+            files[path] = {'size': dir_item.size, 'sha256': _sha256(fs, path, buffer)}
+    return {'version': MANIFEST_VERSION, 'files': dict(sorted(files.items()))}
+
+
+def write_manifest(manifest, filename):
+    with open(filename, 'w') as fh:
+        json.dump(manifest, fh, indent=4)
+        fh.write('\n')
+
+
+def load_manifest(filename):
+    """Load and validate a manifest written by write_manifest()"""
+    with open(filename, 'r') as fh:
+        manifest = json.load(fh)
+    if not isinstance(manifest, dict) or manifest.get('version') != MANIFEST_VERSION:
+        raise ValueError(f"not a version {MANIFEST_VERSION} manifest")
+    files = {}
+    for path, entry in manifest.get('files', {}).items():
+        if not isinstance(entry.get('size'), int) or not isinstance(entry.get('sha256'), str):
+            raise ValueError(f"{path}: expected a size and a sha256")
+        files[normpath(path)] = {'size': entry['size'], 'sha256': entry['sha256'].lower()}
+    return {'version': MANIFEST_VERSION, 'files': files}
+
+
+def verify_fs(fs, manifest):
+    """Compare a mounted filesystem with a manifest. Returns (missing, extra, mismatched): the paths in the manifest
+    but not the filesystem, the files in the filesystem but not the manifest, and (path, reason) pairs for files
+    whose contents differ. Files whose size already differs aren't read at all"""
+    buffer = bytearray(COPY_BUFFER_SIZE)
+    expected = manifest['files']
+    seen = set()
+    extra = []
+    mismatched = []
+    for path, dir_item in walk(DirIndex(fs)):
+        entry = expected.get(path)
+        if entry is None:
+            if dir_item.type != LFS_TYPE_DIR:
+                extra.append(path)
+            continue
+        seen.add(path)
+        if dir_item.type == LFS_TYPE_DIR:
+            mismatched.append((path, "is a directory"))
+        elif dir_item.size != entry['size']:
+            mismatched.append((path, f"size {dir_item.size} does not match {entry['size']}"))
+        elif _sha256(fs, path, buffer) != entry['sha256']:
+            mismatched.append((path, "sha256 does not match"))
+    missing = [path for path in expected if path not in seen]
+    return missing, extra, mismatched
+
+
+def manifest_image(image: str):
+    """Mount `image` and build its manifest. Raises OSError, ValueError or LittleFSError"""
+    fs = LittleFSImage.open_image(image)
+    try:
+        return build_manifest(fs)
+    finally:
+        fs.context.close()
+
+
+def verify_image(image: str, manifest):
+    """Worker entry point: mount `image` and verify it against `manifest`. Never raises, returns a result dict"""
+    start = time.monotonic()
+    result = {'image': image, 'ok': False, 'error': '', 'missing': [], 'extra': [], 'mismatched': [], 'files': 0}
+    fs = None
+    try:
+        fs = LittleFSImage.open_image(image)
+        result['missing'], result['extra'], result['mismatched'] = verify_fs(fs, manifest)
+        result['files'] = len(manifest['files'])
+        result['ok'] = not (result['missing'] or result['extra'] or result['mismatched'])
+    except (errors.LittleFSError, OSError, ValueError) as e:
+        result['error'] = str(e)
+    finally:
+        if fs:
+            fs.context.close()
+        result['seconds'] = time.monotonic() - start
+    return result
+
+
+def verify_images(images, manifest, jobs=None):
+    """Verify many images in parallel worker processes, yielding result dicts in image order. A single image (or
+    jobs=1) is verified in this process, which is faster than starting a worker"""
+    if len(images) == 1 or jobs == 1:
+        for image in images:
+            yield verify_image(image, manifest)
+        return
+    LittleFSImage.open_image  # Import littlefs before the workers are forked, rather than in each of them
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        yield from pool.map(verify_image, images, [manifest] * len(images))
@@ -0,0 +1,239 @@
+import os
+from collections import OrderedDict
+from DirIndex import DirIndex
+from LazyImport import lazy_import
+
+errors = lazy_import('littlefs.errors')
+LittleFSImage = lazy_import('LittleFSImage')
+
+DEFAULT_MEMORY_BUDGET = 64 * 1024 * 1024
+UNDO_DEPTH = 32  # Commands that can be undone, per mount
+
+
+class MountError(IOError):
+    pass
+
+
+class Mount:
+    """A named image in the mount table
+
+    `fs` is None while the mount is evicted. The directory index and working directory are kept across evictions:
+    the image file holds what the evicted buffer did, so the cached listings stay valid, unless the file was
+    rewritten or replaced meanwhile (e.g. by fsread), in which case the index is cleared on reload. Snapshots and
+    undo history live in the image buffer's journals (see MappedContext), so they are lost on eviction.
+    """
+
+    def __init__(self, name, filename, fs):
+        self.name = name
+        self.filename = filename
+        self.fs = fs
+        self.index = DirIndex(fs)
+        self.cur_dir = '/'
+        self.block_size = fs.context.block_size
+        self.size = len(fs.context.buffer)
+        self.undo = []  # Journals of the commands that changed the image, oldest first
+        self.step = None  # Journal of the command running now
+        self.identity = None  # The image file's identity when evicted, see MappedContext
+
+    @property
+    def loaded(self):
+        return self.fs is not None
+
+    def is_dirty(self):
+        return self.loaded and self.fs.context.is_dirty()
+
+    def memory(self):
+        """Bytes held in memory: the image buffer and its snapshot journals"""
+        return self.size + self.fs.context.journal_bytes() if self.loaded else 0
+
+    def snapshots(self):
+        """(name, journal) of each named snapshot, oldest first"""
+        return [(name, journal) for name, journal in self.fs.context.journals if isinstance(name, str)] if self.loaded else []
+
+    def begin_step(self, name):
+        self.step = name
+        if self.loaded:
+            self.fs.context.snapshot(name)
+
+    def end_step(self):
+        """Keep the current command's journal for undo if the command changed the image, otherwise drop it"""
+        name, self.step = self.step, None
+        if not self.loaded or name is None:
+            return
+        context = self.fs.context
+        try:
+            journal = context.journal(name)
+        except KeyError:
+            return  # Rolled back over by the command itself
+        if not journal:
+            context.drop_snapshot(name)
+            return
+        self.undo.append(name)
+        while len(self.undo) > UNDO_DEPTH:
+            context.drop_snapshot(self.undo.pop(0))
+
+    def rollback(self, name, keep=False):
+        """Return the image to the journal `name`, remounting it. Later journals are dropped, and so is `name`
+        itself unless `keep`. Returns the number of blocks restored"""
+        context = self.fs.context
+        blocks = context.rollback(name)
+        if keep:
+            context.snapshot(name)
+        names = {journal_name for journal_name, _ in context.journals}
+        self.undo = [step for step in self.undo if step in names]
+        self.fs = LittleFSImage.remount(self.fs)
+        self.index.fs = self.fs
+        self.index.clear()
+        return blocks
+
+    def load(self):
+        if self.fs is None:
+            try:
+                self.fs = LittleFSImage.open_image(self.filename, self.block_size)
+            except (OSError, ValueError, errors.LittleFSError) as e:
+                raise MountError(f"Failed to reload \"{self.name}\" from \"{self.filename}\": {e}") from e
+            self.index.fs = self.fs
+            if self.fs.context.identity != self.identity:
+                self.index.clear()
+            if self.step:
+                self.fs.context.snapshot(self.step)
+
+    def evict(self):
+        """Release the image buffer, writing any changes back to the image file first. Returns bytes written"""
+        written = 0
+        if self.fs:
+            written = self.fs.context.flush()
+            self.identity = self.fs.context.identity
+            self.close()
+        return written
+
+    def close(self):
+        """Release the image buffer, discarding any changes"""
+        if self.fs:
+            self.fs.context.close()
+            self.fs = None
+            self.undo = []
+
+
+class MountTable:
+    """Named mounts, keeping at most `budget` bytes of image buffers loaded
+
+    Every mount returned by get() is pinned until release(), so the images one command works on are never evicted
+    under it. Beyond that, the least recently used mounts are evicted (flushing them if dirty) and reloaded on their
+    next get().
+    """
+
+    def __init__(self, budget=DEFAULT_MEMORY_BUDGET, on_evict=None):
+        self.budget = budget
+        self.on_evict = on_evict
+        self.mounts = OrderedDict()  # least recently used first
+        self.active = None
+        self.pinned = set()
+        self.evictions = 0
+        self.steps = 0
+
+    def __contains__(self, name):
+        return name in self.mounts
+
+    def __iter__(self):
+        return iter(self.mounts.values())
+
+    def __len__(self):
+        return len(self.mounts)
+
+    def add(self, name, filename, fs):
+        """Add a mount for an opened filesystem, replacing (without flushing) any mount of the same name, and make
+        it the active mount"""
+        if name in self.mounts:
+            self.mounts.pop(name).close()
+        mount = Mount(name, filename, fs)
+        self.mounts[name] = mount
+        self.active = name
+        self.pinned.add(name)
+        self.enforce_budget()
+        return mount
+
+    def remove(self, name):
+        mount = self.mounts.pop(name)
+        self.pinned.discard(name)
+        if self.active == name:
+            self.active = next(reversed(self.mounts), None)
+        return mount
+
+    def get(self, name=None):
+        """The mount called `name` (default: the active mount), loaded and pinned, or None if there is none"""
+        mount = self.mounts.get(self.active if name is None else name)
+        if mount is None:
+            return None
+        self.mounts.move_to_end(mount.name)
+        self.pinned.add(mount.name)
+        if not mount.loaded:
+            mount.load()
+            self.enforce_budget()
+        return mount
+
+    def split(self, path):
+        """Split a mount-qualified path ('g:/cfg/a.json') into ('g', '/cfg/a.json'). Paths without the prefix of a
+        known mount are returned as (None, path)"""
+        name, sep, rest = path.partition(':')
+        if sep and name in self.mounts:
+            return name, rest
+        return None, path
+
+    def loaded_bytes(self):
+        return sum(mount.memory() for mount in self.mounts.values())
+
+    def enforce_budget(self):
+        loaded = self.loaded_bytes()
+        for mount in list(self.mounts.values()):
+            if loaded <= self.budget:
+                break
+            if mount.loaded and mount.name not in self.pinned:
+                memory, snapshots = mount.memory(), len(mount.snapshots())
+                written = mount.evict()
+                loaded -= memory
+                self.evictions += 1
+                if self.on_evict:
+                    self.on_evict(mount, written, snapshots)
+
+    def begin_step(self, line):
+        """Record what each mount's image looks like before the command `line`, for undo()"""
+        self.steps += 1
+        for mount in self.mounts.values():
+            mount.begin_step(('undo', self.steps, line))
+
+    def end_step(self):
+        for mount in self.mounts.values():
+            mount.end_step()
+
+    def undo(self):
+        """Undo the last command that changed any mounted image. Returns its command line and the (mount, blocks
+        restored) of each image it changed, or None if there is nothing to undo"""
+        changed = [mount for mount in self.mounts.values() if mount.undo]
+        if not changed:
+            return None
+        step = max(mount.undo[-1] for mount in changed)
+        undone = []
+        for mount in changed:
+            if mount.undo[-1] == step:
+                self.pinned.add(mount.name)
+                undone.append((mount, mount.rollback(step)))
+        return step[2], undone
+
+    def release(self, keep=()):
+        """Unpin every mount except those named in `keep`, evicting down to the budget"""
+        self.pinned.intersection_update(keep)
+        self.enforce_budget()
+
+    def close(self):
+        for mount in self.mounts.values():
+            mount.close()
+        self.mounts.clear()
+        self.active = None
+        self.pinned.clear()
+
+
+def memory_budget():
+    """Mount memory budget in bytes, from PARTICLE_MOUNT_BUDGET_MB"""
+    megabytes = os.environ.get('PARTICLE_MOUNT_BUDGET_MB')
+    return int(float(megabytes) * 1024 * 1024) if megabytes else DEFAULT_MEMORY_BUDGET
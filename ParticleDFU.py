@@ -0,0 +1,363 @@
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from ShellCmd import ProgressParser
+from Trace import span
+
+# USB DFU 1.1 class requests
+DFU_DNLOAD = 1
+DFU_UPLOAD = 2
+DFU_GETSTATUS = 3
+DFU_CLRSTATUS = 4
+DFU_GETSTATE = 5
+DFU_ABORT = 6
+DFU_REQUEST_OUT = 0x21      # Host to device, class request, interface recipient
+DFU_REQUEST_IN = 0xA1
+
+# DFU states
+STATE_IDLE = 2
+STATE_DNLOAD_SYNC = 3
+STATE_DNBUSY = 4
+STATE_DNLOAD_IDLE = 5
+STATE_UPLOAD_IDLE = 9
+STATE_ERROR = 10
+
+# DFU status codes
+STATUS_OK = 0x00
+STATUS_ERR_WRITE = 0x03
+STATUS_ERR_ERASE = 0x04
+STATUS_ERR_ADDRESS = 0x08
+STATUS_ERR_STALLEDPKT = 0x0f
+
+# STM DfuSe commands, sent as a DNLOAD with wBlockNum 0. Data blocks start at wBlockNum 2
+DFUSE_SET_ADDRESS = 0x21
+DFUSE_ERASE_PAGE = 0x41
+DFUSE_FIRST_BLOCK = 2
+
+DFU_ALT_EXTERNAL_FLASH = 2
+DFU_FLASH_ADDRESS = 0x80000000
+DFU_FLASH_SIZE = 4 * 1024 * 1024
+DFU_PAGE_SIZE = 4096
+DFU_TRANSFER_SIZE = 4096
+DFU_STATUS = struct.Struct('<B3sBB')    # bStatus, bwPollTimeout (24 bit), bState, iString
+
+
+class DFUError(IOError):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class DFUCancelled(DFUError):
+    pass
+
+
+class DfuSe:
+    """DfuSe upload/download engine, speaking DFU class requests through a transport
+
+    A transport has control_out(request, value, data) and control_in(request, value, length) methods; PyUSBTransport
+    talks to a real device and SimulatedDfuSeDevice is one. Progress is reported as ShellCmd.ProgressEvents for the
+    Erase, Download and Upload operations, like the ones parsed from dfu-util's output. cancel() may be called from
+    any thread; the transfer then aborts at the next block and raises DFUCancelled.
+    """
+
+    def __init__(self, transport, transfer_size=DFU_TRANSFER_SIZE, page_size=DFU_PAGE_SIZE, progress_callback=None):
+        self.transport = transport
+        self.transfer_size = transfer_size
+        self.page_size = page_size
+        self.progress_callback = progress_callback
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def _check_cancelled(self):
+        if self.cancelled.is_set():
+            self.abort()
+            raise DFUCancelled("transfer cancelled")
+
+    def get_status(self):
+        status, poll_timeout, state, _ = DFU_STATUS.unpack(bytes(self.transport.control_in(DFU_GETSTATUS, 0, DFU_STATUS.size)))
+        return status, int.from_bytes(poll_timeout, 'little'), state
+
+    def abort(self):
+        self.transport.control_out(DFU_ABORT, 0, b'')
+
+    def clear_status(self):
+        self.transport.control_out(DFU_CLRSTATUS, 0, b'')
+
+    def ensure_idle(self):
+        status, _, state = self.get_status()
+        if state == STATE_ERROR:
+            self.clear_status()
+        elif state != STATE_IDLE:
+            self.abort()
+
+    def _wait(self, what):
+        # Poll GETSTATUS, waiting the time the device asks for, until the last download request has been executed
+        while True:
+            status, poll_timeout, state = self.get_status()
+            if state == STATE_ERROR or status != STATUS_OK:
+                self.clear_status()
+                raise DFUError(f"{what} failed with DFU status 0x{status:02x}", status)
+            if state in (STATE_DNLOAD_IDLE, STATE_IDLE):
+                return
+            time.sleep(poll_timeout / 1000)
+
+    def _dfuse_command(self, command, address):
+        self.transport.control_out(DFU_DNLOAD, 0, struct.pack('<BI', command, address))
+        self._wait(f"DfuSe command 0x{command:02x} at 0x{address:08x}")
+
+    def set_address(self, address):
+        self._dfuse_command(DFUSE_SET_ADDRESS, address)
+
+    def erase(self, address, length):
+        with span('dfu.erase', address=f"0x{address:08x}") as trace:
+            parser = ProgressParser(length)
+            first = address - address % self.page_size
+            for page in range(first, address + length, self.page_size):
+                self._check_cancelled()
+                self._dfuse_command(DFUSE_ERASE_PAGE, page)
+                trace.add(self.page_size, 1)
+                self._progress(parser, 'Erase', min(length, page + self.page_size - address))
+
+    def upload(self, address, length, write):
+        """Read `length` bytes from `address`, passing each block to `write`. Returns the bytes read"""
+        with span('dfu.upload', address=f"0x{address:08x}") as trace:
+            parser = ProgressParser(length)
+            self.ensure_idle()
+            self.set_address(address)
+            self.abort()    # Back to dfuIDLE, uploads aren't allowed from dfuDNLOAD_IDLE
+            done = 0
+            block = DFUSE_FIRST_BLOCK
+            while done < length:
+                self._check_cancelled()
+                # Always request whole blocks, as the device works out the address from the block number and size
+                data = self.transport.control_in(DFU_UPLOAD, block, self.transfer_size)[:length - done]
+                if not data:
+                    raise DFUError(f"upload ended early at 0x{address + done:08x}")
+                write(data)
+                done += len(data)
+                trace.add(len(data), 1)
+                block += 1
+                self._progress(parser, 'Upload', done)
+            self.abort()
+            return done
+
+    def download(self, address, chunks, length):
+        """Erase `length` bytes from `address` and program them with the data from `chunks`. Returns bytes written"""
+        with span('dfu.download', address=f"0x{address:08x}") as trace:
+            parser = ProgressParser(length)
+            self.ensure_idle()
+            self.erase(address, length)
+            self.set_address(address)
+            done = 0
+            block = DFUSE_FIRST_BLOCK
+            for data in _blocks(chunks, self.transfer_size):
+                self._check_cancelled()
+                if done + len(data) > length:
+                    raise DFUError(f"more than {length} bytes to download")
+                if len(data) < self.transfer_size and block != DFUSE_FIRST_BLOCK:
+                    # A short last block would throw off the device's address arithmetic, so address it explicitly
+                    self.set_address(address + done)
+                    block = DFUSE_FIRST_BLOCK
+                self.transport.control_out(DFU_DNLOAD, block, data)
+                self._wait(f"download to 0x{address + done:08x}")
+                done += len(data)
+                trace.add(len(data), 1)
+                block += 1
+                self._progress(parser, 'Download', done)
+            self.abort()
+            return done
+
+    def close(self):
+        if hasattr(self.transport, 'close'):
+            self.transport.close()
+
+    def _progress(self, parser, operation, done):
+        if self.progress_callback:
+            self.progress_callback(parser.update(operation, done))
+
+
+def _blocks(chunks, size):
+    # Regroup an iterable of byte chunks into `size` byte blocks (the last one may be shorter)
+    pending = bytearray()
+    for chunk in chunks:
+        pending.extend(chunk)
+        while len(pending) >= size:
+            yield bytes(pending[:size])
+            del pending[:size]
+    if pending:
+        yield bytes(pending)
+
+
+class PyUSBTransport:
+    """DFU transport over pyusb (optional dependency) to the alt setting of a device's DFU interface"""
+
+    def __init__(self, usb_device, interface=0, alt_setting=DFU_ALT_EXTERNAL_FLASH, timeout=5000):
+        self.usb_device = usb_device
+        self.interface = interface
+        self.timeout = timeout
+        usb_device.set_interface_altsetting(interface=interface, alternate_setting=alt_setting)
+
+    def control_out(self, request, value, data):
+        self.usb_device.ctrl_transfer(DFU_REQUEST_OUT, request, value, self.interface, data, self.timeout)
+
+    def control_in(self, request, value, length):
+        return bytes(self.usb_device.ctrl_transfer(DFU_REQUEST_IN, request, value, self.interface, length, self.timeout))
+
+    def close(self):
+        import usb.util
+        usb.util.dispose_resources(self.usb_device)
+
+    @classmethod
+    def open(cls, vid, pid, serial=None):
+        import usb.core
+        usb_device = usb.core.find(idVendor=vid, idProduct=pid,
+                                   custom_match=lambda d: serial is None or d.serial_number == serial)
+        if usb_device is None:
+            raise DFUError(f"no DFU device {vid:04x}:{pid:04x}" + (f" with serial {serial}" if serial else ""))
+        return cls(usb_device)
+
+
+class SimulatedDfuSeDevice:
+    """Software DfuSe device exposing external flash at 0x80000000, for testing and benchmarking without hardware
+
+    Flash behaves like NOR: erasing sets a page to 0xFF and programming can only clear bits. `erase_time` is seconds
+    per page, `program_rate` and `upload_rate` are bytes per second (0 is instant). Erase and program time is reported
+    to the host as the GETSTATUS poll timeout, as a real device does.
+    """
+
+    def __init__(self, flash=None, base=DFU_FLASH_ADDRESS, page_size=DFU_PAGE_SIZE, erase_time=0.0, program_rate=0,
+                 upload_rate=0):
+        self.flash = flash if flash is not None else bytearray(b'\xff' * DFU_FLASH_SIZE)
+        self.base = base
+        self.page_size = page_size
+        self.erase_time = erase_time
+        self.program_rate = program_rate
+        self.upload_rate = upload_rate
+        self.state = STATE_IDLE
+        self.status = STATUS_OK
+        self.pointer = base
+        self.pending = None
+        self.busy_until = 0.0
+
+    @classmethod
+    def open(cls, filename, size=DFU_FLASH_SIZE, **timing):
+        # Flash contents persist in `filename`, created erased if it doesn't exist
+        if not os.path.exists(filename):
+            with open(filename, 'wb') as fh:
+                fh.write(b'\xff' * size)
+        with open(filename, 'r+b') as fh:
+            return cls(mmap.mmap(fh.fileno(), 0), **timing)
+
+    def close(self):
+        if isinstance(self.flash, mmap.mmap):
+            self.flash.close()
+
+    def _offset(self, address, length=1):
+        offset = address - self.base
+        if offset < 0 or offset + length > len(self.flash):
+            return None
+        return offset
+
+    def _fail(self, status):
+        self.status = status
+        self.state = STATE_ERROR
+
+    def _execute(self):
+        # Carry out the pending download request, returning how long it takes
+        kind, block, data = self.pending
+        self.pending = None
+        if block == 0:
+            command, address = struct.unpack('<BI', data)
+            if command == DFUSE_SET_ADDRESS and self._offset(address) is not None:
+                self.pointer = address
+                return 0.0
+            if command == DFUSE_ERASE_PAGE and self._offset(address) is not None:
+                start = self._offset(address - address % self.page_size)
+                self.flash[start:start + self.page_size] = b'\xff' * self.page_size
+                return self.erase_time
+            self._fail(STATUS_ERR_ADDRESS)
+            return 0.0
+
+        offset = self._offset(self.pointer + (block - DFUSE_FIRST_BLOCK) * len(data), len(data))
+        if offset is None:
+            self._fail(STATUS_ERR_ADDRESS)
+            return 0.0
+        current = int.from_bytes(self.flash[offset:offset + len(data)], 'big')
+        self.flash[offset:offset + len(data)] = (current & int.from_bytes(data, 'big')).to_bytes(len(data), 'big')
+        return len(data) / self.program_rate if self.program_rate else 0.0
+
+    def control_out(self, request, value, data):
+        if request == DFU_ABORT:
+            self.state = STATE_IDLE
+            self.pending = None
+        elif request == DFU_CLRSTATUS:
+            self.state = STATE_IDLE
+            self.status = STATUS_OK
+        elif request == DFU_DNLOAD and self.state in (STATE_IDLE, STATE_DNLOAD_IDLE) and value != 1 and data:
+            self.pending = ('dnload', value, bytes(data))
+            self.state = STATE_DNLOAD_SYNC
+        else:
+            self._fail(STATUS_ERR_STALLEDPKT)
+
+    def control_in(self, request, value, length):
+        if request == DFU_GETSTATUS:
+            poll_timeout = 0
+            if self.state == STATE_DNLOAD_SYNC:
+                duration = self._execute()
+                if self.state != STATE_ERROR:
+                    self.state = STATE_DNBUSY
+                    self.busy_until = time.monotonic() + duration
+                    poll_timeout = int(duration * 1000)
+            elif self.state == STATE_DNBUSY:
+                remaining = self.busy_until - time.monotonic()
+                if remaining <= 0:
+                    self.state = STATE_DNLOAD_IDLE
+                else:
+                    poll_timeout = int(remaining * 1000)
+            return DFU_STATUS.pack(self.status, poll_timeout.to_bytes(3, 'little'), self.state, 0)
+        if request == DFU_GETSTATE:
+            return bytes([self.state])
+        if request == DFU_UPLOAD and self.state in (STATE_IDLE, STATE_UPLOAD_IDLE) and value >= DFUSE_FIRST_BLOCK:
+            offset = self._offset(self.pointer + (value - DFUSE_FIRST_BLOCK) * length)
+            if offset is None:
+                self._fail(STATUS_ERR_ADDRESS)
+                return b''
+            data = bytes(self.flash[offset:offset + length])
+            if self.upload_rate:
+                time.sleep(len(data) / self.upload_rate)
+            self.state = STATE_UPLOAD_IDLE
+            return data
+        self._fail(STATUS_ERR_STALLEDPKT)
+        return b''
+
+
+def simulated_flash_filename(serial):
+    directory = os.environ.get('PARTICLE_SIMULATED_FLASH_DIR', os.path.join(tempfile.gettempdir(), 'particle-simulated-dfu'))
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f"{serial}.bin")
+
+
+def open_dfu(backend, vid, pid, serial, progress_callback=None):
+    """DfuSe engine for a device through the 'native' (pyusb) or 'simulated' backend
+
+    The simulated device's flash is kept in $PARTICLE_SIMULATED_FLASH_DIR/<serial>.bin, with timing from
+    $PARTICLE_SIMULATED_ERASE_MS (per page), $PARTICLE_SIMULATED_PROGRAM_RATE and $PARTICLE_SIMULATED_UPLOAD_RATE
+    (bytes/s). $PARTICLE_DFU_TRANSFER_SIZE sets the transfer size for both.
+    """
+    transfer_size = int(os.environ.get('PARTICLE_DFU_TRANSFER_SIZE', DFU_TRANSFER_SIZE))
+    if backend == 'simulated':
+        transport = SimulatedDfuSeDevice.open(simulated_flash_filename(serial),
+                                              erase_time=float(os.environ.get('PARTICLE_SIMULATED_ERASE_MS', 0)) / 1000,
+                                              program_rate=float(os.environ.get('PARTICLE_SIMULATED_PROGRAM_RATE', 0)),
+                                              upload_rate=float(os.environ.get('PARTICLE_SIMULATED_UPLOAD_RATE', 0)))
+    elif backend == 'native':
+        transport = PyUSBTransport.open(vid, pid, serial)
+    else:
+        raise ValueError(f"unknown DFU backend \"{backend}\"")
+    return DfuSe(transport, transfer_size=transfer_size, progress_callback=progress_callback)
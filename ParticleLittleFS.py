@@ -0,0 +1,756 @@
+import contextlib
+import functools
+import os
+import posixpath
+import queue
+import threading
+from collections import Counter, namedtuple
+from BackupStore import BackupStore
+from DeviceIO import (LOCAL_FILENAME, BACKUP_PATH, backup_filesystem, diff_extents, readFilesystem,
+                      readFilesystemSmart, writeFilesystem, writeFilesystemExtents)
+from DirIndex import LFS_TYPE_DIR, normpath
+from Jobs import JobBusy, JobCancelled, JobManager
+from MountTable import MountError, MountTable, memory_budget
+from ParticleUSB import ParticleUSB, ParticleDevice
+from StreamIO import COPY_BUFFER_SIZE, copy_stream
+from TreeWalk import Filter, glob, has_glob, remove_paths, walk
+from LazyImport import lazy_import
+
+errors = lazy_import('littlefs.errors')
+LittleFSImage = lazy_import('LittleFSImage')
+
+
+class ParticleLittleFSError(Exception):
+    """Base class of every error the session raises"""
+
+
+class FSError(ParticleLittleFSError):
+    """A filesystem operation failed on `path`. `error` is the littlefs error name, e.g. 'ERR_NOENT'"""
+
+    def __init__(self, message, path=None, error=None):
+        super().__init__(message)
+        self.path = path
+        self.error = error
+
+
+class FileNotFound(FSError):
+    pass
+
+
+class NotADirectory(FSError):
+    pass
+
+
+class IsADirectory(FSError):
+    pass
+
+
+class DirectoryNotEmpty(FSError):
+    pass
+
+
+class FileExists(FSError):
+    pass
+
+
+class NotMounted(ParticleLittleFSError):
+    pass
+
+
+class UnsavedChanges(ParticleLittleFSError):
+    pass
+
+
+class DeviceError(ParticleLittleFSError):
+    """A device couldn't be found, or a transfer to or from it failed"""
+
+    def __init__(self, message, device_id=None):
+        super().__init__(message)
+        self.device_id = device_id
+
+
+class DeviceBusy(DeviceError):
+    """The device, or the image file the transfer uses, is in use by `job`, another transfer"""
+
+    def __init__(self, message, device_id, job):
+        super().__init__(message, device_id)
+        self.job = job
+
+
+class TransferCancelled(DeviceError):
+    pass
+
+
+# littlefs error name: (exception, message)
+FS_ERRORS = {
+    'ERR_NOENT': (FileNotFound, "No such file or directory"),
+    'ERR_NOTDIR': (NotADirectory, "Not a directory"),
+    'ERR_ISDIR': (IsADirectory, "Is a directory"),
+    'ERR_NOTEMPTY': (DirectoryNotEmpty, "Directory not empty"),
+    'ERR_EXIST': (FileExists, "File exists"),
+}
+
+
+def fs_error(path, name, detail=None):
+    """The exception for littlefs error `name` on `path`"""
+    cls, message = FS_ERRORS.get(name, (FSError, detail or name))
+    return cls(f"{path}: {message}", path, name)
+
+
+@contextlib.contextmanager
+def _fs_errors(path):
+    # Raise littlefs errors, and the host errors littlefs-python raises in their place, as FSErrors on `path`
+    try:
+        yield
+    except errors.LittleFSError as e:
+        raise fs_error(path, e.name, str(e)) from e
+    except FileExistsError as e:
+        raise fs_error(path, 'ERR_EXIST') from e
+    except FileNotFoundError as e:
+        raise fs_error(path, 'ERR_NOENT') from e
+    except IsADirectoryError as e:
+        raise fs_error(path, 'ERR_ISDIR') from e
+
+
+Entry = namedtuple('Entry', 'mount path name type size')
+Entry.__doc__ = """A file or directory: the mount it is in, its absolute path there, its name, 'file' or 'dir' and its
+size in bytes (0 for directories). Session methods take an Entry wherever they take a path"""
+
+WriteResult = namedtuple('WriteResult', 'backup new_blocks extents device_size size written')
+WriteResult.__doc__ = """What fswrite or fsrestore did: the backup taken first and the blocks it added to the store,
+the (offset, length) extents a delta write planned (None for a full write), the sizes of the device's image and the
+one written, and whether anything was written"""
+
+# The part of a littlefs directory entry remove_paths() needs, for an Entry
+_DirItem = namedtuple('_DirItem', 'name type size')
+
+
+def _entry(mount, path, dir_item):
+    is_dir = dir_item.type == LFS_TYPE_DIR
+    return Entry(mount.name, path, dir_item.name, 'dir' if is_dir else 'file', 0 if is_dir else dir_item.size)
+
+
+def _operation(method):
+    # Calls run one at a time, as littlefs isn't reentrant. Each call lets the mounts earlier calls used be evicted
+    # again, but keeps those it uses loaded until it returns
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            if self.auto_release and not self._depth:
+                self.mounts.release(+self._open_files)
+            self._depth += 1
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self._depth -= 1
+    return wrapper
+
+
+class FileHandle:
+    """A file open in a mounted image, raising FSErrors. It keeps its mount loaded while open, and once a file that
+    was opened for writing is closed, the mount's directory index is updated. Its calls hold the session's lock"""
+
+    def __init__(self, fh, path, on_close, lock):
+        self._fh = fh
+        self.path = path
+        self._on_close = on_close
+        self._lock = lock
+
+    def read(self, size=-1):
+        with self._lock, _fs_errors(self.path):
+            return self._fh.read(size)
+
+    def readinto(self, buffer):
+        with self._lock, _fs_errors(self.path):
+            return self._fh.readinto(buffer)
+
+    def write(self, data):
+        with self._lock, _fs_errors(self.path):
+            return self._fh.write(data)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        with self._lock, _fs_errors(self.path):
+            return self._fh.seek(offset, whence)
+
+    def tell(self):
+        return self._fh.tell()
+
+    def flush(self):
+        with self._lock, _fs_errors(self.path):
+            self._fh.flush()
+
+    def close(self):
+        with self._lock:
+            if self._on_close is None:
+                return
+            try:
+                with _fs_errors(self.path):
+                    self._fh.close()
+            finally:
+                on_close, self._on_close = self._on_close, None
+                on_close()
+
+    @property
+    def closed(self):
+        return self._on_close is None
+
+    def __getattr__(self, name):
+        return getattr(self._fh, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+class Transfer:
+    """A device transfer running on its own thread
+
+    Iterating over it yields (phase, ProgressEvent) as it goes, with None for the event when a phase ('entering DFU
+    mode', 'reading', 'backing up', 'writing') starts, and ends when the transfer does, raising its error if it
+    failed. wait() just waits for the result. Either raises TransferCancelled once cancel() has stopped it. Once the
+    transfer has finished, either removes it from the session's jobs.
+    """
+
+    def __init__(self, job, jobs):
+        self.job = job
+        self._jobs = jobs
+        self._ended = False
+
+    @property
+    def id(self):
+        return self.job.id
+
+    @property
+    def device_id(self):
+        return self.job.device_id
+
+    @property
+    def phase(self):
+        return self.job.phase
+
+    @property
+    def progress(self):
+        return self.job.progress
+
+    @property
+    def done(self):
+        return self.job.done
+
+    @property
+    def result(self):
+        return self.job.result
+
+    @property
+    def log(self):
+        """What the transfer logged, e.g. dfu-util's messages, or that a smart read fell back to a full read"""
+        return self.job.log.getvalue()
+
+    def __iter__(self):
+        while not self._ended:
+            event = self.job.events.get()
+            if event is None:
+                self._ended = True
+                break
+            yield event
+        self.wait()
+
+    def wait(self, timeout=None):
+        """The transfer's result, once it has finished. Raises TimeoutError if it is still running after `timeout`
+        seconds"""
+        self.job.thread.join(timeout)
+        if not self.job.done:
+            raise TimeoutError(f"{self.job.description} still running")
+        self._jobs.discard(self.job)
+        if self.job.state == 'cancelled':
+            raise TransferCancelled(f"{self.job.description} cancelled", self.device_id)
+        if self.job.state == 'failed':
+            if isinstance(self.job.error, ParticleLittleFSError):
+                raise self.job.error
+            raise DeviceError(str(self.job.error), self.device_id) from self.job.error
+        return self.job.result
+
+    def cancel(self):
+        self.job.cancelled.set()
+
+
+class ParticleLittleFS:
+    """A session on mounted images and connected devices, for Python code. The CLI is a layer over it
+
+    Paths are as in the CLI: relative to the active mount's working directory, or qualified with a mount name,
+    'g:/cfg/a.json'. Methods return data, never print, and raise ParticleLittleFSError subclasses: FSErrors for
+    failed filesystem operations, DeviceErrors for devices and transfers.
+
+        with ParticleLittleFS() as fs:
+            fs.mount('temp.littlefs')
+            for entry in fs.listdir('/'):
+                print(entry.name, entry.size)
+            with fs.write('/cfg/a.json') as fh:
+                fh.write(b'{}')
+            fs.sync()
+
+    Images beyond the memory budget are evicted between calls (written back to their file if changed) and reloaded
+    when next used, as in the CLI; an image with files open stays loaded. With `auto_release` off, mounts a caller
+    has used stay loaded until it calls mounts.release(), as the CLI does after each command.
+
+    A session may be shared between threads: each call holds `lock` while it runs, and a caller can hold it to
+    make several calls, or its own use of `mounts`, atomic.
+    """
+
+    def __init__(self, budget=None, on_evict=None, auto_release=True):
+        self.mounts = MountTable(memory_budget() if budget is None else budget, on_evict=on_evict)
+        self.jobs = JobManager()
+        self.auto_release = auto_release
+        self._open_files = Counter()  # Files open per mount
+        self._depth = 0  # Session calls in progress, see _operation()
+        self._copy_buffer = None
+        self.lock = threading.RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def close(self):
+        """Unmount everything, discarding unsaved changes"""
+        self.mounts.close()
+
+    @property
+    def copy_buffer(self):
+        # One reusable buffer bounds the memory used by copies, whatever the file size
+        if self._copy_buffer is None:
+            self._copy_buffer = bytearray(COPY_BUFFER_SIZE)
+        return self._copy_buffer
+
+    def _mount(self, name=None):
+        try:
+            mount = self.mounts.get(name)
+        except MountError as e:
+            raise ParticleLittleFSError(str(e)) from e
+        if mount is None:
+            raise NotMounted(f"{name}: No such mount" if name else "No filesystem mounted!")
+        return mount
+
+    def _resolve(self, path):
+        # The loaded mount and absolute path of a path or Entry
+        if isinstance(path, Entry):
+            return self._mount(path.mount), path.path
+        name, rest = self.mounts.split(path)
+        mount = self._mount(name)
+        return mount, normpath(posixpath.join(mount.cur_dir, rest))
+
+    # Mounts
+
+    def mount(self, image=LOCAL_FILENAME, name=None, replace=True):
+        """Mount an image file as `name` (default: the file name without its extension), replacing any mount of
+        that name without saving it, and make it the active mount. Returns the Mount. Unless `replace`, an existing
+        mount of that name is an error, FileExists, instead"""
+        if name is None:
+            name = os.path.splitext(os.path.basename(image))[0]
+        if not name or any(c in name for c in ':/'):
+            raise ParticleLittleFSError(f"{name}: Invalid mount name")
+        try:
+            fs = LittleFSImage.open_image(image)
+        except FileNotFoundError as e:
+            raise FileNotFound(f"{image}: No such file", image, 'ERR_NOENT') from e
+        except (OSError, ValueError) as e:
+            raise ParticleLittleFSError(f"{image}: {e}") from e
+        except errors.LittleFSError as e:
+            raise fs_error(image, e.name, str(e)) from e
+        # Opened without the lock held, as that is the slow part
+        try:
+            return self._add_mount(name, image, fs, replace)
+        except BaseException:
+            fs.context.close()
+            raise
+
+    @_operation
+    def _add_mount(self, name, image, fs, replace):
+        if not replace and name in self.mounts:
+            raise FileExists(f"{name}: Already mounted from \"{self.mounts.mounts[name].filename}\"", name, 'ERR_EXIST')
+        return self.mounts.add(name, image, fs)
+
+    def _flushable(self, name, destination):
+        mount = self._mount(name)
+        if self._open_files[mount.name]:
+            raise ParticleLittleFSError(f"{mount.name}: {self._open_files[mount.name]} file(s) still open")
+        return mount, destination or mount.filename
+
+    @_operation
+    def sync(self, name=None, destination=None):
+        """Write the changes to mount `name` (default: the active mount) to `destination`, or to the file it was
+        mounted from. Returns the number of bytes written"""
+        mount, destination = self._flushable(name, destination)
+        return mount.fs.context.flush(destination)
+
+    @_operation
+    def unmount(self, name=None, destination=None, save=True):
+        """sync() then unmount mount `name`, or just unmount it, discarding its changes, if not `save`. Returns
+        the number of bytes written"""
+        evicted = self.mounts.mounts.get(self.mounts.active if name is None else name)
+        if evicted and not evicted.loaded and not destination:
+            self.mounts.remove(evicted.name)    # Its changes were written back when it was evicted
+            return 0
+        mount, destination = self._flushable(name, destination)
+        written = mount.fs.context.flush(destination) if save else 0
+        self.mounts.remove(mount.name).close()
+        return written
+
+    @_operation
+    def use(self, name):
+        """Make mount `name` the active one"""
+        self._mount(name)
+        self.mounts.active = name
+
+    # Files and directories
+
+    @_operation
+    def stat(self, path):
+        """The Entry for a file or directory"""
+        mount, fs_path = self._resolve(path)
+        with _fs_errors(path):
+            dir_item = mount.index.stat(fs_path)
+        if fs_path == '/':
+            return Entry(mount.name, '/', '', 'dir', 0)
+        return _entry(mount, fs_path, dir_item)
+
+    @_operation
+    def exists(self, path):
+        try:
+            self.stat(path)
+            return True
+        except (FileNotFound, NotADirectory):
+            return False
+
+    @_operation
+    def listdir(self, path=''):
+        """Entries of a directory (default: the working directory), from the mount's directory index"""
+        mount, fs_path = self._resolve(path)
+        with _fs_errors(path):
+            if mount.index.stat(fs_path).type != LFS_TYPE_DIR:
+                raise errors.LittleFSError(code=-20)    # ERR_NOTDIR
+            return [_entry(mount, posixpath.join(fs_path, dir_item.name), dir_item)
+                    for dir_item in mount.index.scandir(fs_path)]
+
+    @_operation
+    def glob(self, pattern):
+        """Entries matching `pattern`, a path whose components may contain *, ? and [...]"""
+        mount, fs_path = self._resolve(pattern)
+        with _fs_errors(pattern):
+            return [Entry(mount.name, '/', '', 'dir', 0) if path == '/' else _entry(mount, path, dir_item)
+                    for path, dir_item in glob(mount.index, fs_path)]
+
+    @_operation
+    def walk(self, path=''):
+        """Entries of everything below a directory, each directory before its contents"""
+        mount, fs_path = self._resolve(path)
+        with _fs_errors(path):
+            return [_entry(mount, item_path, dir_item) for item_path, dir_item in walk(mount.index, fs_path)]
+
+    @_operation
+    def find(self, path='', name=None, size=None, type=None):
+        """Entries at or below `path` passing every test given: a name glob, a size ('+N', '-N' or 'N', with an
+        optional k, M or G suffix) and a type ('f' or 'd'). Raises ValueError for an invalid test"""
+        matches = Filter(name, size, type)
+        mount, fs_path = self._resolve(path)
+        found = []
+        with _fs_errors(path):
+            top_item = mount.index.stat(fs_path)
+            if fs_path != '/' and matches(top_item):
+                found.append(_entry(mount, fs_path, top_item))
+            if top_item.type == LFS_TYPE_DIR:
+                found.extend(_entry(mount, item_path, dir_item)
+                             for item_path, dir_item in walk(mount.index, fs_path) if matches(dir_item))
+        return found
+
+    @_operation
+    def open(self, path, mode='rb'):
+        """A binary file handle, open for reading ('rb'), writing ('wb'), appending ('ab') or both ('r+b')"""
+        if 'b' not in mode:
+            raise ValueError(f"invalid mode \"{mode}\": files are binary")
+        mount, fs_path = self._resolve(path)
+        with _fs_errors(path):
+            fh = mount.fs.open(fs_path, mode)
+        self._open_files[mount.name] += 1
+        writing = mode != 'rb'
+
+        def on_close():
+            self._open_files[mount.name] -= 1
+            if writing:
+                mount.index.invalidate(fs_path)
+        return FileHandle(fh, path, on_close, self.lock)
+
+    def read(self, path):
+        """A handle to stream a file's contents from"""
+        return self.open(path, 'rb')
+
+    def write(self, path, append=False):
+        """A handle to stream a file's new contents to, replacing it, or appending to it if `append`"""
+        return self.open(path, 'ab' if append else 'wb')
+
+    @_operation
+    def read_bytes(self, path):
+        with self.read(path) as fh:
+            return fh.read()
+
+    @_operation
+    def write_bytes(self, path, data):
+        with self.write(path) as fh:
+            return fh.write(data)
+
+    @_operation
+    def mkdir(self, path, parents=False):
+        """Make a directory, and any missing directories above it if `parents`, when an existing directory isn't
+        an error either"""
+        mount, fs_path = self._resolve(path)
+        parts = [part for part in fs_path.split('/') if part]
+        with _fs_errors(path):
+            for depth in range(1 if parents else len(parts), len(parts) + 1):
+                made = '/' + '/'.join(parts[:depth])
+                if parents:
+                    try:
+                        if mount.index.stat(made).type == LFS_TYPE_DIR:
+                            continue
+                    except errors.LittleFSError as e:
+                        if e.name != 'ERR_NOENT':
+                            raise
+                try:
+                    mount.fs.mkdir(made)
+                finally:
+                    mount.index.invalidate(made)
+
+    @_operation
+    def remove(self, *paths, recursive=False):
+        """Remove files and empty directories, and directories with everything in them if `recursive`. Paths may
+        contain wildcards. Everything is checked before anything is removed, then removed in one batch per mount.
+        Returns the number of files and directories removed"""
+        batches = {}
+        for path in paths:
+            entries = [path] if isinstance(path, Entry) else self.glob(path) if has_glob(path) else [self.stat(path)]
+            if not entries:
+                raise fs_error(path, 'ERR_NOENT')
+            for entry in entries:
+                mount = self._mount(entry.mount)
+                if entry.path == '/':
+                    raise FSError(f"{path}: Cannot remove the root directory", path, 'ERR_INVAL')
+                if entry.type == 'dir' and not recursive and mount.index.scandir(entry.path):
+                    raise fs_error(path, 'ERR_NOTEMPTY')
+                dir_item = _DirItem(entry.name, LFS_TYPE_DIR if entry.type == 'dir' else 0, entry.size)
+                batches.setdefault(mount.name, (mount, {}))[1][entry.path] = dir_item
+        removed = 0
+        for mount, entries in batches.values():
+            with _fs_errors(mount.name + ':'):
+                removed += remove_paths(mount.index, entries.items(), recursive)
+        return removed
+
+    @_operation
+    def copy(self, source, dest):
+        """Copy a file, within or between mounts. Returns the number of bytes copied"""
+        from_mount, from_path = self._resolve(source)
+        with _fs_errors(source):
+            if from_mount.index.stat(from_path).type == LFS_TYPE_DIR:
+                raise errors.LittleFSError(code=-21)    # Cannot copy directories, ERR_ISDIR
+            from_file = from_mount.fs.open(from_path, 'rb')
+        with from_file:
+            to_mount, to_path = self._resolve(dest)
+            try:
+                with _fs_errors(dest), to_mount.fs.open(to_path, 'wb') as to_file:
+                    return copy_stream(from_file, to_file, self.copy_buffer)
+            finally:
+                to_mount.index.invalidate(to_path)
+
+    @_operation
+    def insert(self, local, path, overwrite=False):
+        """Copy the local file `local` into a mounted image. Returns the number of bytes copied"""
+        mount, fs_path = self._resolve(path)
+        if not overwrite and self.exists(path):
+            raise fs_error(path, 'ERR_EXIST')
+        with _fs_errors(local):
+            from_file = open(local, 'rb')
+        with from_file, _fs_errors(path):
+            try:
+                with mount.fs.open(fs_path, 'wb') as to_file:
+                    return copy_stream(from_file, to_file, self.copy_buffer)
+            finally:
+                mount.index.invalidate(fs_path)
+
+    @_operation
+    def extract(self, path, local, overwrite=False):
+        """Copy a file out of a mounted image to the local file `local`. Returns the number of bytes copied"""
+        mount, fs_path = self._resolve(path)
+        with _fs_errors(path):
+            from_file = mount.fs.open(fs_path, 'rb')
+        with from_file:
+            with _fs_errors(local):
+                to_file = open(local, 'wb' if overwrite else 'xb')
+            with to_file:
+                return copy_stream(from_file, to_file, self.copy_buffer)
+
+    # Devices
+
+    def devices(self):
+        """The connected devices this tool works with: Asset Trackers and Gen 3 devices"""
+        try:
+            devices = ParticleUSB.list_devices()
+        except OSError as e:
+            raise DeviceError(f"Can't list devices: {e}") from e
+        return [device for device in devices if device.is_gen3() or device.is_tracker()]
+
+    def device(self, device=None):
+        """The ParticleDevice `device`, which may be a device ID, or the only connected device if None"""
+        if isinstance(device, ParticleDevice):
+            return device
+        devices = self.devices()
+        if device:
+            devices = [found for found in devices if found.device_id.lower() == device.lower()]
+            if not devices:
+                raise DeviceError(f"{device}: No such device", device)
+        elif not devices:
+            raise DeviceError("No devices found!")
+        elif len(devices) > 1:
+            raise DeviceError(f"{len(devices)} devices connected, choose one")
+        return devices[0]
+
+    def enter_dfu(self, device=None):
+        """Put a device in DFU mode. Returns False if it already was"""
+        device = self.device(device)
+        if ParticleUSB.device_registry().in_dfu_mode(device.device_id):
+            return False
+        self._request_dfu(device)
+        return True
+
+    @staticmethod
+    def _request_dfu(device):
+        if not ParticleUSB.enter_dfu_mode(device=device.device_id):
+            raise DeviceError(f"{device.device_id}: Device didn't enter DFU mode", device.device_id)
+
+    def _transfer(self, description, device, work, filename=None):
+        # The device and the image file the transfer reads or writes are its own until it finishes
+        try:
+            job = self.jobs.start(description, work, device.device_id, events=queue.SimpleQueue(),
+                                  resources=[os.path.abspath(filename)] if filename else ())
+            return Transfer(job, self.jobs)
+        except JobBusy as e:
+            raise DeviceBusy(str(e), device.device_id, e.job) from e
+
+    def _enter_dfu(self, job, device):
+        if not ParticleUSB.device_registry().in_dfu_mode(device.device_id):
+            job.set_phase('entering DFU mode')
+            self._request_dfu(device)
+
+    def _backup(self, job, device):
+        job.set_phase('backing up')
+        try:
+            return backup_filesystem(device, progress_callback=job.progress_callback('backing up'), log=job.note)
+        except IOError as e:
+            raise DeviceError(f"Backup failed, not writing to the device without one: {e}", device.device_id) from e
+
+    def _mounts_of(self, filename):
+        return [mount for mount in self.mounts if os.path.abspath(mount.filename) == os.path.abspath(filename)]
+
+    def _check_saved(self, filename):
+        with self.lock:
+            for mount in self._mounts_of(filename):
+                if mount.is_dirty():
+                    raise UnsavedChanges(f"\"{mount.name}\" has unsaved changes to \"{filename}\", sync it first")
+
+    def _reload(self, filename):
+        # Mounts of an image file that was just replaced are reloaded from it when next used, rather than carry on
+        # with the old image. One changed meanwhile is left alone; syncing it writes its whole image back
+        with self.lock:
+            for mount in self._mounts_of(filename):
+                if not mount.is_dirty() and not self._open_files[mount.name]:
+                    mount.close()
+
+    def fsread(self, device=None, full=False, filename=LOCAL_FILENAME):
+        """Start reading a device's filesystem into the image file `filename`: only the blocks littlefs uses,
+        unless `full`. The Transfer's result is `filename`"""
+        device = self.device(device)
+        self._check_saved(filename)
+
+        def work(job):
+            self._enter_dfu(job, device)
+            if os.path.exists(filename):
+                os.remove(filename)
+            job.set_phase('reading')
+            progress_callback = job.progress_callback('reading')
+            try:
+                if full:
+                    result = readFilesystem(filename, device, progress_callback=progress_callback)
+                else:
+                    result = readFilesystemSmart(filename, device, progress_callback=progress_callback, log=job.note)
+            except JobCancelled:
+                if os.path.exists(filename):
+                    os.remove(filename)
+                raise
+            if result:
+                raise DeviceError(f"DFU upload failed with exit status {result}", device.device_id)
+            self._reload(filename)
+            return filename
+        return self._transfer('fsread', device, work, filename)
+
+    def fswrite(self, device=None, filename=LOCAL_FILENAME, delta=False, dry_run=False):
+        """Start writing the image file `filename` to a device, after backing up the device's filesystem. With
+        `delta`, only the blocks that differ from the backup are written, and `dry_run` only plans that. The
+        Transfer's result is a WriteResult"""
+        device = self.device(device)
+        if not os.path.exists(filename):
+            raise FileNotFound(f"{filename}: No such file", filename, 'ERR_NOENT')
+        self._check_saved(filename)
+
+        def work(job):
+            self._enter_dfu(job, device)
+            backup_name, old, new_blocks, blocks_read = self._backup(job, device)
+            LittleFSImage.replay_flush_journal(filename)
+            with open(filename, 'rb') as fh:
+                new = fh.read()
+            extents = None
+            if delta or dry_run:
+                # A delta needs images of the same size, otherwise the whole image is written
+                if len(old) == len(new):
+                    extents = diff_extents(old, new, device.platform.fs_block_size, blocks_read)
+                if dry_run or extents == []:
+                    return WriteResult(backup_name, new_blocks, extents, len(old), len(new), False)
+
+            job.set_phase('writing')
+            progress_callback = job.progress_callback('writing')
+            if extents:
+                result = writeFilesystemExtents(filename, device, extents, progress_callback=progress_callback)
+            else:
+                result = writeFilesystem(filename, device, progress_callback=progress_callback)
+            if result:
+                raise DeviceError(f"DFU download failed with exit status {result}", device.device_id)
+            return WriteResult(backup_name, new_blocks, extents, len(old), len(new), True)
+        return self._transfer('fswrite', device, work, filename)
+
+    def fsrestore(self, backup, device=None):
+        """Start writing the backup `backup` from the backup store to a device, after backing up the device's
+        filesystem. The Transfer's result is a WriteResult"""
+        device = self.device(device)
+        store = BackupStore(BACKUP_PATH)
+        if backup not in store.names():
+            raise FileNotFound(f"{backup}: No such backup", backup, 'ERR_NOENT')
+        size = store.manifest(backup)['size']
+        if size != device.platform.fs_size_bytes():
+            raise ParticleLittleFSError(f"{backup}: Backup is {size} bytes, device filesystem is "
+                                        f"{device.platform.fs_size_bytes()} bytes")
+        # Check the whole backup first: a missing or corrupt block found mid-transfer would leave the device erased
+        try:
+            store.verify(backup)
+        except (OSError, ValueError) as e:
+            raise ParticleLittleFSError(f"{backup}: Backup is damaged: {e}") from e
+
+        def work(job):
+            self._enter_dfu(job, device)
+            backup_name, old, new_blocks, _ = self._backup(job, device)
+            job.set_phase('writing')
+            result = writeFilesystem(backup, device, chunks=store.iter_image(backup),
+                                     progress_callback=job.progress_callback('writing'))
+            if result:
+                raise DeviceError(f"DFU download failed with exit status {result}", device.device_id)
+            return WriteResult(backup_name, new_blocks, None, len(old), device.platform.fs_size_bytes(), True)
+        return self._transfer('fsrestore', device, work)
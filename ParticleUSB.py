@@ -1,6 +1,17 @@
-import subprocess
+import os
+import struct
 import sys
-from parse import parse
+import threading
+import time
+from LazyImport import lazy_import
+from ShellCmd import ShellCmd
+
+parse = lazy_import('parse')
+
+# Writing this baud rate to a Particle device's USB serial port tells it to reset into DFU mode
+DFU_BAUD_RATE = 14400
+CDC_SET_LINE_CODING = 0x20
+CDC_REQUEST_TYPE = 0x21     # Host to device, class request, interface recipient
 
 
 class ParticlePlatform:
@@ -36,10 +47,11 @@ class ParticlePlatform:
 
 
 class ParticleDevice:
-    def __init__(self, name: str, device_id: str, platform):
+    def __init__(self, name: str, device_id: str, platform, dfu_mode=None):
         self.name = name
         self.device_id = device_id
         self.platform = platform
+        self.dfu_mode = dfu_mode    # None if the discovery backend can't tell
 
     def is_gen3(self):
         return self.platform.is_gen3()
@@ -65,50 +77,298 @@ class ParticleUSB:
         'Asset Tracker': ParticlePlatform('tracker', 26, user_block_count=1024),
     }
 
+    @staticmethod
+    def find_platform(name):
+        # Look a platform up by its display name ('Asset Tracker') or short name ('tracker')
+        for display_name, platform in ParticleUSB.known_platforms.items():
+            if name.lower() in (display_name.lower(), platform.name.lower()):
+                return platform
+        return None
+
+    @staticmethod
+    def platform_for_pid(pid):
+        # (platform, in DFU mode) for a Particle USB product ID, or None
+        for platform in ParticleUSB.known_platforms.values():
+            if platform.id and pid in (platform.pid_cdc, platform.pid_dfu):
+                return platform, pid == platform.pid_dfu
+        return None
+
+    @staticmethod
+    def platform_for_size(size):
+        # The platform whose filesystem image is `size` bytes, or None
+        return next((platform for platform in ParticleUSB.known_platforms.values()
+                     if platform.user_block_count and platform.fs_size_bytes() == size), None)
+
+    @staticmethod
+    def platform_display_name(platform):
+        return next((name for name, known in ParticleUSB.known_platforms.items() if known is platform), '')
+
+    registry = None
+
+    @staticmethod
+    def device_registry():
+        # The backend is picked once per process, from $PARTICLE_USB_BACKEND (auto, pyusb, cli or simulated)
+        if ParticleUSB.registry is None:
+            ParticleUSB.registry = DeviceRegistry(select_backend(os.environ.get('PARTICLE_USB_BACKEND', 'auto')))
+        return ParticleUSB.registry
+
     @staticmethod
     def run_shell_cmd(cmd, silent=True):
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-        result = bytearray()
-        result.extend(b'\t')
-        for c in iter(lambda: process.stdout.read(1), b''):
-            result.extend(c)
-            if not silent:
-                sys.stdout.buffer.write(c)
-                if c == b'\n' or c == b'\r':
-                    sys.stdout.buffer.write(b'\t')
-        process.wait()
-        return result.decode('utf-8')
+        shell_cmd = ShellCmd(cmd, capture=True)
+        if not silent:
+            shell_cmd.on_line(lambda line: sys.stdout.write('\t' + line))
+        shell_cmd.run()
+        return shell_cmd.output.decode('utf-8')
 
     @staticmethod
     def list_devices(platform=''):
-        args = ['particle', 'usb', 'list']
+        devices = ParticleUSB.device_registry().devices()
         if platform and platform in ParticleUSB.known_platforms:
-            args.append(platform)
-        result = ParticleUSB.run_shell_cmd(args)
-        if result.strip() == "No devices found.":
+            devices = [device for device in devices if device.platform is ParticleUSB.known_platforms[platform]]
+        return devices
+
+    @staticmethod
+    def enter_dfu_mode(device='', all=False):
+        # Devices the registry already knows are in DFU mode are skipped
+        return ParticleUSB.device_registry().enter_dfu_mode([device] if device and not all else None)
+
+
+class DiscoveryBackend:
+    """Finds connected Particle devices and puts them in DFU mode"""
+    name = ''
+
+    def list_devices(self):
+        raise NotImplementedError
+
+    def enter_dfu_mode(self, device_ids=None):
+        # `device_ids` None means every connected device. Returns True if the request was made
+        raise NotImplementedError
+
+
+class CLIBackend(DiscoveryBackend):
+    """Discovery through the Particle CLI (`particle usb list` / `particle usb dfu`)"""
+    name = 'cli'
+
+    def list_devices(self):
+        result = ParticleUSB.run_shell_cmd(['particle', 'usb', 'list'])
+        if result.strip() == "No devices found." or not result.strip():
             return []
         else:
             device_strings = result.strip().split('\n')
             devices = []
 
             for device_string in device_strings:
-                device_info = parse("{name} [{deviceID}] ({platform})", device_string)
-                # print(device_info)
+                device_info = parse.parse("{name} [{deviceID}] ({platform})", device_string)
+                if not device_info:
+                    continue
                 name = None if device_info['name'] == '<no name>' else device_info['name']
-                platform_str = device_info['platform'].split(', ')[0]
-                platform = ParticleUSB.known_platforms[platform_str] if platform_str in ParticleUSB.known_platforms \
-                    else ParticleUSB.known_platforms['default']
-                devices.append(ParticleDevice(name, device_info['deviceID'], platform))
+                platform_parts = device_info['platform'].split(', ')
+                platform = ParticleUSB.known_platforms.get(platform_parts[0], ParticleUSB.known_platforms['default'])
+                devices.append(ParticleDevice(name, device_info['deviceID'], platform, dfu_mode='DFU' in platform_parts[1:]))
 
-            # print(devices)
             return devices
 
-    @staticmethod
-    def enter_dfu_mode(device='', all=False):
-        args = ['particle', 'usb', 'dfu']
-        if device:
-            args.append(device)
-        elif all:
-            args.append('--all')
-        result = ParticleUSB.run_shell_cmd(args)
-        return result.strip().endswith("Done.")
+    def enter_dfu_mode(self, device_ids=None):
+        if device_ids is None:
+            return ParticleUSB.run_shell_cmd(['particle', 'usb', 'dfu', '--all']).strip().endswith("Done.")
+        return all(ParticleUSB.run_shell_cmd(['particle', 'usb', 'dfu', device_id]).strip().endswith("Done.")
+                   for device_id in device_ids)
+
+
+class PyUSBBackend(DiscoveryBackend):
+    """In-process discovery: enumerates USB devices with Particle's VID and the platform CDC/DFU PIDs
+
+    Devices are put in DFU mode by setting their USB serial port to 14400 baud, then waited for (up to `dfu_timeout`
+    seconds) until they re-enumerate with their DFU product ID. Devices that can't be reached that way (e.g. the
+    kernel's CDC driver owns the interface) are handed to `fallback`, if there is one. `find` defaults to pyusb's
+    usb.core.find, which needs the optional pyusb package and a libusb backend.
+    """
+    name = 'pyusb'
+
+    poll_interval = 0.25
+
+    def __init__(self, find=None, fallback=None, dfu_timeout=10.0):
+        if find is None:
+            import usb.core
+            find = usb.core.find
+            find(idVendor=ParticlePlatform.vid)     # Raises usb.core.NoBackendError if libusb isn't available
+        self.find = find
+        self.fallback = fallback
+        self.dfu_timeout = dfu_timeout
+
+    def _particle_devices(self):
+        # (usb device, platform, dfu mode, device ID) for every connected Particle device we can identify
+        for usb_device in self.find(find_all=True, idVendor=ParticlePlatform.vid):
+            match = ParticleUSB.platform_for_pid(usb_device.idProduct)
+            if not match:
+                continue
+            try:
+                # Particle devices report their device ID as the USB serial number
+                device_id = usb_device.serial_number.lower()
+            except (IOError, ValueError):
+                continue    # No permission to read string descriptors
+            yield usb_device, match[0], match[1], device_id
+
+    def list_devices(self):
+        return [ParticleDevice(None, device_id, platform, dfu_mode=dfu_mode)
+                for _, platform, dfu_mode, device_id in self._particle_devices()]
+
+    def enter_dfu_mode(self, device_ids=None):
+        reset = []
+        unreachable = []
+        line_coding = struct.pack('<IBBB', DFU_BAUD_RATE, 0, 0, 8)     # 14400 baud, 1 stop bit, no parity, 8 bits
+        for usb_device, _, dfu_mode, device_id in self._particle_devices():
+            if dfu_mode or (device_ids is not None and device_id not in device_ids):
+                continue
+            try:
+                usb_device.ctrl_transfer(CDC_REQUEST_TYPE, CDC_SET_LINE_CODING, 0, 0, line_coding)
+                reset.append(device_id)
+            except (IOError, ValueError, NotImplementedError):
+                unreachable.append(device_id)
+        if unreachable and not (self.fallback and self.fallback.enter_dfu_mode(unreachable)):
+            return False
+        return self._wait_for_dfu(reset)
+
+    def _wait_for_dfu(self, device_ids):
+        # True once every device in `device_ids` has re-enumerated in DFU mode, False if they haven't by the timeout
+        deadline = time.monotonic() + self.dfu_timeout
+        waiting = set(device_ids)
+        while waiting:
+            waiting -= {device_id for _, _, dfu_mode, device_id in self._particle_devices() if dfu_mode}
+            if not waiting:
+                break
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(self.poll_interval)
+        return True
+
+
+class SimulatedUSBDevice:
+    """Just enough of a pyusb device for PyUSBBackend: a Particle device that resets into DFU mode at 14400 baud"""
+
+    def __init__(self, platform: ParticlePlatform, device_id: str, dfu_mode=False):
+        self.platform = platform
+        self.device_id = device_id
+        self.dfu_mode = dfu_mode
+        self.idVendor = platform.vid
+
+    @property
+    def idProduct(self):
+        return self.platform.pid_dfu if self.dfu_mode else self.platform.pid_cdc
+
+    @property
+    def serial_number(self):
+        return self.device_id.upper() if self.dfu_mode else self.device_id
+
+    def ctrl_transfer(self, bmRequestType, bRequest, wValue=0, wIndex=0, data_or_wLength=None, timeout=None):
+        if (bmRequestType, bRequest) == (CDC_REQUEST_TYPE, CDC_SET_LINE_CODING) and \
+                struct.unpack_from('<I', bytes(data_or_wLength))[0] == DFU_BAUD_RATE:
+            self.dfu_mode = True
+        return len(data_or_wLength)
+
+
+class SimulatedUSBBus:
+    """A fake USB bus of SimulatedUSBDevices, for exercising discovery without hardware
+
+    `enumerate_delay` seconds are spent on every enumeration, to make caching visible.
+    """
+
+    def __init__(self, devices=(), enumerate_delay=0.0):
+        self.devices = list(devices)
+        self.enumerate_delay = enumerate_delay
+        self.enumerations = 0
+
+    @classmethod
+    def from_spec(cls, spec: str, enumerate_delay=0.0):
+        # e.g. "tracker:2,argon" is two Trackers and an Argon, all out of DFU mode
+        devices = []
+        for item in filter(None, spec.split(',')):
+            name, _, count = item.partition(':')
+            platform = ParticleUSB.find_platform(name.strip())
+            if not platform:
+                raise ValueError(f"unknown platform \"{name}\"")
+            for _ in range(int(count or 1)):
+                devices.append(SimulatedUSBDevice(platform, f"e00fce68{len(devices):016x}"))
+        return cls(devices, enumerate_delay)
+
+    def find(self, find_all=False, idVendor=None):
+        self.enumerations += 1
+        time.sleep(self.enumerate_delay)
+        found = [device for device in self.devices if idVendor is None or device.idVendor == idVendor]
+        return found if find_all else next(iter(found), None)
+
+
+def select_backend(name='auto'):
+    """Create a discovery backend by name. 'auto' uses pyusb when it works here, otherwise the Particle CLI"""
+    if name == 'cli':
+        return CLIBackend()
+    if name == 'pyusb':
+        return PyUSBBackend(fallback=CLIBackend())
+    if name == 'simulated':
+        bus = SimulatedUSBBus.from_spec(os.environ.get('PARTICLE_SIMULATED_DEVICES', 'tracker'))
+        return PyUSBBackend(find=bus.find)
+    if name == 'auto':
+        try:
+            return PyUSBBackend(fallback=CLIBackend())
+        except Exception:   # ImportError without pyusb, usb.core.NoBackendError without libusb
+            return CLIBackend()
+    raise ValueError(f"unknown USB discovery backend \"{name}\"")
+
+
+class DeviceRegistry:
+    """Short-lived cache of the connected devices, and of which of them are in DFU mode
+
+    Listings are reused for `ttl` seconds. A device is considered in DFU mode once it has been put there, until a
+    listing taken more than `ttl` seconds later shows it out of DFU mode (it takes a moment to re-enumerate).
+    Concurrent transfers share one registry, so each method holds `lock`, also while devices are put in DFU mode,
+    so none is asked twice.
+    """
+
+    def __init__(self, backend: DiscoveryBackend, ttl=5.0, clock=time.monotonic):
+        self.backend = backend
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self._devices = None
+        self._listed_at = 0.0
+        self._dfu_since = {}    # device_id -> when it was put in, or seen in, DFU mode
+
+    def devices(self, refresh=False):
+        with self.lock:
+            return list(self._list(refresh))
+
+    def _list(self, refresh=False):
+        now = self.clock()
+        if refresh or self._devices is None or now - self._listed_at > self.ttl:
+            self._devices = self.backend.list_devices()
+            self._listed_at = now
+            for device in self._devices:
+                if device.dfu_mode:
+                    self._dfu_since[device.device_id] = now
+                elif device.dfu_mode is not None and now - self._dfu_since.get(device.device_id, now) > self.ttl:
+                    del self._dfu_since[device.device_id]
+        return self._devices
+
+    def in_dfu_mode(self, device_id):
+        with self.lock:
+            return device_id in self._dfu_since
+
+    def enter_dfu_mode(self, device_ids=None):
+        with self.lock:
+            targets = [device.device_id for device in self._list()] if device_ids is None else device_ids
+            pending = [device_id for device_id in targets if device_id not in self._dfu_since]
+            if not pending:
+                return True
+            everything = device_ids is None and len(pending) == len(targets)
+            if not self.backend.enter_dfu_mode(None if everything else pending):
+                return False
+            now = self.clock()
+            for device_id in pending:
+                self._dfu_since[device_id] = now
+            self._devices = None    # They re-enumerate with their DFU product IDs
+            return True
+
+    def invalidate(self):
+        with self.lock:
+            self._devices = None
+            self._dfu_since.clear()
@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+import posixpath
+import time
+from concurrent.futures import ProcessPoolExecutor
+from DirIndex import LFS_TYPE_DIR, normpath
+from StreamIO import COPY_BUFFER_SIZE, copy_stream, iter_chunks
+from LazyImport import lazy_import
+
+errors = lazy_import('littlefs.errors')
+LittleFSImage = lazy_import('LittleFSImage')
+
+SPEC_KEYS = ('mkdir', 'insert', 'remove', 'expect')
+
+
+def load_spec(filename: str):
+    """Load and validate a provisioning spec. Host paths in `insert` are resolved relative to the spec file
+
+    {
+        "remove": ["/old/file.bin"],
+        "mkdir": ["/cfg", "/usr/data"],
+        "insert": [{"from": "files/config.json", "to": "/cfg/config.json"}],
+        "expect": {"/cfg/config.json": "<sha256 hex digest>"}
+    }
+    """
+    with open(filename, 'r') as fh:
+        spec = json.load(fh)
+
+    unknown = set(spec) - set(SPEC_KEYS)
+    if unknown:
+        raise ValueError(f"unknown spec keys: {', '.join(sorted(unknown))}")
+
+    spec_dir = os.path.dirname(os.path.abspath(filename))
+    inserts = []
+    for item in spec.get('insert', []):
+        source = os.path.join(spec_dir, item['from'])
+        if not os.path.isfile(source):
+            raise ValueError(f"insert: {item['from']}: Not a file")
+        inserts.append({'from': source, 'to': normpath(item['to'])})
+
+    return {
+        'remove': [normpath(path) for path in spec.get('remove', [])],
+        'mkdir': [normpath(path) for path in spec.get('mkdir', [])],
+        'insert': inserts,
+        'expect': {normpath(path): digest.lower() for path, digest in spec.get('expect', {}).items()},
+    }
+
+
+def _makedirs(fs, path):
+    current = ''
+    for part in filter(None, path.split('/')):
+        current += '/' + part
+        try:
+            fs.mkdir(current)
+        except FileExistsError:
+            pass
+        except errors.LittleFSError as e:
+            if e.name != "ERR_EXIST":
+                raise
+
+
+def _sha256(fs, path, buffer):
+    digest = hashlib.sha256()
+    with fs.open(path, 'rb') as fh:
+        for chunk in iter_chunks(fh, buffer):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def apply_spec(fs, spec):
+    """Apply a loaded spec to a mounted filesystem. Returns the number of bytes inserted"""
+    buffer = bytearray(COPY_BUFFER_SIZE)
+    for path in spec['remove']:
+        try:
+            if fs.stat(path).type == LFS_TYPE_DIR:
+                raise ValueError(f"remove: {path}: Is a directory")
+            fs.remove(path)
+        except errors.LittleFSError as e:
+            if e.name != "ERR_NOENT":
+                raise
+
+    for path in spec['mkdir']:
+        _makedirs(fs, path)
+
+    inserted = 0
+    for item in spec['insert']:
+        _makedirs(fs, posixpath.dirname(item['to']))
+        with open(item['from'], 'rb') as from_file, fs.open(item['to'], 'wb') as to_file:
+            inserted += copy_stream(from_file, to_file, buffer)
+
+    for path, expected in spec['expect'].items():
+        try:
+            actual = _sha256(fs, path, buffer)
+        except errors.LittleFSError as e:
+            raise ValueError(f"expect: {path}: {e}")
+        if actual != expected:
+            raise ValueError(f"expect: {path}: sha256 {actual} does not match {expected}")
+
+    return inserted
+
+
+def provision_image(image: str, spec, out_dir=None):
+    """Worker entry point: mount `image`, apply `spec` and write the result. Never raises, returns a result dict"""
+    start = time.monotonic()
+    result = {'image': image, 'ok': False, 'error': '', 'bytes': 0, 'output': image}
+    fs = None
+    try:
+        fs = LittleFSImage.open_image(image)
+        result['bytes'] = apply_spec(fs, spec)
+        if out_dir:
+            result['output'] = os.path.join(out_dir, os.path.basename(image))
+        fs.context.flush(result['output'])
+        result['ok'] = True
+    except (errors.LittleFSError, OSError, ValueError) as e:
+        result['error'] = str(e)
+    finally:
+        if fs:
+            fs.context.close()
+        result['seconds'] = time.monotonic() - start
+    return result
+
+
+def provision_images(images, spec, out_dir=None, jobs=None):
+    """Provision many images in parallel worker processes, yielding result dicts in image order"""
+    LittleFSImage.open_image  # Import littlefs before the workers are forked, rather than in each of them
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        yield from pool.map(provision_image, images, [spec] * len(images), [out_dir] * len(images))
@@ -0,0 +1,144 @@
+import os
+import re
+import subprocess
+import threading
+import time
+from collections import namedtuple
+
+ProgressEvent = namedtuple('ProgressEvent', ['operation', 'bytes', 'total', 'percent', 'throughput', 'eta'])
+
+# e.g. "Upload	[=============            ]  52%      2183168 bytes"
+DFU_PROGRESS_RE = re.compile(r'^\s*(Upload|Download|Erase)\s*\[[=\s]*\]\s*(\d+)%\s*(\d+)\s*bytes')
+LINE_END_RE = re.compile(rb'[\r\n]')
+
+
+class ProgressParser:
+    """Turns dfu-util progress bar lines into ProgressEvents with throughput (bytes/s) and ETA (seconds)"""
+
+    def __init__(self, total=None):
+        self.total = total
+        self.started = {}
+
+    def parse(self, line: str):
+        match = DFU_PROGRESS_RE.match(line)
+        if not match:
+            return None
+        return self.update(match.group(1), int(match.group(3)), int(match.group(2)))
+
+    def update(self, operation: str, transferred: int, percent=None):
+        """ProgressEvent for `transferred` bytes of `operation`, from a progress line or a byte count"""
+        total = self.total
+        if percent is None:
+            percent = transferred * 100 // total if total else 0
+        if not total and percent:
+            total = transferred * 100 // percent
+
+        now = time.monotonic()
+        started_at, started_bytes = self.started.setdefault(operation, (now, transferred))
+        elapsed = now - started_at
+        throughput = (transferred - started_bytes) / elapsed if elapsed > 0 else 0.0
+        eta = (total - transferred) / throughput if throughput and total else None
+        return ProgressEvent(operation, transferred, total, percent, throughput, eta)
+
+
+def format_progress(event: ProgressEvent):
+    eta = f"ETA {event.eta:.0f}s" if event.eta is not None else ""
+    total = f"/{event.total}" if event.total else ""
+    return f"{event.operation:<8} {event.percent:>3}%  {event.bytes}{total} bytes  {event.throughput / 1024:7.1f} KB/s  {eta}"
+
+
+class ShellCmd:
+    """Runs a command, reading its output in large chunks and splitting it into lines on \\r and \\n
+
+    Subscribers registered with on_line() receive every decoded line (including its terminator), and subscribers
+    registered with on_progress() receive a ProgressEvent for every dfu-util progress line. If a subscriber or the
+    stdin_chunks iterator raises, the command is killed and the exception propagates from run().
+    """
+
+    read_size = 65536
+
+    def __init__(self, cmd, stdin_chunks=None, total_bytes=None, capture=False):
+        self.cmd = cmd
+        self.stdin_chunks = stdin_chunks
+        self.parser = ProgressParser(total_bytes)
+        self.capture = capture
+        self.output = bytearray()
+        self.line_listeners = []
+        self.progress_listeners = []
+        self.last_progress = None
+        self.returncode = None
+        self.stdin_error = None
+
+    def on_line(self, callback):
+        self.line_listeners.append(callback)
+        return self
+
+    def on_progress(self, callback):
+        self.progress_listeners.append(callback)
+        return self
+
+    def _feed_stdin(self, process):
+        try:
+            for chunk in self.stdin_chunks:
+                process.stdin.write(chunk)
+        except BrokenPipeError:
+            pass
+        except Exception as e:
+            # Kill the command before closing stdin, so it never takes the end of its input for the end of the data
+            self.stdin_error = e
+            process.kill()
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def _emit(self, raw_line):
+        line = raw_line.decode('utf-8', errors='replace')
+        for callback in self.line_listeners:
+            callback(line)
+        if self.progress_listeners:
+            event = self.parser.parse(line)
+            if event:
+                self.last_progress = event
+                for callback in self.progress_listeners:
+                    callback(event)
+
+    def run(self):
+        process = subprocess.Popen(self.cmd, stdout=subprocess.PIPE,
+                                   stdin=subprocess.PIPE if self.stdin_chunks is not None else None)
+        feeder = None
+        if self.stdin_chunks is not None:
+            feeder = threading.Thread(target=self._feed_stdin, args=(process,), daemon=True)
+            feeder.start()
+
+        fd = process.stdout.fileno()
+        pending = bytearray()
+        try:
+            for chunk in iter(lambda: os.read(fd, self.read_size), b''):
+                if self.capture:
+                    self.output.extend(chunk)
+                if not (self.line_listeners or self.progress_listeners):
+                    continue
+                pending.extend(chunk)
+                start = 0
+                for match in LINE_END_RE.finditer(pending):
+                    self._emit(pending[start:match.end()])
+                    start = match.end()
+                del pending[:start]
+
+            if pending:
+                self._emit(pending)
+        except BaseException:
+            # A listener raising (e.g. to cancel the transfer) or Ctrl-C must not leave the command running
+            process.kill()
+            process.wait()
+            raise
+        finally:
+            process.stdout.close()
+        self.returncode = process.wait()
+        if feeder:
+            feeder.join()
+            if self.stdin_error:
+                raise self.stdin_error
+        return self.returncode
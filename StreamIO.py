@@ -0,0 +1,109 @@
+import sys
+
+COPY_BUFFER_SIZE = 64 * 1024
+
+
+def binary_stdout():
+    # sys.stdout.buffer, or an adapter when stdout has been replaced by a text-only stream
+    buffer = getattr(sys.stdout, 'buffer', None)
+    if buffer is not None:
+        sys.stdout.flush()
+        return buffer
+    return _TextWriter(sys.stdout)
+
+
+class _TextWriter:
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, data):
+        self.stream.write(bytes(data).decode('utf-8', errors='replace'))
+
+    def flush(self):
+        self.stream.flush()
+
+
+def iter_chunks(from_file, buffer, limit=None):
+    """Yield memoryviews of successive reads from `from_file` into the reusable `buffer`, up to `limit` bytes"""
+    view = memoryview(buffer)
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = len(view) if remaining is None else min(len(view), remaining)
+        read = from_file.readinto(view[:size])
+        if not read:
+            return
+        if remaining is not None:
+            remaining -= read
+        yield view[:read]
+
+
+def copy_stream(from_file, to_file, buffer, limit=None):
+    copied = 0
+    for chunk in iter_chunks(from_file, buffer, limit):
+        to_file.write(chunk)
+        copied += len(chunk)
+    return copied
+
+
+def head_length(from_file, buffer, lines, limit=None):
+    """Number of bytes from the current position up to and including the `lines`th newline, at most `limit`"""
+    length = 0
+    for chunk in iter_chunks(from_file, buffer, limit):
+        data = bytes(chunk)
+        position = -1
+        while lines > 0:
+            position = data.find(b'\n', position + 1)
+            if position == -1:
+                break
+            lines -= 1
+        if lines == 0:
+            return length + position + 1
+        length += len(data)
+    return length
+
+
+def tail_offset(from_file, size, buffer, lines):
+    """Offset of the start of the last `lines` lines of a file, found by reading backwards one buffer at a time"""
+    end = size
+    newlines = 0
+    skip_final = True  # A newline ending the file doesn't start another line
+    while end > 0:
+        start = max(0, end - len(buffer))
+        from_file.seek(start)
+        data = b''.join(bytes(chunk) for chunk in iter_chunks(from_file, buffer, end - start))
+        position = len(data)
+        while True:
+            position = data.rfind(b'\n', 0, position)
+            if position == -1:
+                break
+            if skip_final and start + position == size - 1:
+                skip_final = False
+                continue
+            newlines += 1
+            if newlines == lines:
+                return start + position + 1
+        skip_final = False
+        end = start
+    return 0
+
+
+def _hexdump_rows(data, offset):
+    rows = []
+    for row_start in range(0, len(data), 16):
+        row = data[row_start:row_start + 16]
+        hex_bytes = ' '.join(f'{b:02x}' for b in row)
+        text = ''.join(chr(b) if 32 <= b < 127 else '.' for b in row)
+        rows.append(f"{offset + row_start:08x}  {hex_bytes:<47}  |{text}|\n")
+    return ''.join(rows).encode('ascii')
+
+
+def hexdump(from_file, to_file, buffer, offset=0, limit=None):
+    pending = b''
+    for chunk in iter_chunks(from_file, buffer, limit):
+        data = pending + bytes(chunk)
+        whole_rows = len(data) - len(data) % 16
+        to_file.write(_hexdump_rows(data[:whole_rows], offset))
+        offset += whole_rows
+        pending = data[whole_rows:]
+    if pending:
+        to_file.write(_hexdump_rows(pending, offset))
@@ -0,0 +1,223 @@
+import atexit
+import json
+import os
+import threading
+import time
+
+MODES = ('off', 'summary', 'chrome')
+
+
+class SpanStats:
+    __slots__ = ('count', 'seconds', 'max', 'bytes', 'blocks')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.max = 0.0
+        self.bytes = 0
+        self.blocks = 0
+
+    def add(self, seconds, nbytes, blocks):
+        self.count += 1
+        self.seconds += seconds
+        self.max = max(self.max, seconds)
+        self.bytes += nbytes
+        self.blocks += blocks
+
+
+class Span:
+    """A timed region. add() counts bytes and blocks against it; anything else it should record goes in `args`"""
+
+    __slots__ = ('tracer', 'name', 'args', 'bytes', 'blocks', 'start')
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.bytes = 0
+        self.blocks = 0
+        self.start = None
+
+    def add(self, nbytes=0, blocks=0):
+        self.bytes += nbytes
+        self.blocks += blocks
+
+    def __enter__(self):
+        self.tracer._push(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        self.tracer._pop(self)
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer._record(self, end)
+        return False
+
+
+class _NullSpan:
+    """Returned by span() while tracing is off, so instrumented code costs one call and nothing else"""
+
+    __slots__ = ()
+
+    def add(self, nbytes=0, blocks=0):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Tracer:
+    """Collects spans: per-name totals in 'summary' mode, plus every span as a Chrome trace event in 'chrome' mode
+
+    Chrome traces are written to `filename` when tracing stops (or at exit), for chrome://tracing or Perfetto.
+    Hot paths such as littlefs block device callbacks use count(), which only adds to the totals, and to the
+    innermost open span on the same thread.
+    """
+
+    def __init__(self):
+        self.mode = 'off'
+        self.filename = None
+        self.stats = {}
+        self.events = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.origin = time.perf_counter()
+        self.pid = os.getpid()
+        atexit.register(self.stop)
+
+    @property
+    def enabled(self):
+        return self.mode != 'off'
+
+    def start(self, mode, filename=None):
+        """Switch to `mode`, writing out any Chrome trace in progress first. Totals are kept, see reset()"""
+        if mode not in MODES:
+            raise ValueError(f"unknown trace mode \"{mode}\" (expected {', '.join(MODES)})")
+        if mode == 'chrome' and not filename:
+            raise ValueError("chrome tracing needs a file name")
+        self.stop()
+        self.mode = mode
+        self.filename = filename if mode == 'chrome' else None
+
+    def stop(self):
+        """Stop tracing, returning the Chrome trace file written, if any"""
+        written = None
+        if self.mode == 'chrome':
+            written = self.write_chrome(self.filename)
+        self.mode = 'off'
+        self.filename = None
+        return written
+
+    def reset(self):
+        with self.lock:
+            self.stats.clear()
+            self.events.clear()
+
+    def span(self, name, **args):
+        return Span(self, name, args) if self.mode != 'off' else NULL_SPAN
+
+    def count(self, name, seconds, nbytes=0, blocks=0):
+        with self.lock:
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = SpanStats()
+            stats.add(seconds, nbytes, blocks)
+        stack = getattr(self.local, 'stack', None)
+        if stack:
+            args = stack[-1].args
+            args[name + '.calls'] = args.get(name + '.calls', 0) + 1
+            args[name + '.bytes'] = args.get(name + '.bytes', 0) + nbytes
+
+    def _push(self, span):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        stack.append(span)
+
+    def _pop(self, span):
+        stack = self.local.stack
+        if stack and stack[-1] is span:
+            stack.pop()
+
+    def _record(self, span, end):
+        seconds = end - span.start
+        with self.lock:
+            stats = self.stats.get(span.name)
+            if stats is None:
+                stats = self.stats[span.name] = SpanStats()
+            stats.add(seconds, span.bytes, span.blocks)
+            if self.mode == 'chrome':
+                args = dict(span.args, bytes=span.bytes, blocks=span.blocks)
+                self.events.append({'name': span.name, 'ph': 'X', 'pid': self.pid, 'tid': threading.get_ident(),
+                                    'ts': (span.start - self.origin) * 1e6, 'dur': seconds * 1e6, 'args': args})
+
+    def summary(self):
+        """(name, SpanStats) pairs, most total time first"""
+        with self.lock:
+            return sorted(self.stats.items(), key=lambda item: item[1].seconds, reverse=True)
+
+    def write_chrome(self, filename):
+        with self.lock:
+            events = list(self.events)
+            self.events.clear()
+        with open(filename, 'w') as fh:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fh, default=str)
+        return filename
+
+
+tracer = Tracer()
+
+
+def span(name, **args):
+    """A span for `name` if tracing is on, otherwise a no-op. Use as a context manager"""
+    return tracer.span(name, **args) if tracer.mode != 'off' else NULL_SPAN
+
+
+def instrument_context(context):
+    """Time a littlefs block device's read, prog and erase callbacks. They are wrapped on the instance only, so an
+    uninstrumented context runs the plain methods"""
+    if 'read' in vars(context):
+        return
+    read, prog, erase = context.read, context.prog, context.erase
+    perf_counter = time.perf_counter
+
+    def traced_read(cfg, block, off, size):
+        start = perf_counter()
+        data = read(cfg, block, off, size)
+        tracer.count('lfs.read', perf_counter() - start, size)
+        return data
+
+    def traced_prog(cfg, block, off, data):
+        start = perf_counter()
+        result = prog(cfg, block, off, data)
+        tracer.count('lfs.prog', perf_counter() - start, len(data))
+        return result
+
+    def traced_erase(cfg, block):
+        start = perf_counter()
+        result = erase(cfg, block)
+        tracer.count('lfs.erase', perf_counter() - start, cfg.block_size, 1)
+        return result
+
+    context.read, context.prog, context.erase = traced_read, traced_prog, traced_erase
+
+
+def uninstrument_context(context):
+    for name in ('read', 'prog', 'erase'):
+        vars(context).pop(name, None)
+
+
+def configure_from_env():
+    """Start tracing as PARTICLE_TRACE says: 'summary', or 'chrome:<file>'"""
+    setting = os.environ.get('PARTICLE_TRACE')
+    if setting:
+        mode, _, filename = setting.partition(':')
+        tracer.start(mode, filename or None)
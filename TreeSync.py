@@ -0,0 +1,143 @@
+import hashlib
+import os
+import posixpath
+import shutil
+from DirIndex import LFS_TYPE_DIR, normpath
+from StreamIO import COPY_BUFFER_SIZE, copy_stream, iter_chunks
+from TreeWalk import remove_paths
+from LazyImport import lazy_import
+
+errors = lazy_import('littlefs.errors')
+
+
+class SyncStats:
+    def __init__(self):
+        self.copied_files = 0
+        self.copied_bytes = 0
+        self.skipped_files = 0
+        self.skipped_bytes = 0
+        self.deleted = 0
+
+    def __str__(self):
+        return (f"{self.copied_files} file(s) copied ({self.copied_bytes} bytes), "
+                f"{self.skipped_files} unchanged file(s) skipped ({self.skipped_bytes} bytes), "
+                f"{self.deleted} deleted")
+
+
+def _hash_stream(fh, buffer):
+    digest = hashlib.sha256()
+    for chunk in iter_chunks(fh, buffer):
+        digest.update(chunk)
+    return digest.digest()
+
+
+def fs_remove_tree(index, path, dir_item=None):
+    """Remove a file, or a directory and everything in it, from the filesystem behind a DirIndex"""
+    remove_paths(index, [(path, dir_item or index.stat(path))])
+
+
+def _fs_listing(index, path):
+    try:
+        return {dir_item.name: dir_item for dir_item in index.scandir(path)}
+    except errors.LittleFSError as e:
+        if e.name != "ERR_NOENT":
+            raise
+    index.fs.mkdir(path)
+    index.invalidate(path)
+    return {}
+
+
+def push_tree(index, local_dir, fs_dir, delete=False):
+    """Copy a host directory tree into the filesystem, skipping files whose size and SHA-256 already match"""
+    stats = SyncStats()
+    buffer = bytearray(COPY_BUFFER_SIZE)
+    fs_dir = normpath(fs_dir)
+    for root, dirs, files in os.walk(local_dir):
+        dirs.sort()
+        rel = os.path.relpath(root, local_dir)
+        dest_dir = fs_dir if rel == '.' else posixpath.join(fs_dir, *rel.split(os.sep))
+        existing = _fs_listing(index, dest_dir)
+
+        for name in sorted(files):
+            local_path = os.path.join(root, name)
+            dest_path = posixpath.join(dest_dir, name)
+            size = os.path.getsize(local_path)
+            current = existing.get(name)
+            if current and current.type == LFS_TYPE_DIR:
+                fs_remove_tree(index, dest_path, current)
+                current = None
+
+            with open(local_path, 'rb') as from_file:
+                if current and current.size == size:
+                    with index.fs.open(dest_path, 'rb') as fs_file:
+                        if _hash_stream(fs_file, buffer) == _hash_stream(from_file, buffer):
+                            stats.skipped_files += 1
+                            stats.skipped_bytes += size
+                            continue
+                    from_file.seek(0)
+                with index.fs.open(dest_path, 'wb') as to_file:
+                    copy_stream(from_file, to_file, buffer)
+            index.invalidate(dest_path)
+            stats.copied_files += 1
+            stats.copied_bytes += size
+
+        for name in dirs:
+            current = existing.get(name)
+            if current and current.type != LFS_TYPE_DIR:
+                fs_remove_tree(index, posixpath.join(dest_dir, name), current)
+
+        if delete:
+            stale = sorted(set(existing) - set(files) - set(dirs))
+            remove_paths(index, [(posixpath.join(dest_dir, name), existing[name]) for name in stale])
+            stats.deleted += len(stale)
+    return stats
+
+
+def pull_tree(index, fs_dir, local_dir, delete=False):
+    """Copy a filesystem directory tree to the host, skipping files whose size and SHA-256 already match"""
+    stats = SyncStats()
+    buffer = bytearray(COPY_BUFFER_SIZE)
+    fs_dir = normpath(fs_dir)
+    if index.stat(fs_dir).type != LFS_TYPE_DIR:
+        raise errors.LittleFSError(code=-20)    # ERR_NOTDIR
+    os.makedirs(local_dir, exist_ok=True)
+
+    pending = [(fs_dir, local_dir)]
+    while pending:
+        src_dir, dest_dir = pending.pop()
+        listing = index.scandir(src_dir)
+        for dir_item in listing:
+            src_path = posixpath.join(src_dir, dir_item.name)
+            dest_path = os.path.join(dest_dir, dir_item.name)
+            if dir_item.type == LFS_TYPE_DIR:
+                if os.path.isfile(dest_path):
+                    os.remove(dest_path)
+                os.makedirs(dest_path, exist_ok=True)
+                pending.append((src_path, dest_path))
+                continue
+
+            if os.path.isdir(dest_path):
+                shutil.rmtree(dest_path)
+            with index.fs.open(src_path, 'rb') as from_file:
+                if os.path.isfile(dest_path) and os.path.getsize(dest_path) == dir_item.size:
+                    with open(dest_path, 'rb') as local_file:
+                        if _hash_stream(local_file, buffer) == _hash_stream(from_file, buffer):
+                            stats.skipped_files += 1
+                            stats.skipped_bytes += dir_item.size
+                            continue
+                    from_file.seek(0)
+                with open(dest_path, 'wb') as to_file:
+                    copy_stream(from_file, to_file, buffer)
+            stats.copied_files += 1
+            stats.copied_bytes += dir_item.size
+
+        if delete:
+            names = {dir_item.name for dir_item in listing}
+            for entry in os.scandir(dest_dir):
+                if entry.name not in names:
+                    if entry.is_dir(follow_symlinks=False):
+                        shutil.rmtree(entry.path)
+                    else:
+                        os.remove(entry.path)
+                    stats.deleted += 1
+    return stats
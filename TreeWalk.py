@@ -0,0 +1,140 @@
+import fnmatch
+import posixpath
+import re
+from DirIndex import LFS_TYPE_DIR, normpath
+from LazyImport import lazy_import
+
+errors = lazy_import('littlefs.errors')
+
+GLOB_CHARS = re.compile(r'[*?[]')
+SIZE_UNITS = {'': 1, 'c': 1, 'k': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+SIZE_RE = re.compile(r'([+-]?)(\d+)([ckMG]?)$')
+
+
+def has_glob(path):
+    return bool(GLOB_CHARS.search(path))
+
+
+def compile_glob(pattern):
+    """Match function for one path component. As in the shell, a leading '.' must be matched explicitly"""
+    match = re.compile(fnmatch.translate(pattern)).match
+    if pattern.startswith('.'):
+        return match
+    return lambda name: not name.startswith('.') and match(name)
+
+
+def parse_size(text):
+    """'+N' (more than N bytes), '-N' (less than) or 'N' (exactly), with an optional k, M or G suffix, as a test on
+    a size"""
+    match = SIZE_RE.match(text)
+    if not match:
+        raise ValueError(f"invalid size \"{text}\"")
+    sign, number, unit = match.groups()
+    size = int(number) * SIZE_UNITS[unit]
+    if sign == '+':
+        return lambda value: value > size
+    if sign == '-':
+        return lambda value: value < size
+    return lambda value: value == size
+
+
+class Filter:
+    """find's tests on a directory entry, compiled once: a name glob, a size and a type ('f' or 'd')
+
+    As in find(1), the name glob has no leading-dot rule: '*.log' matches '.hidden.log'.
+    """
+
+    def __init__(self, name=None, size=None, type=None):
+        if type not in (None, 'f', 'd'):
+            raise ValueError(f"invalid type \"{type}\" (expected f or d)")
+        self.name = re.compile(fnmatch.translate(name)).match if name else None
+        self.size = parse_size(size) if size else None
+        self.type = type
+
+    def __call__(self, dir_item):
+        is_dir = dir_item.type == LFS_TYPE_DIR
+        if self.type and is_dir != (self.type == 'd'):
+            return False
+        if self.name and not self.name(dir_item.name):
+            return False
+        # Directories have no size of their own, so a size test only matches files
+        return not self.size or (not is_dir and self.size(dir_item.size))
+
+
+def walk(index, top='/'):
+    """(path, dir_item) for everything below directory `top`, each directory before its contents, reading every
+    directory once through the DirIndex"""
+    top = normpath(top)
+    stack = [(top, iter(index.scandir(top)))]
+    while stack:
+        dir_path, entries = stack[-1]
+        dir_item = next(entries, None)
+        if dir_item is None:
+            stack.pop()
+            continue
+        path = posixpath.join(dir_path, dir_item.name)
+        yield path, dir_item
+        if dir_item.type == LFS_TYPE_DIR:
+            stack.append((path, iter(index.scandir(path))))
+
+
+def glob(index, pattern):
+    """(path, dir_item) for every path matching `pattern`, an absolute path whose components may contain *, ? and
+    [...]. Only the directories the pattern can reach are read"""
+    parts = [part for part in normpath(pattern).split('/') if part]
+    if not parts:
+        return [('/', index.stat('/'))]
+    matchers = [compile_glob(part) if has_glob(part) else part for part in parts]
+    matches = []
+
+    def expand(dir_path, depth):
+        matcher = matchers[depth]
+        if isinstance(matcher, str):
+            path = posixpath.join(dir_path, matcher)
+            try:
+                candidates = [(path, index.stat(path))]
+            except errors.LittleFSError as e:
+                if e.name not in ("ERR_NOENT", "ERR_NOTDIR"):
+                    raise
+                return
+        else:
+            candidates = [(posixpath.join(dir_path, dir_item.name), dir_item)
+                          for dir_item in index.scandir(dir_path) if matcher(dir_item.name)]
+        for path, dir_item in candidates:
+            if depth == len(matchers) - 1:
+                matches.append((path, dir_item))
+            elif dir_item.type == LFS_TYPE_DIR:
+                expand(path, depth + 1)
+
+    expand('/', 0)
+    return matches
+
+
+def remove_paths(index, entries, recursive=True):
+    """Remove (path, dir_item) entries, as found by walk() or glob(), in one batch. Returns the number of files and
+    directories removed
+
+    The walk has already read each entry's type, so nothing is stat'ed again. Directories are emptied first when
+    `recursive`, and everything is removed deepest first, a directory at a time, so littlefs never finds a directory
+    still in use and the same metadata blocks are updated back to back. The index is invalidated once, at the end.
+    Raises ERR_NOTEMPTY, before removing anything, for a non-empty directory when not `recursive`.
+    """
+    removals = {}
+    for path, dir_item in entries:
+        path = normpath(path)
+        if path == '/':
+            raise errors.LittleFSError(code=-22)    # ERR_INVAL, the root can't be removed
+        removals[path] = dir_item
+        if dir_item.type == LFS_TYPE_DIR:
+            if recursive:
+                removals.update(walk(index, path))
+            elif index.scandir(path):
+                raise errors.LittleFSError(code=-39)    # ERR_NOTEMPTY
+
+    ordered = sorted(removals, key=lambda path: (-path.count('/'), posixpath.dirname(path)))
+    try:
+        for path in ordered:
+            index.fs.remove(path)
+    finally:
+        index.invalidate_paths(removals)
+    return len(ordered)
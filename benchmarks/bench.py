@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""Benchmarks for mounting, traversal, file I/O and device transfers
+
+Generates synthetic 2MB and 4MB images, times the CLI commands against them and runs full readFilesystem /
+writeFilesystem transfers, both through the stand-in dfu-util in benchmarks/fakebin and through the in-process
+DfuSe engine with its simulated device. Results are written as JSON.
+
+    python benchmarks/bench.py [--out results.json] [--repeat N] [--quick] [--only name[,name]]
+                               [--dfu-rate BYTES_PER_SEC] [--compare baseline.json [--threshold RATIO]]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+FAKEBIN_DIR = os.path.join(BENCH_DIR, 'fakebin')
+SCHEMA_VERSION = 1
+NOISE_FLOOR = 0.001  # Slowdowns smaller than this many seconds aren't reported as regressions
+
+# name: (platform, directories, files per directory, file size in bytes)
+PROFILES = {
+    'argon-small-files': ('argon', 10, 20, 1024),
+    'argon-large-files': ('argon', 2, 4, 192 * 1024),
+    'tracker-many-files': ('tracker', 20, 30, 512),
+    'tracker-large-files': ('tracker', 4, 4, 200 * 1024),
+}
+QUICK_PROFILES = ('argon-small-files', 'tracker-large-files')
+
+
+def make_tree(directory, dirs, files, size, seed):
+    rng = random.Random(seed)
+    for d in range(dirs):
+        path = os.path.join(directory, f"dir{d:03d}")
+        os.makedirs(path)
+        for f in range(files):
+            with open(os.path.join(path, f"file{f:03d}.bin"), 'wb') as fh:
+                fh.write(rng.randbytes(size))
+
+
+class Bench:
+    def __init__(self, work_dir, repeat, dfu_rate, only=None):
+        self.work_dir = work_dir
+        self.repeat = repeat
+        self.dfu_rate = dfu_rate
+        self.only = only
+        self.results = []
+
+    def wanted(self, name):
+        return not self.only or name in self.only
+
+    def time(self, name, profile, run, setup=None, **extra):
+        """Time `run()` `repeat` times, calling `setup()` untimed before each run. Output is discarded"""
+        if not self.wanted(name):
+            return
+        samples = []
+        sink = io.TextIOWrapper(io.BytesIO(), write_through=True)
+        for _ in range(self.repeat):
+            with contextlib.redirect_stdout(sink):
+                if setup:
+                    setup()
+                start = time.perf_counter()
+                run()
+                samples.append(time.perf_counter() - start)
+            sink.buffer.seek(0)
+            sink.buffer.truncate()
+        result = {
+            'benchmark': name,
+            'profile': profile,
+            'samples': len(samples),
+            'min': min(samples),
+            'median': statistics.median(samples),
+            'mean': statistics.mean(samples),
+        }
+        result.update(extra)
+        self.results.append(result)
+        print(f"  {name:<12} {result['median'] * 1000:10.2f} ms (min {result['min'] * 1000:.2f} ms)", file=sys.stderr)
+
+    def run_profile(self, profile, cli, build_image, platform_info):
+        platform_name, dirs, files, size = PROFILES[profile]
+        print(f"{profile}: {dirs * files} x {size} byte files, {platform_info.fs_size_bytes()} byte image",
+              file=sys.stderr)
+
+        src_dir = os.path.join(self.work_dir, profile)
+        image = os.path.join(self.work_dir, profile + '.littlefs')
+        make_tree(src_dir, dirs, files, size, seed=profile)
+        build_image(src_dir, image, platform_info)
+        self.time('mkimage', profile, lambda: build_image(src_dir, image, platform_info))
+
+        host_file = os.path.join(src_dir, 'dir000', 'file000.bin')
+        extracted = os.path.join(self.work_dir, 'extracted.bin')
+        first_dir = '/dir000'
+        first_file = '/dir000/file000.bin'
+
+        shell = cli.LittleFSCLI()
+
+        def mount():
+            shell.do_mount(image)
+            if not shell.fs:
+                raise RuntimeError(f"could not mount {image}")
+
+        def fresh_index():
+            shell.index.clear()
+
+        def remove(path):
+            # Untimed setup: make sure `path` doesn't exist in the mounted filesystem
+            try:
+                shell.index.stat(path)
+            except Exception:
+                return
+            shell.do_rm(path)
+
+        def dirty():
+            remove('/dirty.bin')
+            shell.do_insert(f"{host_file} /dirty.bin")
+
+        self.time('mount_fs', profile, lambda: cli.LittleFSImage.open_image(image).context.close())
+        with contextlib.redirect_stdout(sys.stderr):
+            mount()
+        self.time('tree', profile, lambda: shell.do_tree('/'), setup=fresh_index)
+        self.time('tree_cached', profile, lambda: shell.do_tree('/'))
+        self.time('ls', profile, lambda: shell.do_ls(first_dir), setup=fresh_index)
+        self.time('cat', profile, lambda: shell.do_cat(first_file), bytes=size)
+        self.time('cp', profile, lambda: shell.do_cp(f"{first_file} /copy.bin"),
+                  setup=lambda: remove('/copy.bin'), bytes=size)
+        self.time('insert', profile, lambda: shell.do_insert(f"{host_file} /inserted.bin"),
+                  setup=lambda: remove('/inserted.bin'), bytes=size)
+        self.time('extract', profile, lambda: shell.do_extract(f"{first_file} {extracted}"),
+                  setup=lambda: os.path.exists(extracted) and os.remove(extracted), bytes=size)
+        self.time('sync', profile, lambda: shell.do_sync(''), setup=dirty)
+        self.time('unmount', profile, lambda: shell.do_unmount(''), setup=lambda: (mount(), dirty()))
+
+        self.run_transfers(profile, cli, image, platform_info)
+
+    def run_transfers(self, profile, cli, image, platform_info):
+        import DeviceIO
+        device = cli.ParticleDevice('bench0', 'e00fce680000000000000000', platform_info)
+        serial = DeviceIO.device_serial(device)
+        size = platform_info.fs_size_bytes()
+        read_to = os.path.join(self.work_dir, 'read.littlefs')
+        emulated = size / self.dfu_rate if self.dfu_rate else 0.0
+
+        def check(result):
+            if result != 0:
+                raise RuntimeError(f"fake dfu-util failed ({result})")
+
+        self.time('fsread', profile, lambda: check(DeviceIO.readFilesystem(read_to, device, serial)),
+                  setup=lambda: os.path.exists(read_to) and os.remove(read_to), bytes=size, emulated_seconds=emulated)
+        # Erase and download are both emulated at the same rate
+        self.time('fswrite', profile, lambda: check(DeviceIO.writeFilesystem(image, device, serial=serial)),
+                  bytes=size, emulated_seconds=2 * emulated)
+
+        # The same transfers through the in-process DfuSe engine and its simulated device
+        dfu_backend = DeviceIO.DFU_BACKEND
+        DeviceIO.DFU_BACKEND = 'simulated'
+        try:
+            self.time('fsread_native', profile, lambda: check(DeviceIO.readFilesystem(read_to, device, serial)),
+                      setup=lambda: os.path.exists(read_to) and os.remove(read_to), bytes=size,
+                      emulated_seconds=emulated)
+            self.time('fswrite_native', profile, lambda: check(DeviceIO.writeFilesystem(image, device, serial=serial)),
+                      bytes=size, emulated_seconds=2 * emulated)
+        finally:
+            DeviceIO.DFU_BACKEND = dfu_backend
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_file, threshold):
+    """Print each benchmark's median against the baseline, returning the number of regressions"""
+    with open(baseline_file, 'r') as fh:
+        baseline = {(r['benchmark'], r['profile']): r for r in json.load(fh)['results']}
+    regressions = 0
+    for result in results:
+        old = baseline.get((result['benchmark'], result['profile']))
+        if not old or not old['median']:
+            continue
+        ratio = result['median'] / old['median']
+        flag = ''
+        if ratio > threshold and result['median'] - old['median'] > NOISE_FLOOR:
+            regressions += 1
+            flag = '  REGRESSION'
+        print(f"{result['profile']:<20} {result['benchmark']:<12} {old['median'] * 1000:10.2f} ms -> "
+              f"{result['median'] * 1000:10.2f} ms  x{ratio:.2f}{flag}", file=sys.stderr)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--out', default='-', help="JSON results file (default: stdout)")
+    parser.add_argument('--repeat', type=int, default=5, help="samples per benchmark (default: 5)")
+    parser.add_argument('--quick', action='store_true', help="only run " + ', '.join(QUICK_PROFILES))
+    parser.add_argument('--only', help="comma separated benchmark names to run")
+    parser.add_argument('--dfu-rate', type=float, default=8 * 1024 * 1024,
+                        help="emulated dfu-util transfer rate in bytes/s, 0 for no delay (default: 8MB/s)")
+    parser.add_argument('--compare', metavar='BASELINE', help="compare medians against an earlier results file")
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help="median ratio counted as a regression by --compare (default: 1.25)")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='littlefs-bench-')
+    os.environ['PATH'] = FAKEBIN_DIR + os.pathsep + os.environ.get('PATH', '')
+    os.environ['FAKE_DFU_FLASH_DIR'] = os.path.join(work_dir, 'flash')
+    for variable in ('FAKE_DFU_UPLOAD_RATE', 'FAKE_DFU_DOWNLOAD_RATE', 'FAKE_DFU_ERASE_RATE',
+                     'PARTICLE_SIMULATED_UPLOAD_RATE', 'PARTICLE_SIMULATED_PROGRAM_RATE'):
+        os.environ[variable] = str(args.dfu_rate)
+    os.environ['PARTICLE_SIMULATED_FLASH_DIR'] = os.environ['FAKE_DFU_FLASH_DIR']
+    os.environ['PARTICLE_SIMULATED_ERASE_MS'] = str(4096 * 1000 / args.dfu_rate if args.dfu_rate else 0)
+
+    # The CLI writes its working files to the current directory
+    sys.path.insert(0, REPO_DIR)
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        import cli
+        from LittleFSImage import build_image
+        from ParticleUSB import ParticleUSB
+
+        bench = Bench(work_dir, args.repeat, args.dfu_rate, set(args.only.split(',')) if args.only else None)
+        for profile in (QUICK_PROFILES if args.quick else PROFILES):
+            bench.run_profile(profile, cli, build_image, ParticleUSB.find_platform(PROFILES[profile][0]))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'schema': SCHEMA_VERSION,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': args.repeat,
+        'dfu_rate': args.dfu_rate,
+        'results': bench.results,
+    }
+    if args.out == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.out, 'w') as fh:
+            json.dump(report, fh, indent=2)
+
+    if args.compare:
+        return 1 if compare(bench.results, args.compare, args.threshold) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
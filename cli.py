@@ -1,96 +1,136 @@
 from cmd import Cmd
-from littlefs import LittleFS, errors
-import subprocess
 import sys
 import os
+import posixpath
+import shlex
 import shutil
-from datetime import datetime
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from ParticleUSB import ParticleUSB, ParticleDevice
-
-try:
-    import readline
-except ImportError:
-    readline = None
+from BackupStore import BackupStore
+from ShellCmd import format_progress
+from DeviceIO import (LOCAL_FILENAME, BACKUP_PATH, DFU_FS_ADDRESS, backup_filesystem, device_serial, diff_extents,
+                      load_image, readFilesystemSmart, writeFilesystem, writeFilesystemExtents)
+from DirIndex import LFS_TYPE_DIR
+from MountTable import UNDO_DEPTH, MountError
+from Trace import configure_from_env, instrument_context, span, tracer, uninstrument_context
+from LittleFSLayout import ImageLayout, diff_images, estimate_blocks
+from StreamIO import binary_stdout, copy_stream, head_length, tail_offset, hexdump
+from TreeWalk import has_glob
+from ParticleLittleFS import DeviceBusy, DeviceError, FileExists, FileNotFound, ParticleLittleFS, ParticleLittleFSError
+from LazyImport import lazy_import
+
+# Imported when a command first needs them, as littlefs is slow to import
+errors = lazy_import('littlefs.errors')
+LittleFSImage = lazy_import('LittleFSImage')
+Manifest = lazy_import('Manifest')
+Provision = lazy_import('Provision')
+TreeSync = lazy_import('TreeSync')
 
 histfile = 'someconsole_history'
 histfile_size = 1000
 
 import logging
-logging.basicConfig(filename='debug.log', level=logging.DEBUG)
+# Debug logging is off unless PARTICLE_DEBUG_LOG names a file to write it to
+if os.environ.get('PARTICLE_DEBUG_LOG'):
+    logging.basicConfig(filename=os.environ['PARTICLE_DEBUG_LOG'], level=logging.DEBUG)
 
 LOCAL_PATH = os.path.dirname(os.path.realpath(__file__))
-LOCAL_FILENAME = "temp.littlefs"
-
-def run_shell_cmd(cmd, filter_str='', indent_char='\t'):
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    line_buffer = b''
-    for c in iter(lambda: process.stdout.read(1), b''):
-        line_buffer += c
-        if c == b'\r' or c == b'\n':
-            out_str = line_buffer.decode("utf-8")
-            if filter_str and not out_str.startswith(filter_str):
-                line_buffer = b''
-                continue
-
-            sys.stdout.write(indent_char)
-            sys.stdout.write(out_str)
-            line_buffer = b''
-
-    process.wait()
-    print()
-
-def readFilesystem(filename: str, device: ParticleDevice):
-    run_shell_cmd(['dfu-util',
-                   '-d', f',{device.platform.vid:04x}:{device.platform.pid_dfu:04x}',
-                   '-a', '2',
-                   '-s', f'0x80000000:{device.platform.fs_size_bytes()}',
-                   '-U', filename],
-                  filter_str='Upload')
-
-def writeFilesystem(filename: str, device: ParticleDevice):
-    run_shell_cmd(['dfu-util',
-                   '-d', f',{device.platform.vid:04x}:{device.platform.pid_dfu:04x}',
-                   '-a', '2',
-                   '-s', '0x80000000',
-                   '-D', filename],
-                  filter_str='Download')
-
-def mount_fs(filename: str, block_size=4096):
-    _fs = None
 
+def split_background(inp: str):
+    # Split command arguments, and say whether they end with '&', asking for the command to run as a background job
+    args = inp.split()
+    if args and args[-1].endswith('&'):
+        args[-1] = args[-1][:-1]
+        if not args[-1]:
+            args.pop()
+        return args, True
+    return args, False
+
+
+class FleetProgress:
+    """One status line per device for concurrent fleet transfers, redrawn in place when stdout is a terminal"""
+
+    def __init__(self, devices):
+        self.lock = threading.Lock()
+        self.order = [device.device_id for device in devices]
+        self.status = {device_id: ('waiting', None) for device_id in self.order}
+        self.rates = {}
+        self.live = sys.stdout.isatty()
+        self.drawn = False
+
+    def update(self, device_id, phase, percent=None):
+        with self.lock:
+            last_phase, last_percent = self.status[device_id]
+            if (phase, percent) == (last_phase, last_percent):
+                return
+            self.status[device_id] = (phase, percent)
+            if self.live:
+                self._redraw()
+            elif phase != last_phase:
+                print(f"\t{device_id}: {phase}")
+
+    def _redraw(self):
+        if self.drawn:
+            sys.stdout.write(f"\x1b[{len(self.order)}F")
+        for device_id in self.order:
+            phase, percent = self.status[device_id]
+            detail = f" {percent:>3}%  {self.rates.get(device_id, 0) / 1024:.1f} KB/s" if percent is not None else ""
+            sys.stdout.write(f"\x1b[2K\t{device_id}: {phase}{detail}\n")
+        sys.stdout.flush()
+        self.drawn = True
+
+    def progress_callback(self, device_id, phase):
+        def callback(event):
+            self.rates[device_id] = event.throughput
+            self.update(device_id, phase, event.percent)
+        return callback
+
+
+def fleet_read(device: ParticleDevice, out_dir, progress: FleetProgress):
+    filename = os.path.join(out_dir, f"{device.device_id}.littlefs")
     if os.path.exists(filename):
-        fs_file_size = os.path.getsize(filename)
-        gen3_bytes = ParticleUSB.known_platforms['Argon'].fs_size_bytes()
-        tracker_bytes = ParticleUSB.known_platforms['Asset Tracker'].fs_size_bytes()
-
-        if fs_file_size == gen3_bytes:
-            block_count = 512  # 2MB for Argon/Boron/BSoM (512 * 4096)
-            print(f'\"{filename}\" mounted as 2MB (Argon/Boron/BSoM) filesystem')
-        elif fs_file_size == tracker_bytes:
-            block_count = 1024  # 4MB for Tracker (1024 * 4096)
-            print(f'\"{filename}\" mounted as 4MB (Tracker) filesystem')
-        else:
-            print(f"Mount failed: file \"{filename}\" wrong size (expected {gen3_bytes}, {tracker_bytes}])")
-            _fs = None
-            return None
-
-    # File does not exist
+        os.remove(filename)
+    progress.update(device.device_id, 'reading')
+    result = readFilesystemSmart(filename, device, device_serial(device), progress.progress_callback(device.device_id, 'reading'))
+    if result or not os.path.exists(filename):
+        raise IOError(f"DFU upload failed with exit status {result}")
+    return filename
+
+def fleet_write(device: ParticleDevice, filename, delta, progress: FleetProgress):
+    if os.path.getsize(filename) != device.platform.fs_size_bytes():
+        raise ValueError(f"image is {os.path.getsize(filename)} bytes, device filesystem is {device.platform.fs_size_bytes()} bytes")
+
+    serial = device_serial(device)
+    progress.update(device.device_id, 'backing up')
+    backup_name, backup_image, _, blocks_read = backup_filesystem(device, serial, progress.progress_callback(device.device_id, 'backing up'))
+
+    progress.update(device.device_id, 'writing')
+    callback = progress.progress_callback(device.device_id, 'writing')
+    if delta:
+        LittleFSImage.replay_flush_journal(filename)
+        with open(filename, 'rb') as fh:
+            extents = diff_extents(backup_image, fh.read(), device.platform.fs_block_size, blocks_read)
+        if not extents:
+            return f"unchanged, backup {backup_name}"
+        result = writeFilesystemExtents(filename, device, extents, serial, callback)
+        written = sum(length for _, length in extents)
     else:
-        print(f"Mount failed: file \"{filename}\" does not exist")
-        _fs = None
-        return None
+        result = writeFilesystem(filename, device, serial=serial, progress_callback=callback)
+        written = os.path.getsize(filename)
 
-    # Passed our checks - try mounting
+    if result:
+        raise IOError(f"DFU download failed with exit status {result}")
+    return f"wrote {written} bytes, backup {backup_name}"
+
+def run_fleet_job(job, device, *args):
+    # Returns (succeeded, detail, seconds) so one failing device never stops the others
+    start = time.monotonic()
     try:
-        _fs = LittleFS(block_size=block_size, block_count=block_count, mount=False)
-        with open(filename, 'rb') as fh:
-            _fs.context.buffer = bytearray(fh.read())
-        _fs.mount()
+        return True, job(device, *args), time.monotonic() - start
     except Exception as e:
-        print(f"Failed to mount file \"{filename}\" with error: \"{e}\"")
-        _fs = None
-    finally:
-        return _fs
+        return False, str(e), time.monotonic() - start
 
 
 def tree(_fs, root, prefix=''):
@@ -110,15 +150,6 @@ def tree(_fs, root, prefix=''):
             # i.e. space because last, └── , above so no more |
             yield from tree(_fs, root + '/' + path.name, prefix=prefix+extension)
 
-def list_files(startpath):
-    for root, dirs, files in os.walk(startpath):
-        level = root.replace(startpath, '').count(os.sep)
-        indent = ' ' * 4 * (level)
-        print(f'{indent}{os.path.basename(root)}/')
-        subindent = ' ' * 4 * (level + 1)
-        for f in files:
-            print(f'{subindent}{f}')
-
 class LittleFSCLI(Cmd):
 
     mounted_prompt = "[{}] {}:{}$ "
@@ -127,31 +158,114 @@ class LittleFSCLI(Cmd):
 
     intro = "Particle LittleFS Command Line Utility"
 
-    fs = None
-    fs_filename = ""
-    cur_dir = '/'
     target_device = None
+    fleet_jobs = 4
+    status = 0  # 1 if the last command failed, see error()
+    readline = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # The session does the work; commands parse their arguments and print what it returns
+        self.session = ParticleLittleFS(on_evict=self.report_eviction, auto_release=False)
+        self.mounts = self.session.mounts
+        self.jobs = self.session.jobs
+
+    @property
+    def fs(self):
+        mount = self.mounts.get()
+        return mount.fs if mount else None
+
+    @property
+    def index(self):
+        mount = self.mounts.get()
+        return mount.index if mount else None
+
+    @property
+    def fs_filename(self):
+        mount = self.mounts.get()
+        return mount.filename if mount else ""
+
+    @property
+    def cur_dir(self):
+        mount = self.mounts.get()
+        return mount.cur_dir if mount else '/'
+
+    @cur_dir.setter
+    def cur_dir(self, path):
+        mount = self.mounts.get()
+        if mount:
+            mount.cur_dir = path
+
+    def resolve(self, path):
+        """The mount and path a possibly mount-qualified path ('g:/cfg/a.json') refers to. Unqualified paths are
+        in the active mount, and a bare 'g:' is that mount's working directory"""
+        name, path = self.mounts.split(path)
+        mount = self.mounts.get(name)
+        return mount, path if path or name is None else mount.cur_dir
+
+    def report_eviction(self, mount, written, snapshots):
+        details = []
+        if written:
+            details.append(f"wrote changes to \"{mount.filename}\" ({written} bytes written)")
+        if snapshots:
+            details.append(f"dropped its {snapshots} snapshot(s) and undo history")
+        if details:
+            print(f"Evicted \"{mount.name}\" from memory, {' and '.join(details)}")
+
+    def onecmd(self, line):
+        self.status = 0
+        # Every command can be undone: each mounted image journals the blocks the command changes
+        self.mounts.begin_step(line)
+        with span(f"cmd.{self.parseline(line)[0] or 'empty'}", line=line):
+            try:
+                return super().onecmd(line)
+            except MountError as e:
+                self.error(e)
+            finally:
+                self.mounts.end_step()
+
+    def error(self, message):
+        # Report why a command failed, on stderr, and fail it: one-shot runs stop and exit with status 1
+        print(message, file=sys.stderr)
+        self.status = 1
 
     def preloop(self):
-        if readline and os.path.exists(histfile):
+        # Only an interactive session needs readline and the history, so they're loaded here rather than at import
+        try:
+            import readline
+        except ImportError:
+            return
+        self.readline = readline
+        if os.path.exists(histfile):
             readline.read_history_file(histfile)
 
     def postloop(self):
-        if readline:
-            readline.set_history_length(histfile_size)
-            readline.write_history_file(histfile)
+        if self.readline:
+            self.readline.set_history_length(histfile_size)
+            self.readline.write_history_file(histfile)
 
     def postcmd(self, stop: bool, line: str) -> bool:
-        if self.target_device or self.fs:
+        for job in self.jobs.reap():
+            self.report_job(job)
+
+        # Let the mounts this command used be evicted again, and build the prompt without reloading anything
+        self.mounts.release()
+        mount = self.mounts.mounts.get(self.mounts.active)
+        if self.target_device or mount:
             self.prompt = self.mounted_prompt.format(
                 self.target_device.device_id if self.target_device else "<No Target>",
-                self.fs_filename if self.fs else "<No FS>",
-                self.cur_dir
+                mount.name if mount else "<No FS>",
+                mount.cur_dir if mount else '/'
             )
         else:
             self.prompt = self.unmounted_prompt
+        self.prompt = ''.join(f"[{job.id} {job.description}: {job.status()}] " for job in self.jobs.running()) + self.prompt
+
+        return stop
 
-        return False  # continue execution
+    def emptyline(self):
+        # Enter redraws the prompt, with up to date job progress, rather than repeating the last command
+        return False
 
     def fs_autocomplete(self, text, line, start_index, end_index):
         search_dir = self.cur_dir
@@ -159,21 +273,22 @@ class LittleFSCLI(Cmd):
         arg_start_idx = line.index(' ') + 1
         if start_index > arg_start_idx:
             search_dir += line[arg_start_idx:start_index]
-        logging.debug(f"Tab completion: {{search_dir: {search_dir}}}")
+        logging.debug("Tab completion: {search_dir: %s}", search_dir)
 
         if text:
             results = [
                 "{}{}".format(dir_item.name, "/" if dir_item.type == 34 else "")
-                for dir_item in self.fs.scandir(search_dir)
+                for dir_item in self.index.scandir(search_dir)
                 if dir_item.name.startswith(text)
             ]
         else:
             results = [
                 "{}{}".format(dir_item.name, "/" if dir_item.type == 34 else "")
-                for dir_item in self.fs.scandir(search_dir)
+                for dir_item in self.index.scandir(search_dir)
             ]
 
-        logging.debug(f"fs_autocomplete(): {{search_text: {text}, line: {line}, search_dir: {search_dir}, start_index: {start_index}, end_index: {end_index}, results: {results}}}")
+        logging.debug("fs_autocomplete(): {search_text: %s, line: %s, search_dir: %s, start_index: %s, end_index: %s, results: %s}",
+                      text, line, search_dir, start_index, end_index, results)
         return results
 
     def os_autocomplete(self, text, line, start_index, end_index):
@@ -181,7 +296,7 @@ class LittleFSCLI(Cmd):
         arg_start_idx = line.index(' ') + 1
         if start_index > arg_start_idx:
             search_dir += line[arg_start_idx:start_index]
-        logging.debug(f"Tab completion: {{search_dir: {search_dir}}}")
+        logging.debug("Tab completion: {search_dir: %s}", search_dir)
 
         if text:
             results = [
@@ -195,20 +310,149 @@ class LittleFSCLI(Cmd):
                 for dir_item in os.scandir(search_dir)
             ]
 
-        logging.debug(f"os_autocomplete: {{search_text: {text}, line: {line}, search_dir: {search_dir}, start_index: {start_index}, end_index: {end_index}, results: {results}}}")
+        logging.debug("os_autocomplete: {search_text: %s, line: %s, search_dir: %s, start_index: %s, end_index: %s, results: %s}",
+                      text, line, search_dir, start_index, end_index, results)
         return results
 
     def do_exit(self, inp):
+        self.finish_jobs()
         print("Bye")
         return True
 
+    def finish_jobs(self):
+        # Wait for background jobs, reporting them, before exiting
+        running = self.jobs.running()
+        if running:
+            print(f"Waiting for {len(running)} background job(s) to finish, Ctrl-C cancels them")
+            try:
+                for job in running:
+                    self.jobs.wait(job)
+            except KeyboardInterrupt:
+                for job in running:
+                    self.jobs.cancel(job)
+                for job in running:
+                    self.jobs.wait(job)
+            for job in self.jobs.reap():
+                self.report_job(job)
+
     def help_exit(self):
         print('exit the application. Shorthand: x q Ctrl-D.')
 
+    def do_trace(self, inp=''):
+        args = inp.split()
+        if not args:
+            print(f"Tracing is {tracer.mode}" + (f", writing to \"{tracer.filename}\"" if tracer.filename else ""))
+            return
+        try:
+            if args[0] not in ('off', 'summary', 'chrome') or len(args) != (2 if args[0] == 'chrome' else 1):
+                raise ValueError("usage: trace [off | summary | chrome <file>]")
+            written = tracer.stop()
+            if written:
+                print(f"Wrote trace to \"{written}\"")
+            tracer.start(args[0], args[1] if len(args) > 1 else None)
+        except (OSError, ValueError) as e:
+            self.error(f"trace: {e}")
+            return
+
+        # Images mounted from now on are instrumented when opened; these are the ones already loaded
+        for mount in self.mounts:
+            if mount.loaded:
+                (instrument_context if tracer.enabled else uninstrument_context)(mount.fs.context)
+
+    def help_trace(self):
+        print("Time commands, transfers, mounts and littlefs block device calls. Usage: \'trace [off | summary | chrome <file>]\'")
+        print("\tsummary  keep per-operation totals, shown by \'stats\'")
+        print("\tchrome   also record every span, written to <file> as a Chrome trace (chrome://tracing, Perfetto) when")
+        print("\t         tracing is turned off or on exit. PARTICLE_TRACE=summary or chrome:<file> starts tracing at startup")
+
+    def do_stats(self, inp=''):
+        if inp.strip() == '--reset':
+            tracer.reset()
+            return
+        if inp.strip():
+            self.error("usage: stats [--reset]")
+            return
+        summary = tracer.summary()
+        if not summary:
+            print("No trace data" + ("" if tracer.enabled else ", use \'trace summary\' to start collecting it"))
+            return
+        print(f"{'Operation':<20} {'Count':>7} {'Total ms':>10} {'Mean ms':>9} {'Max ms':>9} {'Bytes':>11} {'Blocks':>7}")
+        for name, stats in summary:
+            print(f"{name:<20} {stats.count:>7} {stats.seconds * 1000:>10.1f} {stats.seconds * 1000 / stats.count:>9.3f} "
+                  f"{stats.max * 1000:>9.3f} {stats.bytes:>11} {stats.blocks:>7}")
+
+    def help_stats(self):
+        print("Show the time, bytes and blocks traced per operation, most total time first. Usage: \'stats [--reset]\'")
+
+    def do_jobs(self, inp=''):
+        jobs = list(self.jobs.jobs.values())
+        if not jobs:
+            print("No background jobs")
+        for job in jobs:
+            print(f"[{job.id}] {job.description:<10} {job.elapsed():7.1f}s  {job.device_id or ''}  {job.status()}")
+
+    def help_jobs(self):
+        print("List background jobs. Start a transfer in the background by ending it with \'&\', e.g. \'fsread &\'")
+
+    def do_wait(self, inp=''):
+        if inp:
+            job = self.jobs.get(inp)
+            if not job:
+                self.error(f"wait: {inp}: No such job")
+                return
+            waiting = [job]
+        else:
+            waiting = self.jobs.running()
+        try:
+            for job in waiting:
+                self.jobs.wait(job)
+        except KeyboardInterrupt:
+            print("\nStopped waiting, the job is still running")
+
+    def complete_wait(self, text, line, start_index, end_index):
+        return [str(job.id) for job in self.jobs.running() if str(job.id).startswith(text)]
+
+    def help_wait(self):
+        print("Wait for a background job to finish, or for all of them. Usage: \'wait [job]\'")
+
+    def do_cancel(self, inp=''):
+        job = self.jobs.get(inp)
+        if not job:
+            self.error(f"cancel: {inp}: No such job" if inp else "usage: cancel <job>")
+            return
+        if not job.done:
+            self.jobs.cancel(job)
+            print(f"[{job.id}] {job.description} cancelling")
+
+    def complete_cancel(self, text, line, start_index, end_index):
+        return self.complete_wait(text, line, start_index, end_index)
+
+    def help_cancel(self):
+        print("Cancel a background job. Usage: \'cancel <job>\'")
+
+    def report_job(self, job, background=True):
+        if background:
+            print(f"[{job.id}] {job.description} {job.state} after {job.elapsed():.1f}s")
+        log = job.log.getvalue().rstrip()
+        if log:
+            print(log)
+        if job.state == 'done':
+            if job.on_success:
+                job.on_success()
+        elif job.state == 'failed':
+            self.error(f"{job.description}: {job.error}")
+        elif not background:
+            self.error(f"{job.description}: Transfer cancelled")
+
     def do_dfu(self, inp=''):
         if self.target_device:
-            print("Putting target device in DFU mode...")
-            ParticleUSB.enter_dfu_mode(device=self.target_device.device_id)
+            try:
+                if self.session.enter_dfu(self.target_device):
+                    print("Put target device in DFU mode")
+                else:
+                    print("Target device is already in DFU mode")
+            except DeviceError as e:
+                self.error(f"dfu: {e}")
         else:
             self.do_target()
             if self.target_device:
@@ -227,6 +471,7 @@ class LittleFSCLI(Cmd):
                     choice = int(input("Which device do you want to target? "))
                     if choice in range(1, len(devices) + 1):
                         self.target_device = devices[choice - 1]
+                        break
 
                 except ValueError:
                     print("Invalid choice")
@@ -240,73 +485,525 @@ class LittleFSCLI(Cmd):
 
         if self.target_device:
             if not self.target_device.is_gen3() and not self.target_device.is_tracker():
-                print("This utility only works with Asset Tracker and Gen 3 devices")
+                self.error("This utility only works with Asset Tracker and Gen 3 devices")
                 self.target_device = None
             else:
                 print(f"Selected device: {{name:\"{self.target_device.name}\", platform:\"{self.target_device.platform.name}\", id:\"{self.target_device.device_id}\"}}")
         else:
-            print("No devices found!")
+            self.error("No devices found!")
 
     def help_target(self):
         print("Set target Particle device")
 
     def do_fsread(self, inp=''):
+        args, background = split_background(inp)
+        full = '--full' in args
+        mount_name = None
+        if '--mount' in args:
+            position = args.index('--mount')
+            mount_name = args[position + 1] if position + 1 < len(args) else os.path.splitext(LOCAL_FILENAME)[0]
+            del args[position:position + 2]
+        if any(arg != '--full' for arg in args):
+            self.error("usage: fsread [--full] [--mount [name]] [&]")
+            return
+
         if not self.target_device:
             self.do_target()
 
         if self.target_device:
-            self.do_dfu()
-            # ParticleUSB.enter_dfu_mode(device=self.target_device.device_id)
-
-            if os.path.exists(LOCAL_FILENAME):
-                # print("Deleting existing local filesystem copy")
-                os.remove(LOCAL_FILENAME)
-
-            print("Creating local copy of device filesystem...")
-            print()
-            readFilesystem(LOCAL_FILENAME, self.target_device)
-
-            print(f"Wrote filesystem to local temporary file: \"{LOCAL_FILENAME}\". Use \'mount\' to mount it\n")
+            def on_done(filename):
+                print(f"Wrote filesystem to local temporary file: \"{filename}\". Use \'mount\' to mount it")
+                if mount_name:
+                    self.do_mount(f"{filename} as {mount_name}")
+            device = self.target_device
+            self.run_transfer('fsread', lambda: self.session.fsread(device, full),
+                              background, on_done)
 
     def help_fsread(self):
-        print("Make a local copy of a device's embedded filesystem")
+        print("Make a local copy of a device's embedded filesystem. Usage: \'fsread [--full] [--mount [name]] [&]\'")
+        print("\tOnly the blocks the filesystem uses are read, unused blocks are left erased; --full reads every block")
+        print("\t--mount mounts the copy when the read finishes, as [name] if given. A trailing & runs the read in the background")
 
     # TODO: Add filename argument
     # TODO: Add --nobackup flag to skip read & backup
     def do_fswrite(self, inp=''):
+        args, background = split_background(inp)
+        dry_run = '--dry-run' in args
+        delta = '--delta' in args or dry_run
+        if any(arg not in ('--delta', '--dry-run') for arg in args):
+            self.error("usage: fswrite [--delta] [--dry-run] [&]")
+            return
+
         if not self.target_device:
             self.do_target()
 
         if self.target_device:
             if os.path.exists(LOCAL_FILENAME):
                 # TODO: Add some sanity checking here - file size since we know it, maybe try to mount it first?
-                self.do_dfu()
-
-                backup_fn = f"{self.target_device.device_id}-{datetime.now().strftime('%Y.%m.%d-%H.%M.%S')}.littlefs"
-                print("Backing up existing filesystem...")
-                readFilesystem("backups/" + backup_fn, self.target_device)
-                print(f"Device filesystem backed up to \"{backup_fn}\"")
-                print()
-
-                print(f"Writing local filesystem \"{LOCAL_FILENAME}\" to device...")
-                print("NOTE: Ignore warnings about DFU Suffix being incorrect!")
-                print()
-                writeFilesystem(LOCAL_FILENAME, self.target_device)
-                print("Wrote new filesystem to device")
+                device = self.target_device
+                self.run_transfer('fswrite', lambda: self.session.fswrite(device, delta=delta, dry_run=dry_run),
+                                  background, lambda result: self.report_write(device, result, delta))
             else:
-                print("No local filesystem copy exists to write! Use \'fsread\' first.")
+                self.error("No local filesystem copy exists to write! Use \'fsread\' first.")
+
+    PHASE_MESSAGES = {
+        'entering DFU mode': "Putting target device in DFU mode...",
+        'reading': "Creating local copy of device filesystem...",
+        'backing up': "Backing up existing filesystem...",
+        'writing': "Writing filesystem to device...\nNOTE: Ignore warnings about DFU Suffix being incorrect!",
+    }
+
+    def run_transfer(self, description, start, background, on_done=None):
+        """Start a session transfer for the target device with `start()`, then show its progress until it finishes, or
+        leave it running as a background job. `on_done(result)` reports the result once it succeeds"""
+        try:
+            transfer = start()
+        except DeviceBusy as e:
+            self.error(f"{description}: {e}, use \'wait {e.job.id}\' or \'cancel {e.job.id}\'")
+            return
+        except ParticleLittleFSError as e:
+            self.error(f"{description}: {e}")
+            return
+        if on_done:
+            transfer.job.on_success = lambda: on_done(transfer.result)  # Called by report_job()
+        if background:
+            print(f"[{transfer.id}] {description} running in the background")
+            return
+
+        shown = None
+        try:
+            for phase, event in transfer:
+                if event is None:
+                    print(('\n' if shown else '') + self.PHASE_MESSAGES.get(phase, phase))
+                    shown = None
+                elif (event.operation, event.percent) != shown:
+                    shown = (event.operation, event.percent)
+                    sys.stdout.write(f"\r\t{format_progress(event)}   ")
+                    sys.stdout.flush()
+        except KeyboardInterrupt:
+            transfer.cancel()
+        except ParticleLittleFSError:
+            pass  # Reported with the job below
+        self.jobs.wait(transfer.job)
+        if shown:
+            print()
+        self.jobs.discard(transfer.job)
+        self.report_job(transfer.job, background=False)
+
+    def report_write(self, device, result, delta):
+        print(f"Device filesystem backed up to \"{result.backup}\" ({result.new_blocks} new blocks stored)")
+        if delta and result.extents is None:
+            print(f"Delta write unavailable: device image is {result.device_size} bytes, local image is {result.size} "
+                  f"bytes, so the full image {'was' if result.written else 'would be'} written")
+        elif delta:
+            block_size = device.platform.fs_block_size
+            changed = sum(length for _, length in result.extents)
+            print(f"Delta plan: {len(result.extents)} extent(s), {changed // block_size} of {result.size // block_size} blocks changed")
+            for offset, length in result.extents:
+                print(f"\t0x{DFU_FS_ADDRESS + offset:08x}:{length}")
+            print(f"Writing {changed} of {result.size} bytes (saves {result.size - changed} bytes, {100 * (result.size - changed) / result.size:.1f}%)")
+            if not result.extents:
+                print("Device filesystem already matches the local copy, nothing to write")
+        if result.written:
+            print("Wrote new filesystem to device")
 
     def help_fswrite(self):
-        print("Write local filesystem to device")
+        print("Write local filesystem to device. Usage: \'fswrite [--delta] [--dry-run] [&]\'")
+        print("\t--delta    only write the flash blocks that differ from the device's current filesystem")
+        print("\t--dry-run  print the delta write plan without writing anything")
 
-    # TODO: Add "write backup" function which allows you to select a backup image from the backups/ folder and write it
     def do_fsrestore(self, inp=''):
-        print("Available backup images:")
-        for file in os.listdir("backups/"):
-            print("\t" + file)
+        store = BackupStore(BACKUP_PATH)
+        names = store.names()
+        inp, background = split_background(inp)
+        inp = ' '.join(inp)
+        if not inp:
+            if names:
+                print("Available backup images:")
+                for name in names:
+                    manifest = store.manifest(name)
+                    print(f"\t{name}  ({manifest['size']} bytes, {len(set(manifest['blocks']))} unique blocks)")
+            else:
+                print("No backup images available")
+            return
+
+        if inp not in names:
+            self.error(f"fsrestore: {inp}: No such backup")
+            return
+
+        if not self.target_device:
+            self.do_target()
+
+        if self.target_device:
+            device = self.target_device
+            self.run_transfer('fsrestore', lambda: self.session.fsrestore(inp, device),
+                              background, lambda result: self.report_write(device, result, False))
+
+    def complete_fsrestore(self, text, line, start_index, end_index):
+        return [name for name in BackupStore(BACKUP_PATH).names() if name.startswith(text)]
 
     def help_fsrestore(self):
-        print("Unimplemented")
+        print("List backup images, or write one back to the device. Usage: \'fsrestore [backup]\'")
+
+    def do_fsprune(self, inp=''):
+        if self.jobs.running():
+            self.error("fsprune: Background jobs may be adding backups, use \'wait\' or \'cancel\' first")
+            return
+
+        store = BackupStore(BACKUP_PATH)
+        imported = store.import_legacy()
+        if imported:
+            print(f"Imported {len(imported)} raw backup image(s) into the backup store")
+
+        for name in inp.split():
+            try:
+                store.remove(name)
+                print(f"Removed backup \"{name}\"")
+            except FileNotFoundError:
+                self.error(f"fsprune: {name}: No such backup")
+
+        removed, freed = store.prune()
+        print(f"Pruned {removed} unreferenced block(s), freed {freed} bytes")
+
+    def complete_fsprune(self, text, line, start_index, end_index):
+        return self.complete_fsrestore(text, line, start_index, end_index)
+
+    def help_fsprune(self):
+        print("Delete backup blocks no backup image references. Usage: \'fsprune [backup ...]\' also removes the named backups first")
+
+    def do_diff(self, inp=''):
+        args = inp.split()
+        if len(args) != 2:
+            self.error("usage: diff <imageA> <imageB>")
+            return
+
+        try:
+            image_a, image_b = load_image(args[0]), load_image(args[1])
+            block_size = (ParticleUSB.platform_for_size(len(image_a)) or ParticleUSB.known_platforms['default']).fs_block_size
+            differences, changed = diff_images(image_a, image_b, block_size)
+        except (OSError, ValueError) as e:
+            self.error(f"diff: {e}")
+            return
+
+        counts = {'A': 0, 'D': 0, 'M': 0}
+        for status, path, size_a, size_b in differences:
+            counts[status] += 1
+            if path.endswith('/'):
+                print(f"{status} {path}")
+            elif status == 'M':
+                print(f"{status} {path} ({size_a} -> {size_b} bytes, {size_b - size_a:+d})")
+            else:
+                print(f"{status} {path} ({size_a if status == 'D' else size_b} bytes)")
+        print(f"{counts['A']} added, {counts['D']} removed, {counts['M']} modified "
+              f"({changed} of {len(image_a) // block_size} blocks differ)")
+
+    def complete_diff(self, text, line, start_index, end_index):
+        names = [name for name in BackupStore(BACKUP_PATH).names() if name.startswith(text)]
+        return names + self.os_autocomplete(text, line, start_index, end_index)
+
+    def help_diff(self):
+        print("List files added (A), removed (D) or modified (M) between two images. Usage: \'diff <imageA> <imageB>\'")
+        print("\tEither image may be a file or the name of a backup in the backup store")
+
+    def do_fleet(self, inp=''):
+        usage = "usage: fleet read [directory] | fleet write [image] [--delta] [--platform name] [--jobs N]"
+        args = inp.split()
+        if not args or args[0] not in ('read', 'write'):
+            self.error(usage)
+            return
+
+        if self.jobs.running():
+            print("fleet: Background jobs are using devices, use \'wait\' or \'cancel\' first")
+            return
+
+        operation = args.pop(0)
+        delta = False
+        platform = None
+        jobs = self.fleet_jobs
+        positional = []
+        try:
+            while args:
+                arg = args.pop(0)
+                if arg == '--delta':
+                    delta = True
+                elif arg == '--platform':
+                    platform = args.pop(0)
+                elif arg == '--jobs':
+                    jobs = int(args.pop(0))
+                    if jobs < 1:
+                        raise ValueError
+                else:
+                    positional.append(arg)
+        except (IndexError, ValueError):
+            self.error(usage)
+            return
+        if len(positional) > 1:
+            self.error(usage)
+            return
+
+        if operation == 'read':
+            target = positional[0] if positional else '.'
+            if not os.path.isdir(target):
+                self.error(f"fleet: {target}: Not a directory")
+                return
+        else:
+            target = positional[0] if positional else LOCAL_FILENAME
+            if not os.path.exists(target):
+                self.error(f"fleet: {target}: No such file")
+                return
+
+        devices = self.fleet_devices(platform)
+        if devices:
+            self.run_fleet(operation, devices, target, delta, jobs)
+
+    def fleet_devices(self, platform=None):
+        devices = [device for device in ParticleUSB.list_devices()
+                   if (device.is_gen3() or device.is_tracker()) and
+                   (not platform or platform in (device.platform.name, ParticleUSB.platform_display_name(device.platform)))]
+        if not devices:
+            self.error("No devices found!")
+        return devices
+
+    def run_fleet(self, operation, devices, target, delta=False, jobs=None):
+        # Returns {device_id: (succeeded, detail, seconds)}; the detail of a successful read is the image filename
+        jobs = jobs or self.fleet_jobs
+        print(f"Putting {len(devices)} device(s) in DFU mode...")
+        if not ParticleUSB.enter_dfu_mode(all=True):
+            print("Not every device entered DFU mode, their transfers may fail")
+
+        print(f"Running fleet {operation} on {len(devices)} device(s), {min(jobs, len(devices))} at a time...")
+        progress = FleetProgress(devices)
+        results = {}
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            if operation == 'read':
+                futures = {pool.submit(run_fleet_job, fleet_read, device, target, progress): device for device in devices}
+            else:
+                futures = {pool.submit(run_fleet_job, fleet_write, device, target, delta, progress): device for device in devices}
+            for future in as_completed(futures):
+                device = futures[future]
+                results[device.device_id] = future.result()
+                progress.update(device.device_id, 'done' if results[device.device_id][0] else 'failed')
+
+        print()
+        print(f"{'Device':<26} {'Platform':<10} {'Result':<7} {'Time':>7}  Detail")
+        for device in devices:
+            succeeded, detail, seconds = results[device.device_id]
+            print(f"{device.device_id:<26} {device.platform.name:<10} {'OK' if succeeded else 'FAILED':<7} {seconds:>6.1f}s  {detail}")
+        failed = sum(1 for succeeded, _, _ in results.values() if not succeeded)
+        print(f"{len(devices) - failed} succeeded, {failed} failed")
+        if failed:
+            self.status = 1
+        return results
+
+    def complete_fleet(self, text, line, start_index, end_index):
+        return self.os_autocomplete(text, line, start_index, end_index)
+
+    def help_fleet(self):
+        print("Read or write the filesystem of every connected device at once. Usage:")
+        print("\tfleet read [directory]   save each device's filesystem to <directory>/<device_id>.littlefs")
+        print("\tfleet write [image]      back up each device, then write [image] (default: the local copy)")
+        print("\t--delta          only write the flash blocks that changed")
+        print("\t--platform name  only use devices of this platform (e.g. tracker)")
+        print(f"\t--jobs N         transfer to at most N devices concurrently (default: {self.fleet_jobs})")
+
+    def do_provision(self, inp=''):
+        usage = "usage: provision <spec.json> (<image> ... | --fsread [directory]) [--out directory] [--jobs N]"
+        args = inp.split()
+        if not args:
+            self.error(usage)
+            return
+
+        spec_fn = args.pop(0)
+        images = []
+        fsread_dir = None
+        out_dir = None
+        jobs = None
+        try:
+            while args:
+                arg = args.pop(0)
+                if arg == '--fsread':
+                    fsread_dir = args.pop(0) if args and not args[0].startswith('--') else '.'
+                elif arg == '--out':
+                    out_dir = args.pop(0)
+                elif arg == '--jobs':
+                    jobs = int(args.pop(0))
+                    if jobs < 1:
+                        raise ValueError
+                else:
+                    images.append(arg)
+        except (IndexError, ValueError):
+            self.error(usage)
+            return
+        if bool(images) == bool(fsread_dir):
+            self.error(usage)
+            return
+
+        try:
+            spec = Provision.load_spec(spec_fn)
+        except (OSError, ValueError, KeyError) as e:
+            self.error(f"provision: {spec_fn}: Invalid spec: {e}")
+            return
+
+        for directory in filter(None, (fsread_dir, out_dir)):
+            if not os.path.isdir(directory):
+                self.error(f"provision: {directory}: Not a directory")
+                return
+
+        if fsread_dir:
+            devices = self.fleet_devices()
+            if not devices:
+                return
+            results = self.run_fleet('read', devices, fsread_dir)
+            images = [detail for succeeded, detail, _ in results.values() if succeeded]
+            print()
+
+        print(f"Provisioning {len(images)} image(s)...")
+        start = time.monotonic()
+        failed = 0
+        for result in Provision.provision_images(images, spec, out_dir, jobs):
+            if result['ok']:
+                print(f"\tOK      {result['seconds']:>6.2f}s  {result['output']}  ({result['bytes']} bytes inserted)")
+            else:
+                failed += 1
+                print(f"\tFAILED  {result['seconds']:>6.2f}s  {result['image']}: {result['error']}")
+        print(f"{len(images) - failed} succeeded, {failed} failed in {time.monotonic() - start:.2f}s")
+        if failed:
+            self.status = 1
+
+    def complete_provision(self, text, line, start_index, end_index):
+        return self.os_autocomplete(text, line, start_index, end_index)
+
+    def help_provision(self):
+        print("Apply a provisioning spec to many images in parallel worker processes. Usage:")
+        print("\tprovision <spec.json> <image> ...          provision local images in place")
+        print("\tprovision <spec.json> --fsread [directory] read every connected device first, then provision the images")
+        print("\t--out directory  write provisioned images to this directory instead of in place")
+        print("\t--jobs N         number of worker processes (default: one per CPU)")
+
+    def do_manifest(self, inp=''):
+        args = inp.split()
+        if len(args) > 2:
+            self.error("usage: manifest [image] [manifest.json]")
+            return
+        image = args[0] if args else LOCAL_FILENAME
+        manifest_fn = args[1] if len(args) > 1 else os.path.splitext(image)[0] + '.manifest.json'
+        start = time.monotonic()
+        try:
+            manifest = Manifest.manifest_image(image)
+            Manifest.write_manifest(manifest, manifest_fn)
+        except (OSError, ValueError, errors.LittleFSError) as e:
+            self.error(f"manifest: {image}: {e}")
+            return
+        total = sum(entry['size'] for entry in manifest['files'].values())
+        print(f"Wrote manifest \"{manifest_fn}\": {len(manifest['files'])} files, {total} bytes hashed "
+              f"in {time.monotonic() - start:.2f}s")
+
+    def complete_manifest(self, text, line, start_index, end_index):
+        return self.os_autocomplete(text, line, start_index, end_index)
+
+    def help_manifest(self):
+        print("Write the path, size and SHA-256 of every file in an image to a JSON manifest, for verify. Usage:")
+        print("\tmanifest [image] [manifest.json]   (default: the local copy, and the image name with .manifest.json)")
+
+    def do_verify(self, inp=''):
+        usage = "usage: verify <image> ... <manifest.json> [--jobs N]"
+        args = inp.split()
+        jobs = None
+        try:
+            if '--jobs' in args:
+                i = args.index('--jobs')
+                jobs = int(args[i + 1])
+                del args[i:i + 2]
+                if jobs < 1:
+                    raise ValueError
+        except (IndexError, ValueError):
+            self.error(usage)
+            return
+        if len(args) < 2:
+            self.error(usage)
+            return
+        images, manifest_fn = args[:-1], args[-1]
+
+        try:
+            manifest = Manifest.load_manifest(manifest_fn)
+        except (OSError, ValueError, KeyError, AttributeError) as e:
+            self.error(f"verify: {manifest_fn}: Invalid manifest: {e}")
+            return
+
+        start = time.monotonic()
+        failed = 0
+        for result in Manifest.verify_images(images, manifest, jobs):
+            if result['ok']:
+                print(f"\tOK      {result['seconds']:>6.2f}s  {result['image']}  ({result['files']} files match)")
+                continue
+            failed += 1
+            if result['error']:
+                print(f"\tFAILED  {result['seconds']:>6.2f}s  {result['image']}: {result['error']}")
+                continue
+            print(f"\tFAILED  {result['seconds']:>6.2f}s  {result['image']}: {len(result['missing'])} missing, "
+                  f"{len(result['extra'])} extra, {len(result['mismatched'])} mismatched")
+            for path in result['missing']:
+                print(f"\t\tmissing   {path}")
+            for path in result['extra']:
+                print(f"\t\textra     {path}")
+            for path, reason in result['mismatched']:
+                print(f"\t\tmismatch  {path}: {reason}")
+        if len(images) > 1:
+            print(f"{len(images) - failed} verified, {failed} failed in {time.monotonic() - start:.2f}s")
+        if failed:
+            self.status = 1
+
+    def complete_verify(self, text, line, start_index, end_index):
+        return self.os_autocomplete(text, line, start_index, end_index)
+
+    def help_verify(self):
+        print("Check images against a manifest written by manifest, listing missing, extra and mismatched files. Usage:")
+        print("\tverify <image> ... <manifest.json> [--jobs N]")
+        print("\tFiles whose size differs aren't hashed. Several images are verified in parallel worker processes,")
+        print("\t--jobs N of them (default: one per CPU)")
+
+    def do_mkimage(self, inp=''):
+        usage = "usage: mkimage <directory> <image> --platform <name>"
+        try:
+            args = shlex.split(inp)
+        except ValueError:
+            self.error(usage)
+            return
+        platform = None
+        if '--platform' in args:
+            position = args.index('--platform')
+            if position + 1 < len(args):
+                platform = ParticleUSB.find_platform(args[position + 1])
+                if not platform or not platform.user_block_count:
+                    self.error(f"mkimage: {args[position + 1]}: Unsupported platform")
+                    return
+                del args[position:position + 2]
+        if len(args) != 2 or not platform:
+            self.error(usage)
+            return
+
+        src_dir, out_filename = args
+        if not os.path.isdir(src_dir):
+            self.error(f"mkimage: {src_dir}: Not a directory")
+            return
+
+        try:
+            directories, files, packed = LittleFSImage.build_image(src_dir, out_filename, platform)
+            print(f"Wrote {platform.fs_size_bytes()} byte {platform.name} image \"{out_filename}\": {directories} directories, {files} files, {packed} bytes")
+        except errors.LittleFSError as e:
+            if e.name == "ERR_NOSPC":
+                self.error(f"mkimage: {src_dir}: Does not fit in a {platform.fs_size_bytes()} byte filesystem")
+            else:
+                self.error(f"mkimage: {e}")
+        except OSError as e:
+            self.error(f"mkimage: {e}")
+
+    def complete_mkimage(self, text, line, start_index, end_index):
+        return self.os_autocomplete(text, line, start_index, end_index)
+
+    def help_mkimage(self):
+        print("Build a LittleFS image from a directory on your computer, no device needed. Usage: \'mkimage <directory> <image> --platform <name>\'")
+        print("\tSupported platforms: " + ", ".join(platform.name for platform in ParticleUSB.known_platforms.values() if platform.user_block_count))
 
     def do_save(self, inp=''):
         if self.fs:
@@ -326,13 +1023,13 @@ class LittleFSCLI(Cmd):
                         shutil.copy(LOCAL_PATH + '/' + LOCAL_FILENAME, save_path)
                         print(f"Saved filesystem copy to \"{save_path}\"")
                     except Exception as e:
-                        print("Error copying file: {}".format(e))
+                        self.error("Error copying file: {}".format(e))
                 else:
-                    print(f"Error: \"{save_path}\" is not a valid path")
+                    self.error(f"Error: \"{save_path}\" is not a valid path")
             else:
-                print("Error: No path supplied. Usage is \'save <path>\'")
+                self.error("Error: No path supplied. Usage is \'save <path>\'")
         else:
-            print("No filesystem mounted! Use \'mount\' to mount one.")
+            self.error("No filesystem mounted! Use \'mount\' to mount one.")
             return
 
     def complete_save(self, text, line, start_index, end_index):
@@ -342,63 +1039,210 @@ class LittleFSCLI(Cmd):
         print("Save a copy of the temporary filesystem read out from a device. Usage: \'save <path>\'")
 
     def do_mount(self, inp=''):
-        self.fs = None
-        self.fs_filename = inp if inp else LOCAL_FILENAME
-        self.cur_dir = '/'
+        args = inp.split()
+        name = None
+        if len(args) >= 2 and args[-2] == 'as':
+            name = args[-1]
+            args = args[:-2]
+            if name == 'as':
+                self.error(f"mount: {name}: Invalid mount name")
+                return
+        filename = ' '.join(args) if args else LOCAL_FILENAME
         try:
-            self.fs = mount_fs(self.fs_filename)
-        except FileNotFoundError as e:
-            print(f"mount: {self.fs_filename}: Not a file")
-        except errors.LittleFSError as e:
-            print(e)
+            mount = self.session.mount(filename, name)
+        except ParticleLittleFSError as e:
+            self.error(f"mount: {e}")
+            return
+        print(f"\"{filename}\" mounted as {LittleFSImage.size_description(mount.size)} filesystem")
 
     def complete_mount(self, text, line, start_index, end_index):
         return self.os_autocomplete(text, line, start_index, end_index)
 
     def help_mount(self):
-        print("Mount local copy of device filesystem")
+        print("Mount local copy of device filesystem. Usage: \'mount [littlefs_filesystem] [as name]\'")
+        print("\tSeveral images can be mounted at once under different names (default: the file name without its extension).")
+        print("\tThe last one mounted is active; paths like \'name:/dir/file\' refer to any mounted image. See \'use\' and \'mounts\'")
+
+    def mount_arg(self, inp):
+        # Split an optional leading 'name:' off `inp`, returning (mount, rest of inp)
+        args = inp.split(maxsplit=1)
+        if args and args[0].endswith(':') and args[0][:-1] in self.mounts:
+            return self.mounts.get(args[0][:-1]), args[1] if len(args) > 1 else ''
+        return self.mounts.get(), inp
 
     def do_unmount(self, inp=''):
-        if self.fs:
-            out_file = inp if inp else self.fs_filename
-            with open(out_file, 'wb') as fh:
-                fh.write(self.fs.context.buffer)
-            print(f"Wrote filesystem to file: \"{out_file}\"")
-            self.fs = None
-            self.cur_dir = '/'
+        mount, out_file = self.mount_arg(inp)
+        if mount:
+            out_file = out_file or mount.filename
+            written = self.session.unmount(mount.name, out_file)
+            print(f"Wrote filesystem to file: \"{out_file}\" ({written} bytes written)")
         else:
-            print("No filesystem mounted!")
+            self.error("No filesystem mounted!")
+
+    def complete_unmount(self, text, line, start_index, end_index):
+        return [f"{mount.name}:" for mount in self.mounts if mount.name.startswith(text)]
 
     def help_unmount(self):
-        print("Unmount local copy of device filesystem")
+        print("Unmount local copy of device filesystem. Usage: \'unmount [name:] [destination]\'")
+        print("\tWrites the active mount (or the mount \'name\') to [destination], or back to the file it was mounted from")
 
     def do_sync(self, inp=''):
-        if self.fs:
-            with open(self.fs_filename, 'wb') as fh:
-                fh.write(self.fs.context.buffer)
-            print(f"Wrote filesystem to file: \"{LOCAL_FILENAME}\"")
+        mount, out_file = self.mount_arg(inp)
+        if mount:
+            out_file = out_file or mount.filename
+            written = self.session.sync(mount.name, out_file)
+            print(f"Wrote filesystem to file: \"{out_file}\" ({written} bytes written)")
         else:
-            print("No filesystem mounted!")
+            self.error("No filesystem mounted!")
+
+    def complete_sync(self, text, line, start_index, end_index):
+        return self.complete_unmount(text, line, start_index, end_index)
 
     def help_sync(self):
-        print("Save in-memory filesystem changes to file")
+        print("Save in-memory filesystem changes to file. Usage: \'sync [name:] [destination]\'")
+
+    def do_use(self, inp=''):
+        name = inp.strip().rstrip(':')
+        if name in self.mounts:
+            self.session.use(name)
+        elif name:
+            self.error(f"use: {name}: No such mount")
+        else:
+            self.error("usage: use <name>")
+
+    def complete_use(self, text, line, start_index, end_index):
+        return [mount.name for mount in self.mounts if mount.name.startswith(text)]
+
+    def help_use(self):
+        print("Make the mount \'name\' the active one, that unqualified paths refer to. Usage: \'use <name>\'")
+
+    def do_mounts(self, inp=''):
+        args = inp.split()
+        if args:
+            try:
+                if args[0] != '--budget' or len(args) != 2:
+                    raise ValueError
+                self.mounts.budget = int(float(args[1]) * 1024 * 1024)
+            except ValueError:
+                self.error("usage: mounts [--budget MB]")
+                return
+            self.mounts.enforce_budget()
+
+        if self.mounts:
+            print(f"  {'Name':<16} {'State':<8} {'Changes':<8} File")
+            for mount in sorted(self.mounts, key=lambda mount: mount.name):
+                print(f"{'*' if mount.name == self.mounts.active else ' '} {mount.name:<16} "
+                      f"{'loaded' if mount.loaded else 'evicted':<8} {'unsaved' if mount.is_dirty() else '':<8} {mount.filename}")
+        print(f"{self.mounts.loaded_bytes() // 1024} of {self.mounts.budget // 1024} KB budget in use, "
+              f"{self.mounts.evictions} evictions")
+
+    def help_mounts(self):
+        print("List mounted images, marking the active one with \'*\'. Usage: \'mounts [--budget MB]\'")
+        print("\tLeast recently used images beyond the memory budget are evicted (written back to their file if changed)")
+        print("\tand reloaded when next used. --budget sets the budget, also set by PARTICLE_MOUNT_BUDGET_MB (default 64)")
+
+    def do_snapshot(self, inp=''):
+        if self.fs:
+            args = inp.split()
+            if len(args) > 1:
+                self.error("usage: snapshot [name]")
+                return
+            mount = self.mounts.get()
+            names = [name for name, _ in mount.snapshots()]
+            name = args[0] if args else next(f"s{i}" for i in range(1, len(names) + 2) if f"s{i}" not in names)
+            if name in names:
+                mount.fs.context.drop_snapshot(name)
+            mount.fs.context.snapshot(name)
+            print(f"Took snapshot \"{name}\" of \"{mount.name}\"")
+        else:
+            self.error("No filesystem mounted!")
+
+    def help_snapshot(self):
+        print("Take a snapshot of the mounted image, which rollback returns to. Usage: 'snapshot [name]'")
+        print("\tA snapshot only saves the blocks changed after it was taken, so it costs memory in proportion to the")
+        print("\tchanges made since. Snapshots are kept in memory only, and lost on unmount or eviction")
+
+    def do_snapshots(self, inp=''):
+        if self.fs:
+            mount = self.mounts.get()
+            snapshots = mount.snapshots()
+            if snapshots:
+                print(f"{'Name':<16} {'Blocks changed since':>20}")
+                for name, journal in snapshots:
+                    print(f"{name:<16} {len(journal):>20}")
+            else:
+                print(f"No snapshots of \"{mount.name}\"")
+            print(f"{len(mount.undo)} command(s) can be undone, {mount.fs.context.journal_bytes() // 1024} KB of "
+                  f"snapshot memory in use")
+        else:
+            self.error("No filesystem mounted!")
+
+    def help_snapshots(self):
+        print("List the snapshots of the mounted image")
+
+    def do_rollback(self, inp=''):
+        if self.fs:
+            args = inp.split()
+            mount = self.mounts.get()
+            names = [name for name, _ in mount.snapshots()]
+            if len(args) > 1:
+                self.error("usage: rollback [name]")
+                return
+            if not names:
+                self.error(f"rollback: No snapshots of \"{mount.name}\"")
+                return
+            name = args[0] if args else names[-1]
+            if name not in names:
+                self.error(f"rollback: {name}: No such snapshot")
+                return
+            blocks = mount.rollback(name, keep=True)
+            print(f"Rolled \"{mount.name}\" back to snapshot \"{name}\" ({blocks} blocks restored)")
+            self.check_cur_dir(mount)
+        else:
+            self.error("No filesystem mounted!")
+
+    def help_rollback(self):
+        print("Return the mounted image to a snapshot (default: the latest). Usage: 'rollback [name]'")
+        print("\tThe snapshot is kept, so you can roll back to it again. Later snapshots are dropped")
+
+    def do_undo(self, inp=''):
+        undone = self.mounts.undo()
+        if not undone:
+            self.error("undo: Nothing to undo")
+            return
+        line, mounts = undone
+        for mount, blocks in mounts:
+            print(f"Undid \"{line}\" in \"{mount.name}\" ({blocks} blocks restored)")
+            self.check_cur_dir(mount)
+
+    def check_cur_dir(self, mount):
+        # After a rollback the working directory may no longer exist
+        try:
+            if mount.index.stat(mount.cur_dir).type == LFS_TYPE_DIR:
+                return
+        except errors.LittleFSError:
+            pass
+        mount.cur_dir = '/'
+
+    def help_undo(self):
+        print(f"Undo the last command that changed a mounted image. Up to {UNDO_DEPTH} commands per image can be undone")
 
     def do_tree(self, inp=''):
         if self.fs:
-            path = inp if inp else self.cur_dir
+            mount, path = self.resolve(inp if inp else self.cur_dir)
             try:
-                self.fs.stat(path)
+                mount.index.stat(path)
             except errors.LittleFSError as e:
                 if e.name == "ERR_NOENT":
-                    print(f"tree: {path}: Not a directory")
+                    self.error(f"tree: {path}: Not a directory")
                 else:
-                    print(e)
+                    self.error(e)
                 return
             print(path)
-            for line in tree(self.fs, path):
+            for line in tree(mount.index, path):
                 print(line)
         else:
-            print("No filesystem mounted!")
+            self.error("No filesystem mounted!")
 
     def complete_tree(self, text, line, start_index, end_index):
         return self.fs_autocomplete(text, line, start_index, end_index)
@@ -408,74 +1252,276 @@ class LittleFSCLI(Cmd):
 
     def do_ls(self, inp=''):
         if self.fs:
-            ls_path = inp if inp else self.cur_dir
             try:
-                for dir_item in self.fs.scandir(ls_path):
-                    print(f"{'d' if dir_item.type == 34 else '-'} {dir_item.size:>8} {dir_item.name}")
-            except errors.LittleFSError as e:
-                if e.name == "ERR_NOENT":
-                    print(f"ls: {ls_path}: No such file or directory")
-                elif e.name == "ERR_NOTDIR":
-                    print(f"ls: {ls_path}: Not a directory")
-                else:
-                    print(e)
+                for entry in self.session.listdir(inp):
+                    print(f"{'d' if entry.type == 'dir' else '-'} {entry.size:>8} {entry.name}")
+            except ParticleLittleFSError as e:
+                self.error(f"ls: {e}")
         else:
-            print("No filesystem mounted!")
+            self.error("No filesystem mounted!")
 
     def complete_ls(self, text, line, start_index, end_index):
         return self.fs_autocomplete(text, line, start_index, end_index)
 
-    def do_cat(self, inp=''):
+    def do_du(self, inp=''):
         if self.fs:
-            size = 0
+            args = inp.split()
+            summarize = '-s' in args
+            paths = [arg for arg in args if arg != '-s']
+            if len(paths) > 1:
+                self.error("usage: du [-s] [path]")
+                return
+            mount, path = self.resolve(paths[0] if paths else self.cur_dir)
+            path = posixpath.join(mount.cur_dir, path)
+            index = mount.index
             try:
-                stat = self.fs.stat(inp)
-                if stat.type == 34:
-                    print(f"cat: {inp}: Is a directory")
+                if index.stat(path).type != LFS_TYPE_DIR:
+                    print(f"{index.stat(path).size:<10} {path}")
                     return
-                size = stat.size
-                # print("Size of {}: {} bytes".format(inp, size))
+                if not summarize:
+                    for dir_path in self.du_directories(index, path):
+                        print(f"{index.usage(dir_path):<10} {dir_path}")
+                print(f"{index.usage(path):<10} {path}")
             except errors.LittleFSError as e:
                 if e.name == "ERR_NOENT":
-                    print(f"ls: {inp}: No such file or directory")
+                    self.error(f"du: {path}: No such file or directory")
                 else:
-                    print(e)
+                    self.error(e)
+        else:
+            self.error("No filesystem mounted!")
+
+    def du_directories(self, index, path):
+        # Subdirectories of `path`, deepest first, as du lists them
+        for dir_item in index.scandir(path):
+            if dir_item.type == LFS_TYPE_DIR:
+                dir_path = posixpath.join(path, dir_item.name)
+                yield from self.du_directories(index, dir_path)
+                yield dir_path
+
+    def complete_du(self, text, line, start_index, end_index):
+        return self.fs_autocomplete(text, line, start_index, end_index)
+
+    def help_du(self):
+        print("Show the size of a directory and its subdirectories in bytes. Usage: \'du [-s] [path]\', -s prints only the total")
+
+    def do_df(self, inp=''):
+        if self.fs:
+            if inp and not os.path.exists(inp):
+                self.error(f"df: {inp}: No such file or directory")
+                return
+            context = self.fs.context
+            block_size = context.block_size
+            block_count = len(context.buffer) // block_size
+            try:
+                metadata, data = ImageLayout(context.buffer, block_size).allocation()
+            except ValueError as e:
+                self.error(f"df: {e}")
                 return
+            used = len(metadata | data)
+            free = block_count - used
+            print(f"{'Filesystem':<24} {'Blocks':>7} {'Used':>7} {'Free':>7} {'Use%':>5}")
+            print(f"{os.path.basename(self.fs_filename):<24} {block_count:>7} {used:>7} {free:>7} {used * 100 // block_count:>4}%")
+            print(f"{len(metadata)} metadata blocks, {len(data)} file data blocks, {free * block_size} bytes free "
+                  f"({block_size} byte blocks)")
+
+            if inp:
+                files, directories, needed = estimate_blocks(inp, block_size)
+                print(f"\"{inp}\" ({files} files, {directories} directories) needs {needed} blocks: ", end='')
+                if needed <= free:
+                    print(f"fits, leaving {free - needed} blocks free")
+                else:
+                    print(f"does not fit, {needed - free} blocks short")
+        else:
+            self.error("No filesystem mounted!")
+
+    def complete_df(self, text, line, start_index, end_index):
+        return self.os_autocomplete(text, line, start_index, end_index)
+
+    def help_df(self):
+        print("Show used and free blocks of the mounted filesystem. Usage: \'df [local_path]\'")
+        print("\tWith a local file or directory, also shows whether it would fit")
 
+    def do_cat(self, inp=''):
+        if self.fs:
+            usage = "usage: cat [--head N | --tail N] [--bytes START:END] [--hex] file"
+            args = inp.split()
+            head = tail = None
+            byte_range = None
+            hex_mode = False
+            paths = []
             try:
-                with self.fs.open(inp, 'r') as fh:
-                    file = fh.read(size)
-                    try:
-                        print(file.decode('utf-8'))
-                    except UnicodeDecodeError as e:
-                        print(file)
-            except errors.LittleFSError as e:
-                print(e)
+                while args:
+                    arg = args.pop(0)
+                    if arg == '--head':
+                        head = int(args.pop(0))
+                    elif arg == '--tail':
+                        tail = int(args.pop(0))
+                    elif arg == '--bytes':
+                        first, last = args.pop(0).split(':')
+                        byte_range = (int(first, 0) if first else None, int(last, 0) if last else None)
+                    elif arg == '--hex':
+                        hex_mode = True
+                    else:
+                        paths.append(arg)
+            except (IndexError, ValueError):
+                self.error(usage)
+                return
+            if len(paths) != 1 or (head is not None and tail is not None) or any(n is not None and n < 1 for n in (head, tail)):
+                self.error(usage)
+                return
+            try:
+                entry = self.session.stat(paths[0])
+                if entry.type == 'dir':
+                    self.error(f"cat: {paths[0]}: Is a directory")
+                    return
+            except ParticleLittleFSError as e:
+                self.error(f"cat: {e}")
+                return
+
+            size = entry.size
+            start, end = 0, size
+            if byte_range:
+                start = min(size, byte_range[0] or 0)
+                end = max(start, min(size, size if byte_range[1] is None else byte_range[1]))
+
+            out = binary_stdout()
+            try:
+                with self.session.read(entry) as fh:
+                    if head is not None:
+                        fh.seek(start)
+                        end = start + head_length(fh, self.copy_buffer, head, end - start)
+                    elif tail is not None:
+                        start = max(start, tail_offset(fh, end, self.copy_buffer, tail))
+
+                    fh.seek(start)
+                    if hex_mode:
+                        hexdump(fh, out, self.copy_buffer, start, end - start)
+                    elif end > start:
+                        copy_stream(fh, out, self.copy_buffer, end - start)
+                        fh.seek(end - 1)
+                        if fh.read(1) != b'\n':
+                            out.write(b'\n')
+                out.flush()
+            except ParticleLittleFSError as e:
+                self.error(f"cat: {e}")
         else:
-            print("No filesystem mounted!")
+            self.error("No filesystem mounted!")
+
+    @property
+    def copy_buffer(self):
+        # One reusable buffer bounds the memory used by cat, cp, insert and extract, whatever the file size
+        return self.session.copy_buffer
 
     def complete_cat(self, text, line, start_index, end_index):
         return self.fs_autocomplete(text, line, start_index, end_index)
 
+    def expand(self, command, pattern):
+        # What a path argument, which may contain wildcards, matches relative to the working directory: the prefix
+        # to show its paths with ('g:' if the argument named the mount) and the matching Entries. A pattern that
+        # matches nothing is reported
+        name, _ = self.mounts.split(pattern)
+        try:
+            entries = self.session.glob(pattern)
+        except ParticleLittleFSError as e:
+            self.error(f"{command}: {e}")
+            return '', []
+        if not entries:
+            self.error(f"{command}: {pattern}: No such file or directory")
+        return f"{name}:" if name else '', entries
+
     def do_rm(self, inp=''):
         if self.fs:
-            try:
-                self.fs.remove(inp)
-            except errors.LittleFSError as e:
-                if e.name == "ERR_NOENT":
-                    print(f"ls: {inp}: No such file or directory")
-                elif e.name == "ERR_NOTEMPTY":
-                    print(f"ls: {inp}: Directory not empty")
-                else:
-                    print(e)
+            args = inp.split()
+            recursive = '-r' in args
+            patterns = [arg for arg in args if arg != '-r']
+            if not patterns:
+                self.error("usage: rm [-r] file_or_directory ...")
                 return
 
+            # Everything to remove from each mount, removed as one batch
+            batches = {}
+            for pattern in patterns:
+                prefix, entries = self.expand('rm', pattern)
+                for entry in entries:
+                    if entry.path == '/':
+                        self.error(f"rm: {prefix}/: Cannot remove the root directory")
+                    elif entry.type == 'dir' and not recursive and self.session.listdir(entry):
+                        self.error(f"rm: {prefix}{entry.path}: Directory not empty")
+                    else:
+                        batches.setdefault(entry.mount, []).append(entry)
+
+            for name, entries in batches.items():
+                try:
+                    removed = self.session.remove(*entries, recursive=recursive)
+                except ParticleLittleFSError as e:
+                    self.error(f"rm: {e}")
+                    continue
+                if recursive or any(has_glob(pattern) for pattern in patterns):
+                    print(f"Removed {removed} file(s) and directories from \"{name}\"")
         else:
-            print("No filesystem mounted!")
+            self.error("No filesystem mounted!")
 
     def complete_rm(self, text, line, start_index, end_index):
         return self.fs_autocomplete(text, line, start_index, end_index)
 
+    def help_rm(self):
+        print("Remove files and empty directories. Usage: 'rm [-r] file_or_directory ...'")
+        print("\tPaths may contain wildcards (*, ? and [...]), e.g. 'rm /logs/*.log.[0-9]'. -r also removes directories")
+        print("\twith everything in them. Everything matched is removed as one batch, deepest paths first")
+
+    def do_find(self, inp=''):
+        if self.fs:
+            try:
+                args = shlex.split(inp)
+            except ValueError as e:
+                self.error(f"find: {e}")
+                return
+            top, tests, delete = None, {}, False
+            try:
+                args = iter(args)
+                for arg in args:
+                    if arg in ('-name', '-size', '-type'):
+                        value = next(args, None)
+                        if value is None:
+                            raise ValueError(f"{arg} needs a value")
+                        tests[arg[1:]] = value
+                    elif arg == '-delete':
+                        delete = True
+                    elif top is None and not arg.startswith('-'):
+                        top = arg
+                    else:
+                        raise ValueError(f"unknown argument \"{arg}\"")
+                found = self.session.find(top or '', **tests)
+            except ValueError as e:
+                self.error(f"find: {e}")
+                self.help_find()
+                return
+            except ParticleLittleFSError as e:
+                self.error(f"find: {e}")
+                return
+
+            name, _ = self.mounts.split(top or '')
+            prefix = f"{name}:" if name else ''
+            for entry in found:
+                print(prefix + entry.path)
+            if delete and found:
+                try:
+                    removed = self.session.remove(*found, recursive=True)
+                except ParticleLittleFSError as e:
+                    self.error(f"find: {e}")
+                    return
+                print(f"Removed {removed} file(s) and directories")
+        else:
+            self.error("No filesystem mounted!")
+
+    def complete_find(self, text, line, start_index, end_index):
+        return self.fs_autocomplete(text, line, start_index, end_index)
+
+    def help_find(self):
+        print("Find files and directories. Usage: 'find [path] [-name glob] [-size [+|-]N[k|M|G]] [-type f|d] [-delete]'")
+        print("\tLists everything under [path] (default: the current directory) passing every test given. -size +N is more")
+        print("\tthan N bytes, -N less, N exactly. -delete removes everything listed, directories with all their contents")
+
     # TODO: cd
     def do_cd(self, inp):
         if self.fs:
@@ -493,7 +1539,7 @@ class LittleFSCLI(Cmd):
                         if len(cur_dir_split) > 1:
                             cur_dir_split.pop()
                         else:
-                            print(f"cd: {inp}: No such file or directory")
+                            self.error(f"cd: {inp}: No such file or directory")
                             return
                     else:
                         cur_dir_split.append(cd_dir)
@@ -501,20 +1547,20 @@ class LittleFSCLI(Cmd):
                 new_path = '/' + '/'.join(filter(None, cur_dir_split))
 
             try:
-                new_path_stat = self.fs.stat(new_path)
+                new_path_stat = self.index.stat(new_path)
                 if new_path_stat.type == 34:
                     self.cur_dir = new_path
                 else:
-                    print(f"cd: {new_path}: Not a directory")
+                    self.error(f"cd: {new_path}: Not a directory")
             except errors.LittleFSError as e:
                 if e.name == "ERR_NOENT":
-                    print(f"cd: {new_path}: No such file or directory")
+                    self.error(f"cd: {new_path}: No such file or directory")
                 else:
-                    print(f"cd: {new_path}: Error: {e}")
+                    self.error(f"cd: {new_path}: Error: {e}")
 
             # print("New Directory: \"{}\"".format(self.cur_dir))
         else:
-            print("No filesystem mounted!")
+            self.error("No filesystem mounted!")
 
     def complete_cd(self, text, line, start_index, end_index):
         return self.fs_autocomplete(text, line, start_index, end_index)
@@ -522,152 +1568,274 @@ class LittleFSCLI(Cmd):
     def do_mkdir(self, inp=''):
         if self.fs:
             if inp:
-                dir_to_make = self.cur_dir + '/' + inp
                 try:
-                    self.fs.mkdir(dir_to_make)
-                except FileExistsError as e:
-                    print(f"mkdir: {dir_to_make}: Directory exists")
-                except errors.LittleFSError as e:
-                    print(e)
+                    self.session.mkdir(inp)
+                except ParticleLittleFSError as e:
+                    self.error(f"mkdir: {e}")
             else:
-                print("usage: mkdir [directory]")
+                self.error("usage: mkdir [directory]")
         else:
-            print("No filesystem mounted!")
+            self.error("No filesystem mounted!")
 
     def complete_mkdir(self, text, line, start_index, end_index):
         return self.fs_autocomplete(text, line, start_index, end_index)
 
     def do_cp(self, inp=''):
         if self.fs:
-            paths = inp.split(" ")
-            if len(paths) == 2:
+            paths = inp.split()
+            if len(paths) > 2 or (len(paths) == 2 and has_glob(paths[0])):
                 try:
-                    from_file_stat = self.fs.stat(paths[0])
-                    if from_file_stat.type == 34:
-                        raise errors.LittleFSError(code=-21)    # Cannot copy directories, raise ERR_ISDIR
-                    with self.fs.open(paths[0], 'rb') as from_file:
-                        try:
-                            with self.fs.open(paths[1], 'wb') as to_file:
-                                to_file.write(from_file.read(from_file_stat.size))
-                            print("Copied {} bytes from {} to {}".format(from_file_stat.size, paths[0], paths[1]))
-                        except errors.LittleFSError as e:
-                            if e.name == "ERR_NOENT":
-                                print(f"cp: {paths[1]}: No file or directory")
-                            elif e.name == "ERR_ISDIR":
-                                print(f"cp: {paths[1]}: Is a directory")
-                            else:
-                                print(f"cp: {paths[1]}: Error: {e}")
-                except errors.LittleFSError as e:
-                    if e.name == "ERR_ISDIR":
-                        print(f"cp: {paths[0]}: Is a directory")
-                    elif e.name == "ERR_NOENT":
-                        print(f"cp: {paths[0]}: No file or directory")
-                    else:
-                        print(f"cp: {paths[0]}: {e}")
-
+                    to_dir = self.session.stat(paths[-1])
+                except ParticleLittleFSError:
+                    to_dir = None
+                if not to_dir or to_dir.type != 'dir':
+                    self.error(f"cp: {paths[-1]}: Not a directory")
+                    return
+                to_name, _ = self.mounts.split(paths[-1])
+                to_prefix = f"{to_name}:" if to_name else ''
+                for pattern in paths[:-1]:
+                    prefix, entries = self.expand('cp', pattern)
+                    for entry in entries:
+                        self.copy_file(prefix + entry.path, to_prefix + posixpath.join(to_dir.path, entry.name))
+            elif len(paths) == 2:
+                self.copy_file(*paths)
             else:
-                print("usage: cp [path_from] [path_to]")
+                self.error("usage: cp [path_from] [path_to] | cp [path_from ...] [directory]")
         else:
-            print("No filesystem mounted!")
+            self.error("No filesystem mounted!")
+
+    def copy_file(self, source, dest):
+        # Copy one file between (possibly mount-qualified) paths, reporting any error against the path given
+        try:
+            size = self.session.copy(source, dest)
+        except ParticleLittleFSError as e:
+            self.error(f"cp: {e}")
+            return
+        print("Copied {} bytes from {} to {}".format(size, source, dest))
 
     def complete_cp(self, text, line, start_index, end_index):
         return self.fs_autocomplete(text, line, start_index, end_index)
 
+    def help_cp(self):
+        print("Copy a file within or between mounted filesystems. Usage: 'cp [path_from] [path_to]'")
+        print("\tWith wildcards (e.g. 'cp /logs/*.log g:/archive') or several files, copies each into a directory")
+
     def do_insert(self, inp=''):
         if self.fs:
             paths = inp.split(" ")
             if len(paths) == 2:
                 try:
-                    # Does the target file already exist? If so,
-                    try:
-                        self.fs.stat(paths[1])
-                        print(f"insert: {paths[1]}: Target file already exists")
-                        return
-                    except errors.LittleFSError as e:
-                        if e.name != "ERR_NOENT":
-                            raise e;
-                    # dir_path = os.path.dirname(os.path.realpath(__file__))
-                    # file_path = dir_path + '/' + paths[0]
-                    size = os.stat(paths[0]).st_size
-                    with open(paths[0], 'rb') as from_file:
-                        try:
-                            with self.fs.open(paths[1], 'wb') as to_file:
-                                for chunk in iter((lambda: from_file.read(256)), b''):
-                                    to_file.write(chunk)
-                            print(f"Copied {size} bytes: local:{os.path.realpath(from_file.name)} > littlefs:{paths[1]}")
-                        except errors.LittleFSError as e:
-                            if e.name == "ERR_NOENT":
-                                print(f"insert: {paths[1]}: Path does not exist — do you need to mkdir?")
-                            elif e.name == "ERR_ISDIR":
-                                print(f"insert: {paths[1]}: Is a directory")
-                            else:
-                                print(f"insert: {paths[1]}: Error: {e}")
-                except errors.LittleFSError as e:
-                    if e.name == "ERR_ISDIR":
-                        print(f"insert: {paths[0]}: Is a directory")
-                    else:
-                        print(f"insert: {paths[0]}: {e}")
-                except FileNotFoundError as e:
-                    print(f"insert: {paths[0]}: Not a file")
-
+                    size = self.session.insert(*paths)
+                except FileExists:
+                    self.error(f"insert: {paths[1]}: Target file already exists")
+                except ParticleLittleFSError as e:
+                    missing_dir = isinstance(e, FileNotFound) and e.path == paths[1]
+                    self.error(f"insert: {e}{' — do you need to mkdir?' if missing_dir else ''}")
+                else:
+                    print(f"Copied {size} bytes: local:{os.path.realpath(paths[0])} > littlefs:{paths[1]}")
             else:
-                print("usage: cp [local_path] [path_to]")
+                self.error("usage: insert [local_path] [path_to]")
         else:
-            print("No filesystem mounted!")
+            self.error("No filesystem mounted!")
 
     def help_insert(self):
         print("Insert a file from your computer into the LittleFS filesystem")
 
     def do_extract(self, inp=''):
         if self.fs:
-            paths = inp.split(" ")
-            if len(paths) == 2:
-                try:
-                    # Open source file
-                    size = self.fs.stat(paths[0]).size
-                    with self.fs.open(paths[0], 'rb') as from_file:
-                        try:
-                            # Open destination file
-                            if os.path.exists(paths[1]):
-                                raise FileExistsError
-                            with open(paths[1], 'wb') as to_file:
-                                for chunk in iter((lambda: from_file.read(256)), b''):
-                                    to_file.write(chunk)
-                                print(f"Copied {size} bytes: littlefs:{paths[0]} > local:{os.path.realpath(to_file.name)}")
-                        except errors.LittleFSError as e:
-                            if e.name == "ERR_NOENT":
-                                print(f"insert: {paths[1]}: Not a file")
-                            elif e.name == "ERR_ISDIR":
-                                print(f"insert: {paths[1]}: Is a directory")
-                            else:
-                                print(f"insert: {paths[1]}: Error: {e}")
-                        except FileExistsError:
-                            print(f"insert: {paths[1]}: Destination file exists")
-                except errors.LittleFSError as e:
-                    if e.name == "ERR_ISDIR":
-                        print(f"insert: {paths[0]}: Is a directory")
-                    else:
-                        print(f"insert: {paths[0]}: {e}")
-                except FileNotFoundError as e:
-                    print(f"insert: {paths[0]}: Not a file")
-
+            paths = inp.split()
+            if len(paths) > 2 or (len(paths) == 2 and has_glob(paths[0])):
+                if not os.path.isdir(paths[-1]):
+                    self.error(f"extract: {paths[-1]}: Not a directory")
+                    return
+                for pattern in paths[:-1]:
+                    prefix, entries = self.expand('extract', pattern)
+                    for entry in entries:
+                        self.extract_file(prefix + entry.path, os.path.join(paths[-1], entry.name))
+            elif len(paths) == 2:
+                self.extract_file(*paths)
             else:
-                print("usage: cp [local_path] [path_to]")
+                self.error("usage: extract [path_from] [local_path] | extract [path_from ...] [local_directory]")
         else:
-            print("No filesystem mounted!")
+            self.error("No filesystem mounted!")
+
+    def extract_file(self, source, local_path):
+        try:
+            size = self.session.extract(source, local_path)
+        except ParticleLittleFSError as e:
+            self.error(f"extract: {e}")
+            return
+        print(f"Copied {size} bytes: littlefs:{source} > local:{os.path.realpath(local_path)}")
 
     def help_extract(self):
         print("Extract a file from the LittleFS filesystem to your computer")
+        print("\tWith wildcards (e.g. 'extract /logs/*.log out') or several files, extracts each into a local directory")
+
+    def sync_args(self, command, inp):
+        # Parse '[--delete] <from> <to>' for push and pull
+        args = inp.split()
+        delete = '--delete' in args
+        paths = [arg for arg in args if arg != '--delete']
+        if len(paths) != 2:
+            self.error(f"usage: {command} [--delete] {'<local_dir> <fs_dir>' if command == 'push' else '<fs_dir> <local_dir>'}")
+            return None
+        return delete, paths
+
+    def do_push(self, inp=''):
+        if self.fs:
+            parsed = self.sync_args('push', inp)
+            if not parsed:
+                return
+            delete, (local_dir, fs_dir) = parsed
+            if not os.path.isdir(local_dir):
+                self.error(f"push: {local_dir}: Not a directory")
+                return
+            mount, fs_dir = self.resolve(fs_dir)
+            fs_dir = posixpath.join(mount.cur_dir, fs_dir)
+            try:
+                stats = TreeSync.push_tree(mount.index, local_dir, fs_dir, delete)
+                print(f"push: {stats}")
+            except errors.LittleFSError as e:
+                self.error(f"push: {fs_dir}: {e}")
+            except OSError as e:
+                self.error(f"push: {e}")
+        else:
+            self.error("No filesystem mounted!")
+
+    def complete_push(self, text, line, start_index, end_index):
+        return self.os_autocomplete(text, line, start_index, end_index)
+
+    def help_push(self):
+        print("Copy a directory tree from your computer into the filesystem, skipping unchanged files. Usage: \'push [--delete] <local_dir> <fs_dir>\'")
+        print("\t--delete  remove files and directories from <fs_dir> that don't exist in <local_dir>")
+
+    def do_pull(self, inp=''):
+        if self.fs:
+            parsed = self.sync_args('pull', inp)
+            if not parsed:
+                return
+            delete, (fs_dir, local_dir) = parsed
+            mount, fs_dir = self.resolve(fs_dir)
+            fs_dir = posixpath.join(mount.cur_dir, fs_dir)
+            try:
+                stats = TreeSync.pull_tree(mount.index, fs_dir, local_dir, delete)
+                print(f"pull: {stats}")
+            except errors.LittleFSError as e:
+                if e.name == "ERR_NOENT":
+                    self.error(f"pull: {fs_dir}: No such file or directory")
+                elif e.name == "ERR_NOTDIR":
+                    self.error(f"pull: {fs_dir}: Not a directory")
+                else:
+                    self.error(f"pull: {fs_dir}: {e}")
+            except OSError as e:
+                self.error(f"pull: {e}")
+        else:
+            self.error("No filesystem mounted!")
+
+    def complete_pull(self, text, line, start_index, end_index):
+        return self.fs_autocomplete(text, line, start_index, end_index)
+
+    def help_pull(self):
+        print("Copy a directory tree from the filesystem to your computer, skipping unchanged files. Usage: \'pull [--delete] <fs_dir> <local_dir>\'")
+        print("\t--delete  remove files and directories from <local_dir> that don't exist in <fs_dir>")
 
     def default(self, inp=''):
         if inp == 'x' or inp == 'q':
             return self.do_exit(inp)
 
-        print(f"Unknown Command: \"{inp}\"")
+        self.error(f"Unknown Command: \"{inp}\"")
 
     do_EOF = do_exit
     help_EOF = help_exit
 
 
+def script_commands(text):
+    """Commands in a script or -c argument: one per line or separated by ';', skipping blanks and # comments"""
+    commands = []
+    for line in text.splitlines():
+        if line.strip().startswith('#'):
+            continue
+        commands.extend(command.strip() for command in line.split(';') if command.strip())
+    return commands
+
+
+def serve(path=None):
+    # Run the JSON-RPC daemon on the Unix socket `path` until Ctrl-C or SIGTERM
+    import signal
+    import Daemon
+    path = path or Daemon.socket_path()
+    daemon = Daemon.Daemon(ParticleLittleFS(), LOCAL_FILENAME)
+    try:
+        server = Daemon.DaemonServer(path, daemon)
+    except OSError as e:
+        print(f"daemon: {e}", file=sys.stderr)
+        return 1
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+    LittleFSImage.open_image  # Import littlefs now, rather than in the first request
+    print(f"Serving JSON-RPC on \"{path}\", Ctrl-C stops")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        daemon.close()
+    return 0
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Access the LittleFS filesystem of Particle devices. With no commands, starts the interactive "
+                    "shell; otherwise runs them and exits with status 0 if they all succeeded, 1 if one failed")
+    parser.add_argument('script', nargs='?', help="file of commands to run, one per line ('-' for stdin)")
+    parser.add_argument('-c', dest='commands', metavar='COMMANDS', help="commands to run, separated by ';'")
+    parser.add_argument('--keep-going', action='store_true', help="run the remaining commands after one fails")
+    parser.add_argument('--debug-log', metavar='FILE', help="write debug logging to FILE")
+    parser.add_argument('--daemon', action='store_true', help="serve the JSON-RPC API on a Unix socket instead")
+    parser.add_argument('--socket', metavar='PATH', help="socket for --daemon (default: $PARTICLE_DAEMON_SOCKET or "
+                                                         "particle-littlefs.sock)")
+    args = parser.parse_args(argv)
+
+    if args.debug_log:
+        logging.basicConfig(filename=args.debug_log, level=logging.DEBUG)
+    configure_from_env()
+
+    if args.commands is not None and args.script:
+        parser.error("give either -c or a script, not both")
+    if args.daemon:
+        if args.commands is not None or args.script:
+            parser.error("--daemon doesn't run commands")
+        return serve(args.socket)
+    if args.commands is not None:
+        commands = script_commands(args.commands)
+    elif args.script == '-' or (args.script is None and not sys.stdin.isatty()):
+        commands = script_commands(sys.stdin.read())
+    elif args.script:
+        try:
+            with open(args.script) as fh:
+                commands = script_commands(fh.read())
+        except OSError as e:
+            parser.error(f"{args.script}: {e.strerror}")
+    else:
+        LittleFSCLI().cmdloop()
+        return 0
+
+    cli = LittleFSCLI()
+    status = 0
+    for command in commands:
+        stop = cli.postcmd(cli.onecmd(command), command)
+        status = status or cli.status
+        if stop or (cli.status and not args.keep_going):
+            break
+    cli.status = 0
+    cli.finish_jobs()
+    return status or cli.status
+
+
 if __name__ == '__main__':
-    LittleFSCLI().cmdloop()
+    sys.exit(main())